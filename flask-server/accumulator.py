@@ -0,0 +1,222 @@
+"""
+One-pass, mergeable aggregation of per-track features into playlist metrics.
+
+An Accumulator keeps, per numeric feature, a running count, sum and sum of
+squared deviations (for the variance), and the set of Rosamerica genres
+seen as an 8-bit mask. Tracks can be added one at a time, in any order, and
+accumulators built over separate chunks (threads, workers, jobs) merge into
+the accumulator of the whole:
+
+    acc = Accumulator()
+    for detail in details:
+        acc.add(detail)
+    acc.merge(Accumulator.from_dict(other_worker_state))
+    jojo.get_jojo_chart(acc.chart_metrics(total_duration_ms, potential))
+
+Counts, sums and the genre mask merge exactly: sums are kept as exact
+floating-point partials (as math.fsum does), so the result doesn't depend
+on how the tracks were split or ordered. Variances merge with Chan's
+pairwise formula, exact up to rounding.
+"""
+import math
+import feature_store
+
+FEATURES = ("bpm", "danceability", "relaxedProbability") # Numeric per-track features that are averaged
+GENRES = feature_store.GENRES # Rosamerica classes; bit i of the genre mask is GENRES[i]
+
+_GENRE_BITS = {genre: 1 << i for i, genre in enumerate(GENRES)}
+
+
+def genre_bit(genre):
+    """The mask bit of a Rosamerica genre label, 0 for anything else."""
+    return _GENRE_BITS.get(genre, 0)
+
+
+def genre_count(mask):
+    return bin(mask).count("1")
+
+
+def genre_mask(genres):
+    """Mask of the genres that are present in a {genre: count} mapping."""
+    mask = 0
+    for genre, count in genres.items():
+        if count > 0:
+            mask |= genre_bit(genre)
+    return mask
+
+
+def _add_partial(partials, x):
+    """Adds x to a list of non-overlapping partials whose exact sum is the total (Shewchuk)."""
+    i = 0
+    for y in partials:
+        if abs(x) < abs(y):
+            x, y = y, x
+        hi = x + y
+        lo = y - (hi - x)
+        if lo:
+            partials[i] = lo
+            i += 1
+        x = hi
+    partials[i:] = [x]
+
+
+def _finite(value, name):
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"{name} must be finite, got {value}")
+    return value
+
+
+def feature_value(detail, feature):
+    """A track's value of a numeric feature, or None when missing."""
+    value = detail.get(feature)
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value):
+        return value
+    return None
+
+
+class RunningStats:
+    """Count, exact sum and sum of squared deviations (m2) of one feature."""
+
+    def __init__(self, count=0, partials=None, m2=0.0):
+        self.count = count
+        self.partials = partials if partials is not None else []
+        self.m2 = m2
+
+    @property
+    def sum(self):
+        return math.fsum(self.partials)
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count > 0 else None
+
+    @property
+    def variance(self):
+        """Population variance, None when empty."""
+        return max(self.m2, 0.0) / self.count if self.count > 0 else None
+
+    def add(self, value, weight=1):
+        """
+        Adds weight occurrences of value; a negative weight removes
+        occurrences added before (West's weighted update).
+        """
+        if not weight:
+            return
+        count = self.count + weight
+        if count <= 0:
+            self.count, self.partials, self.m2 = 0, [], 0.0
+            return
+        old_mean = self.mean if self.count > 0 else 0.0
+        step = value if weight > 0 else -value
+        for _ in range(abs(weight)): # Repeated adds keep the sum exact, value * weight wouldn't
+            _add_partial(self.partials, step)
+        self.count = count
+        self.m2 += weight * (value - old_mean) * (value - self.mean)
+
+    def merge(self, other):
+        """Adds the occurrences counted by other (Chan et al.'s pairwise update)."""
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.partials, self.m2 = other.count, list(other.partials), other.m2
+            return self
+        delta = other.mean - self.mean
+        count = self.count + other.count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        for partial in other.partials:
+            _add_partial(self.partials, partial)
+        self.count = count
+        return self
+
+    def to_dict(self):
+        return {"count": self.count, "sum": list(self.partials), "m2": self.m2}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Inverse of to_dict. Raises ValueError for negative counts and non-finite numbers."""
+        count = int(data["count"])
+        if count < 0:
+            raise ValueError(f"count must not be negative, got {count}")
+        return cls(count, [_finite(p, "sum") for p in data["sum"]], _finite(data["m2"], "m2"))
+
+
+class Accumulator:
+    """Running playlist metrics over any number of tracks; see the module docstring."""
+
+    def __init__(self):
+        self.stats = {feature: RunningStats() for feature in FEATURES}
+        self.genre_mask = 0
+
+    @classmethod
+    def from_details(cls, details, weights=None):
+        """Accumulator over track details (with per-detail occurrence counts when given)."""
+        acc = cls()
+        for i, detail in enumerate(details):
+            acc.add(detail, 1 if weights is None else weights[i])
+        return acc
+
+    def add(self, detail, weight=1):
+        """Adds weight occurrences of a track's features (None details are skipped)."""
+        if not detail or weight <= 0:
+            return
+        for feature in FEATURES:
+            value = feature_value(detail, feature)
+            if value is not None:
+                self.stats[feature].add(value, weight)
+        self.genre_mask |= genre_bit(detail.get("genre"))
+
+    def merge(self, other):
+        for feature in FEATURES:
+            self.stats[feature].merge(other.stats[feature])
+        self.genre_mask |= other.genre_mask
+        return self
+
+    def metrics(self):
+        """
+        Playlist metrics, as aggregate_metrics and the frontend compute them:
+        averages rounded to 2 decimals, None when no track has the feature.
+        """
+        def average(feature):
+            mean = self.stats[feature].mean
+            return round(mean, 2) if mean is not None else None
+
+        return {
+            "averageBPM": average("bpm"),
+            "averageDanceability": average("danceability"),
+            "uniqueGenreCount": genre_count(self.genre_mask) or None,
+            "averageRelaxedProbability": average("relaxedProbability"),
+        }
+
+    def chart_metrics(self, total_duration_ms, potential):
+        """metrics() plus the Spotify duration and potential: the input of jojo.get_jojo_chart."""
+        return dict(self.metrics(), spotifyTotalDurationMs=total_duration_ms, potential=potential)
+
+    def feature_stats(self):
+        """Per-feature count, mean and standard deviation."""
+        summary = {}
+        for feature, stats in self.stats.items():
+            variance = stats.variance
+            summary[feature] = {
+                "count": stats.count,
+                "mean": stats.mean,
+                "std": math.sqrt(variance) if variance is not None else None,
+            }
+        summary["genres"] = [genre for genre in GENRES if self.genre_mask & genre_bit(genre)]
+        return summary
+
+    def to_dict(self):
+        """JSON-safe form, for sending partial accumulators between processes."""
+        return {
+            "features": {feature: stats.to_dict() for feature, stats in self.stats.items()},
+            "genre_mask": self.genre_mask,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        acc = cls()
+        for feature, stats in data.get("features", {}).items():
+            if feature in acc.stats:
+                acc.stats[feature] = RunningStats.from_dict(stats)
+        acc.genre_mask = int(data.get("genre_mask", 0)) & ((1 << len(GENRES)) - 1)
+        return acc
@@ -1,81 +1,215 @@
+import os
 import requests
 import json
+from concurrent.futures import ThreadPoolExecutor
+import deadlines
+import feature_store
+import http_client
+import logs
+import telemetry
+
+API_ROOT = os.getenv("ACOUSTICBRAINZ_API_ROOT", "https://acousticbrainz.org/api/v1")
+BULK_LIMIT = 25 # Max recording_ids the bulk endpoints accept per request
+LOWLEVEL_FEATURES = "rhythm.bpm;rhythm.danceability" # Only the low-level fields we use
+REQUEST_TIMEOUT = 15 # Seconds, per request (less when an analysis budget ends sooner)
+HEDGE_AFTER = float(os.getenv("ACOUSTICBRAINZ_HEDGE_AFTER", 2.0)) # Seconds before a slow bulk request gets a duplicate
+
+log = logs.get_logger(__name__)
+
+
+def _feature(doc, path):
+    """Reads a dotted feature path from a low-level document, nested or flat."""
+    if path in doc:
+        return doc[path]
+    for key in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key)
+    return doc
+
+
+def extract_features(mbid, data, hdata):
+    """
+    Builds the feature dictionary from a low-level document and an optional
+    high-level document (None when AcousticBrainz has no high-level data).
+    """
+    # --- Extract BPM ---
+    bpm = _feature(data, 'rhythm.bpm')
+    bpm = bpm if isinstance(bpm, (int, float)) else None
+
+    # --- Extract Danceability ---
+    danceability = _feature(data, 'rhythm.danceability')
+    danceability = danceability if isinstance(danceability, (int, float)) else None
+
+    highlevel = (hdata or {}).get('highlevel', {})
+
+    # --- Determine Genre (Rosamerica Only) ---
+    genre = "Unknown"
+    try:
+        genre = highlevel.get('genre_rosamerica', {}).get('value') or "Unknown"
+    except Exception as e:
+         log.warning("Error extracting Rosamerica genre", mbid=mbid, error=str(e))
+         genre = "Unknown"
+
+    # --- Extract Relaxed Mood Probability ---
+    relaxed_prob = None
+    try:
+        # Path: highlevel -> mood_relaxed -> all -> relaxed
+        relaxed_prob = highlevel.get('mood_relaxed', {}).get('all', {}).get('relaxed', None)
+    except Exception as e:
+         log.warning("Error extracting relaxed mood", mbid=mbid, error=str(e))
+         relaxed_prob = None # Fallback
+
+    log.debug("Extracted features", mbid=mbid, bpm=bpm, danceability=danceability,
+              genre=genre, relaxed_probability=relaxed_prob, sample=True)
+    return {
+        "bpm": bpm,
+        "danceability": danceability,
+        "genre": genre,
+        "relaxedProbability": relaxed_prob,
+    }
+
 
 def get_acousticbrainz_data(mbid):
     """
-    Takes a single MBID and queries the AcousticBrainz low-level API.
+    Takes a single MBID and looks it up in the offline feature store, or
+    queries the AcousticBrainz low-level API when it isn't there.
     Returns a dictionary containing bpm, danceability, the Rosamerica genre,
     and the relaxed mood probability.
     Handles cases where sections or specific fields might be missing.
     """
     if not mbid:
-        print(f"No MBID provided.")
+        log.debug("No MBID provided")
         return None
 
-    api_url = f"https://acousticbrainz.org/api/v1/{mbid}/low-level"
-    hurl = f"https://acousticbrainz.org/api/v1/{mbid}/high-level"
-    print(f"Querying AcousticBrainz: {hurl}")
-    print(f"Querying AcousticBrainz: {api_url}")
+    # The dataset is frozen: answer from the offline feature store when built
+    store = feature_store.default_store()
+    if store is not None:
+        res = store.get(mbid)
+        telemetry.CACHE_LOOKUPS.inc(cache="feature_store", result="miss" if res is None else "hit")
+        if res is not None:
+            return res
+
+    api_url = f"{API_ROOT}/{mbid}/low-level"
+    hurl = f"{API_ROOT}/{mbid}/high-level"
+    log.debug("Querying AcousticBrainz", mbid=mbid, sample=True)
 
     try:
-        response = requests.get(api_url, timeout=15)
-        hres = requests.get(hurl, timeout=15)
+        with telemetry.stage("acoustic_fetch"):
+            response = http_client.session.get(api_url, timeout=REQUEST_TIMEOUT)
+            hres = http_client.session.get(hurl, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
 
         try:
             data = response.json()
         except json.JSONDecodeError:
-            print(f"Error: Invalid lowlevel JSON received from AcousticBrainz for MBID {mbid}")
+            log.warning("Invalid low-level JSON received from AcousticBrainz", mbid=mbid)
             return None
         try:
             hdata = hres.json()
         except json.JSONDecodeError:
-            print(f"Error: Invalid highlevel JSON received from AcousticBrainz for MBID {mbid}")
+            log.warning("Invalid high-level JSON received from AcousticBrainz", mbid=mbid)
             return None
 
-        # --- Extract BPM ---
-        bpm = data.get('rhythm', {}).get('bpm')
-        bpm = bpm if isinstance(bpm, (int, float)) else None
-        print(f"MBID {mbid} - Validated BPM: {bpm}")
-
-        # --- Extract Danceability ---
-        danceability = data.get('rhythm', {}).get('danceability')
-        danceability = danceability if isinstance(danceability, (int, float)) else None
-        print(f"MBID {mbid} - Validated Danceability: {danceability}")
-
-        # --- Determine Genre (Rosamerica Only) ---
-        genre = "Unknown"
-        try:
-            genre = hdata.get('highlevel', {}).get('genre_rosamerica', {}).get('value', {})
-        except Exception as e:
-             print(f"MBID {mbid} - Error extracting Rosamerica genre: {e}")
-             genre = "Unknown"
-
-        # --- Extract Relaxed Mood Probability ---
-        relaxed_prob = None
-        try:
-            # Path: highlevel -> mood_relaxed -> all -> relaxed
-            relaxed_prob = hdata.get('highlevel', {}).get('mood_relaxed', {}).get('all', {}).get('relaxed', None)
-        except Exception as e:
-             print(f"MBID {mbid} - Error extracting relaxed mood: {e}")
-             relaxed_prob = None # Fallback
-
-        # Return dictionary with the new probability
-        res = {
-            "bpm": bpm,
-            "danceability": danceability,
-            "genre": genre,
-            "relaxedProbability": relaxed_prob, # Add the new field
-        }
-        print()
-        return res
+        return extract_features(mbid, data, hdata)
 
     except requests.exceptions.Timeout:
-        print(f"Error: Timeout while fetching AcousticBrainz data for MBID {mbid}")
+        log.warning("Timeout while fetching AcousticBrainz data", mbid=mbid)
         return None
     except requests.exceptions.RequestException as e:
-        print(f"Error: Request failed for AcousticBrainz MBID {mbid}: {e}")
+        log.warning("AcousticBrainz request failed", mbid=mbid, error=str(e))
         return None
     except Exception as e:
-        print(f"Error: Unexpected error processing AcousticBrainz data for MBID {mbid}: {e}")
+        log.exception("Unexpected error processing AcousticBrainz data", mbid=mbid)
         return None
+
+
+def _fetch_bulk(level, mbids, params, deadline=None):
+    """
+    Queries a bulk endpoint ("low-level" or "high-level") for up to
+    BULK_LIMIT MBIDs. Returns {mbid: document} for the recordings it knows.
+    """
+    params = dict(params, recording_ids=";".join(mbids))
+    timeout = deadlines.request_timeout(deadline, REQUEST_TIMEOUT)
+    response = http_client.session.get(f"{API_ROOT}/{level}", params=params, timeout=timeout)
+    response.raise_for_status()
+    data = response.json()
+    # Response shape: {mbid: {"0": document, ...}, "mbid_mapping": {...}}
+    return {
+        mbid.lower(): docs.get("0")
+        for mbid, docs in data.items()
+        if mbid != "mbid_mapping" and isinstance(docs, dict) and docs.get("0") is not None
+    }
+
+
+def _fetch_bulk_safe(level, mbids, params, deadline=None):
+    """
+    _fetch_bulk with a hedged duplicate for slow requests; failures give
+    None. Running out of budget is raised to the caller.
+    """
+    try:
+        return deadlines.hedged(lambda: _fetch_bulk(level, mbids, params, deadline), HEDGE_AFTER, deadline)
+    except deadlines.DeadlineExceeded:
+        raise
+    except requests.exceptions.RequestException as e:
+        if deadline is not None:
+            deadline.check(e)
+        log.warning("AcousticBrainz bulk request failed", endpoint=level, mbids=len(mbids), error=str(e))
+    except (json.JSONDecodeError, ValueError) as e:
+        log.warning("Invalid bulk JSON received from AcousticBrainz", endpoint=level, error=str(e))
+    return None
+
+
+def get_acousticbrainz_data_batch(mbids, max_workers=8, deadline=None):
+    """
+    Takes many MBIDs and fetches their features, from the offline feature
+    store when available and otherwise with the AcousticBrainz bulk
+    endpoints, BULK_LIMIT recordings per request. Low-level requests only ask
+    for the rhythm features we use, and low-level/high-level requests for all
+    chunks run concurrently.
+    Returns {mbid: features}, with None for MBIDs that have no low-level data.
+    MBIDs whose chunk failed to download are left out, so callers can tell
+    them from real misses and retry them. Raises DeadlineExceeded when the
+    deadline passes first.
+    """
+    unique = list(dict.fromkeys(m.lower() for m in mbids if m))
+    if not unique:
+        return {}
+
+    # Recordings in the offline feature store need no network at all
+    results = {}
+    store = feature_store.default_store()
+    if store is not None:
+        for mbid in unique:
+            features = store.get(mbid)
+            if features is not None:
+                results[mbid] = features
+        unique = [mbid for mbid in unique if mbid not in results]
+        telemetry.CACHE_LOOKUPS.inc(len(results), cache="feature_store", result="hit")
+        telemetry.CACHE_LOOKUPS.inc(len(unique), cache="feature_store", result="miss")
+        if not unique:
+            return results
+
+    chunks = [unique[i:i + BULK_LIMIT] for i in range(0, len(unique), BULK_LIMIT)]
+    low_params = {"features": LOWLEVEL_FEATURES}
+    high_params = {} # Raw class codes ("roc", "relaxed"), as extract_features and the single-MBID path expect
+
+    with telemetry.stage("acoustic_fetch"), ThreadPoolExecutor(max_workers=max_workers) as pool:
+        low_futures = [pool.submit(_fetch_bulk_safe, "low-level", chunk, low_params, deadline) for chunk in chunks]
+        high_futures = [pool.submit(_fetch_bulk_safe, "high-level", chunk, high_params, deadline) for chunk in chunks]
+        lowlevel, highlevel = {}, {}
+        failed = set()
+        for chunk, low_future, high_future in zip(chunks, low_futures, high_futures):
+            low, high = low_future.result(), high_future.result()
+            if low is None or high is None:
+                failed.update(chunk)
+                continue
+            lowlevel.update(low)
+            highlevel.update(high)
+
+    for mbid in unique:
+        if mbid in failed:
+            continue
+        data = lowlevel.get(mbid)
+        results[mbid] = extract_features(mbid, data, highlevel.get(mbid)) if data is not None else None
+    return results
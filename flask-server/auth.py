@@ -0,0 +1,44 @@
+import threading
+import time
+import ratelimit
+
+
+class TokenRefresher:
+    """
+    Single-flight Spotify token refresh. Concurrent requests from the same
+    user usually carry the same expired token; only one of them refreshes it
+    and the others receive the same new token. Results are remembered for a
+    short while, so requests that still carry the old refresh token (their
+    session cookie predates the refresh) don't refresh it a second time,
+    which could fail if Spotify rotated the refresh token.
+    """
+
+    def __init__(self, remember_for=60):
+        self.remember_for = remember_for
+        self._coalescer = ratelimit.Coalescer()
+        self._recent = {} # refresh token -> (token_info, expires_at)
+        self._lock = threading.Lock()
+        self.refreshes = 0
+
+    def _remembered(self, refresh_token):
+        with self._lock:
+            now = time.monotonic()
+            for key in [k for k, (_, expires_at) in self._recent.items() if expires_at < now]:
+                del self._recent[key]
+            entry = self._recent.get(refresh_token)
+            return entry[0] if entry else None
+
+    def refresh(self, oauth, refresh_token):
+        """Returns fresh token info for refresh_token, refreshing at most once."""
+        token_info = self._remembered(refresh_token)
+        if token_info:
+            return token_info
+
+        def do_refresh():
+            token_info = oauth.refresh_access_token(refresh_token)
+            with self._lock:
+                self.refreshes += 1
+                self._recent[refresh_token] = (token_info, time.monotonic() + self.remember_for)
+            return token_info
+
+        return self._coalescer.run(refresh_token, do_refresh)
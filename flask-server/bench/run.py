@@ -0,0 +1,395 @@
+"""
+Offline benchmark of the analysis flow (Spotify playlist -> MBIDs ->
+AcousticBrainz features -> stand matching) against the local stand-ins in
+stubs.py. No live service is contacted.
+
+For every playlist size it reports, per stage, wall time, throughput,
+p50/p99 latency per upstream call and peak Python memory, then times the
+whole pipeline.analyze_playlist cold (empty caches), with a warm MBID cache
+and for an unchanged snapshot. Stand matching and the similar-playlists
+index get microbenchmarks of their own. Results are written as JSON to bench/results/ so runs can be compared:
+
+    python bench/run.py --sizes 100 1000 10000
+    python bench/run.py --compare bench/results/baseline.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, SERVER_DIR)
+
+import stubs
+
+CHART_ROWS = (1000, 100000) # Rows per get_jojo_charts microbenchmark
+MICRO_REPEAT = 2000 # Calls per single-playlist matching microbenchmark
+SIMILAR_QUERIES = 1000 # Queries per similar-playlists index size
+
+
+def percentiles(samples):
+    """p50/p99/max of a list of seconds, in milliseconds."""
+    import numpy as np
+    if not samples:
+        return {"calls": 0, "p50_ms": None, "p99_ms": None, "max_ms": None}
+    values = np.asarray(samples) * 1000
+    return {
+        "calls": len(samples),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+
+
+class Timed:
+    """Wraps a function, recording the duration of every call."""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.samples = []
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.fn(*args, **kwargs)
+        finally:
+            self.samples.append(time.perf_counter() - start)
+
+
+def measure(fn, items, trace_memory):
+    """
+    Runs fn() once. Returns its result and the stage report: wall time,
+    items per second and, when tracing, peak traced memory.
+    """
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = fn()
+    finally:
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+    return result, {
+        "items": items,
+        "seconds": round(elapsed, 4),
+        "throughput_per_s": round(items / elapsed, 2) if elapsed else None,
+        "peak_memory_kb": round(peak / 1024, 1) if peak is not None else None,
+    }
+
+
+def fresh_caches(tmp):
+    """Points the MBID cache and the analysis state at new, empty files."""
+    import mbid_cache
+    import musicbrainz
+    import playlist_state
+    run = f"{time.monotonic_ns()}"
+    musicbrainz.cache = mbid_cache.MbidCache(path=os.path.join(tmp, f"mbid-{run}.sqlite3"))
+    return playlist_state.PlaylistStateStore(os.path.join(tmp, f"state-{run}.sqlite3"))
+
+
+def bench_stages(sp, size, tmp, trace_memory):
+    """The four stages of one analysis, run one after another with cold caches."""
+    import acousticbrainz
+    import musicbrainz
+    import pipeline
+    fresh_caches(tmp)
+    playlist_id = f"bench{size}"
+    report = {}
+
+    # Spotify: playlist metadata plus every page of items
+    playlist_items = Timed(sp.playlist_items)
+    sp.playlist_items = playlist_items
+    try:
+        (tracks, duration_ms), report["spotify"] = measure(
+            lambda: pipeline.fetch_playlist_tracks(sp, playlist_id), size, trace_memory)
+    finally:
+        del sp.playlist_items
+    report["spotify"]["latency"] = percentiles(playlist_items.samples)
+
+    # MBIDs: bulk ISRC lookups, then text search for the rest on a thread pool
+    get_mbids_by_isrc = Timed(musicbrainz.get_mbids_by_isrc)
+    get_mbid = Timed(musicbrainz.get_mbid)
+
+    def resolve():
+        musicbrainz.get_mbids_by_isrc, musicbrainz.get_mbid = get_mbids_by_isrc, get_mbid
+        try:
+            by_isrc = pipeline._resolve_isrcs(tracks)
+            rest = [i for i in range(len(tracks)) if i not in by_isrc]
+            with ThreadPoolExecutor(max_workers=pipeline.ANALYZE_CONCURRENCY) as pool:
+                found = dict(zip(rest, pool.map(lambda i: pipeline._resolve_mbid(tracks[i]), rest)))
+            return [m for m in list(by_isrc.values()) + list(found.values()) if m]
+        finally:
+            musicbrainz.get_mbids_by_isrc, musicbrainz.get_mbid = get_mbids_by_isrc.fn, get_mbid.fn
+
+    mbids, report["mbid"] = measure(resolve, len(tracks), trace_memory)
+    report["mbid"]["latency"] = percentiles(get_mbids_by_isrc.samples + get_mbid.samples)
+    report["mbid"]["latency_isrc_batch"] = percentiles(get_mbids_by_isrc.samples)
+    report["mbid"]["latency_text_search"] = percentiles(get_mbid.samples)
+    report["mbid"]["resolved"] = len(mbids)
+
+    # Acoustic features: the bulk endpoints, one batch per BULK_LIMIT MBIDs as the pipeline sends them
+    batch = Timed(acousticbrainz.get_acousticbrainz_data_batch)
+    chunks = [mbids[i:i + acousticbrainz.BULK_LIMIT] for i in range(0, len(mbids), acousticbrainz.BULK_LIMIT)]
+
+    def fetch_features():
+        with ThreadPoolExecutor(max_workers=pipeline.ANALYZE_CONCURRENCY) as pool:
+            features = {}
+            for result in pool.map(batch, chunks):
+                features.update(result)
+            return features
+
+    features, report["acoustic"] = measure(fetch_features, len(mbids), trace_memory)
+    report["acoustic"]["latency"] = percentiles(batch.samples)
+    report["acoustic"]["with_features"] = sum(1 for f in features.values() if f)
+
+    # Chart: aggregation and stand matching
+    def chart():
+        details = [f for f in features.values() if f]
+        metrics = dict(pipeline.aggregate_metrics(details), spotifyTotalDurationMs=duration_ms, potential=3)
+        return pipeline.chart_payload(metrics)
+
+    _, report["chart"] = measure(chart, len(features), trace_memory)
+    return report
+
+
+def bench_end_to_end(sp, size, tmp, trace_memory):
+    """pipeline.analyze_playlist as the server runs it, cold, with a warm MBID cache and unchanged."""
+    import pipeline
+
+    def run(store):
+        events = list(pipeline.analyze_playlist(sp, f"bench{size}", 3, state_store=store))
+        return events[-1]
+
+    report = {}
+    store = fresh_caches(tmp)
+    result, report["cold"] = measure(lambda: run(store), size, trace_memory)
+    report["cold"]["chart_ok"] = result.get("chart") is not None
+
+    import playlist_state
+    warm_store = playlist_state.PlaylistStateStore(os.path.join(tmp, f"state-warm-{size}.sqlite3"))
+    _, report["warm_mbid_cache"] = measure(lambda: run(warm_store), size, trace_memory)
+    _, report["unchanged_snapshot"] = measure(lambda: run(warm_store), size, trace_memory)
+    return report
+
+
+def bench_matching():
+    """Stand matching on its own: single playlists and bulk chart batches."""
+    import numpy as np
+    import jojo
+    import pipeline
+    metrics = {
+        "averageBPM": 121.5, "averageDanceability": 1.3, "uniqueGenreCount": 6,
+        "spotifyTotalDurationMs": 3600000, "averageRelaxedProbability": 0.4, "potential": 3,
+    }
+    jojo.get_nearest_stands(metrics) # Stand table loaded outside the timings
+
+    report = {}
+    for name, fn in (("get_nearest_stands", lambda: jojo.get_nearest_stands(metrics)),
+                     ("get_nearest_stands_k5", lambda: jojo.get_nearest_stands(metrics, k=5)),
+                     ("chart_payload", lambda: pipeline.chart_payload(metrics))):
+        timed = Timed(fn)
+        for _ in range(MICRO_REPEAT):
+            timed()
+        report[name] = percentiles(timed.samples)
+        report[name]["calls_per_s"] = round(len(timed.samples) / sum(timed.samples), 1)
+
+    rng = np.random.default_rng(7)
+    for rows in CHART_ROWS:
+        raw = np.column_stack([
+            rng.uniform(0, 3, rows), rng.uniform(40, 250, rows), rng.uniform(0, 1, rows),
+            rng.integers(1, 7, rows), rng.uniform(4, 10 ** 8, rows), rng.integers(1, 9, rows),
+        ])
+        start = time.perf_counter()
+        jojo.get_jojo_charts(raw)
+        elapsed = time.perf_counter() - start
+        report[f"get_jojo_charts_{rows}"] = {
+            "rows": rows, "seconds": round(elapsed, 4), "rows_per_s": round(rows / elapsed, 1),
+        }
+    return report
+
+
+def bench_similar(entries, tmp):
+    """
+    Similar-playlists index of entries random playlists: bulk insert, first
+    load, query latency and recall of the 10 nearest against an exact scan.
+    """
+    import numpy as np
+    import playlist_index
+    run = f"{time.monotonic_ns()}"
+    index = playlist_index.PlaylistIndex(os.path.join(tmp, f"index-{run}.sqlite3"),
+                                         os.path.join(tmp, f"vectors-{run}.f32"))
+    rng = np.random.default_rng(11)
+    vectors = rng.uniform(0, 100, (entries, playlist_index.DIMENSIONS)).astype(np.float32)
+    queries = rng.uniform(0, 100, (SIMILAR_QUERIES, playlist_index.DIMENSIONS)).astype(np.float32)
+
+    start = time.perf_counter()
+    for first in range(0, entries, 10000):
+        index.add_many((f"p{i}", None, vectors[i], True) for i in range(first, min(entries, first + 10000)))
+    insert_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    index.query(queries[0], 10)
+    load_seconds = time.perf_counter() - start
+
+    timed = Timed(index.query)
+    found = [timed(query, 10) for query in queries]
+    report = percentiles(timed.samples)
+    report["calls_per_s"] = round(len(timed.samples) / sum(timed.samples), 1)
+
+    hits = 0
+    for query, result in zip(queries[:100], found[:100]):
+        exact = np.argsort(((vectors - query) ** 2).sum(axis=1))[:10]
+        hits += len({f"p{i}" for i in exact} & {entry["playlist_id"] for entry in result})
+    report.update(
+        insert={"rows": entries, "seconds": round(insert_seconds, 4), "rows_per_s": round(entries / insert_seconds, 1)},
+        load={"seconds": round(load_seconds, 4)},
+        recall_at_10=round(hits / 1000, 4),
+        cells=index.stats()["cells"],
+    )
+    return report
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SERVER_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(report, prefix=""):
+    """{"a": {"b": 1}} -> {"a.b": 1}, numbers only."""
+    flat = {}
+    for key, value in report.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+# Compared fields; for all of them lower is better except throughputs
+COMPARED = ("seconds", "p50_ms", "p99_ms", "peak_memory_kb", "throughput_per_s", "calls_per_s", "rows_per_s",
+            "import_ms", "rss_kb", "table_load_us", "first_chart_ms", "recall_at_10")
+HIGHER_IS_BETTER = ("throughput_per_s", "calls_per_s", "rows_per_s", "recall_at_10")
+
+
+def compare(baseline, current, threshold):
+    """Prints every compared figure next to the baseline. Returns the regressions."""
+    before, after = flatten(baseline["results"]), flatten(current["results"])
+    regressions = []
+    print(f"\n{'metric':<60} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name in sorted(set(before) & set(after)):
+        field = name.rsplit(".", 1)[-1]
+        if field not in COMPARED or not before[name]:
+            continue
+        change = (after[name] - before[name]) / before[name]
+        worse = -change if field in HIGHER_IS_BETTER else change
+        flag = " !" if worse > threshold else ""
+        if flag:
+            regressions.append(name)
+        print(f"{name:<60} {before[name]:>12g} {after[name]:>12g} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the playlist analysis flow.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="Playlist sizes, in tracks")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Base latency of every stub response")
+    parser.add_argument("--jitter-ms", type=float, default=10.0, help="Random extra latency, up to this much")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of stub responses that are 5xx")
+    parser.add_argument("--mb-latency-ms", type=float, help="MusicBrainz latency, if different")
+    parser.add_argument("--mb-rate", type=float, default=500.0,
+                        help="MusicBrainz requests/second allowed (the live limit of 1 would take hours at 10k)")
+    parser.add_argument("--isrc-share", type=float, default=0.8, help="Share of tracks that have an ISRC")
+    parser.add_argument("--index-sizes", type=int, nargs="*", default=[100000],
+                        help="Entries per similar-playlists index benchmark")
+    parser.add_argument("--skip-end-to-end", action="store_true")
+    parser.add_argument("--no-memory", action="store_true", help="Don't trace memory (tracing slows Python code)")
+    parser.add_argument("--output", default=os.path.join(BENCH_DIR, "results"), help="Directory for the JSON result")
+    parser.add_argument("--compare", help="Baseline result JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Relative change reported as a regression")
+    args = parser.parse_args()
+
+    state = stubs.StubState(stubs.Catalog(isrc_share=args.isrc_share),
+                            args.latency_ms, args.jitter_ms, args.error_rate)
+    if args.mb_latency_ms is not None:
+        state.configure("musicbrainz", latency_ms=args.mb_latency_ms)
+
+    with stubs.StubServers(state) as servers, tempfile.TemporaryDirectory() as tmp:
+        # The app modules read their configuration at import time
+        os.environ.update(servers.env())
+        os.environ.update({
+            "MUSICBRAINZ_RATE": str(args.mb_rate),
+            "MBID_CACHE_PATH": os.path.join(tmp, "mbid.sqlite3"),
+            "ANALYSIS_STATE_PATH": os.path.join(tmp, "state.sqlite3"),
+            "FEATURE_STORE_PATH": os.path.join(tmp, "no-feature-store.bin"),
+            "PLAYLIST_INDEX_PATH": os.path.join(tmp, "playlist-index.sqlite3"),
+            "PLAYLIST_VECTORS_PATH": os.path.join(tmp, "playlist-vectors.f32"),
+            "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+        })
+        os.environ.pop("REDIS_URL", None)
+        from spotipy import Spotify
+        import http_client
+
+        sp = Spotify(auth="bench", requests_session=http_client.session)
+        sp.prefix = servers.env()["SPOTIFY_API_URL"]
+
+        results = {"sizes": {}}
+        for size in args.sizes:
+            print(f"Playlist of {size} tracks: stages", flush=True)
+            entry = {"stages": bench_stages(sp, size, tmp, not args.no_memory)}
+            if not args.skip_end_to_end:
+                print(f"Playlist of {size} tracks: end to end", flush=True)
+                entry["end_to_end"] = bench_end_to_end(sp, size, tmp, not args.no_memory)
+            results["sizes"][str(size)] = entry
+        print("Stand matching microbenchmarks", flush=True)
+        results["matching"] = bench_matching()
+        results["similar"] = {}
+        for entries in args.index_sizes:
+            print(f"Similar-playlists index of {entries} playlists", flush=True)
+            results["similar"][str(entries)] = bench_similar(entries, tmp)
+        results["upstreams"] = http_client.host_stats()
+        results["stub_requests"] = {"requests": state.requests, "errors": state.errors}
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git_revision": git_revision(),
+            "python": sys.version.split()[0],
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"bench-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for size, entry in results["sizes"].items():
+        for stage, stage_report in entry["stages"].items():
+            latency = stage_report.get("latency", {})
+            print(f"{size:>6} {stage:<10} {stage_report['seconds']:>9.3f}s {stage_report['throughput_per_s'] or 0:>10.1f}/s"
+                  f"  p50 {latency.get('p50_ms') or 0:>8.2f}ms  p99 {latency.get('p99_ms') or 0:>8.2f}ms"
+                  f"  peak {stage_report['peak_memory_kb'] or 0:>9.0f}KB")
+    print(f"Results written to {path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} figure(s) regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Cold-start benchmark: how long a fresh worker takes to import the app, how
+much memory it holds afterwards and what it costs to load the stand table
+and serve the first chart. Each run is a new interpreter.
+
+    python bench/startup.py --runs 5
+    python bench/startup.py --max-import-ms 400 --max-rss-mb 60   # fail above these
+
+Heavy modules that should stay off the start-up path (pandas, numpy,
+spotipy, redis by default) are reported, and loading any of them fails the
+run. Results are written to bench/results/ and can be compared like run.py's.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+
+import run
+
+HEAVY_MODULES = ("pandas", "numpy", "spotipy", "redis")
+
+# Runs in a fresh interpreter inside SERVER_DIR; prints one JSON line
+PROBE = r"""
+import json, os, sys, time
+start = time.perf_counter()
+import server
+import_seconds = time.perf_counter() - start
+
+def rss_kb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+rss_after_import = rss_kb()
+loaded = [m for m in HEAVY if m in sys.modules]
+
+import jojo, stand_table
+start = time.perf_counter()
+jojo.load_stand_table()
+table_seconds = time.perf_counter() - start
+start = time.perf_counter()
+with open(stand_table.DEFAULT_CSV_PATH, "rb") as f:
+    stand_table.compile_csv(f.read())
+csv_seconds = time.perf_counter() - start
+
+metrics = {"averageBPM": 121.5, "averageDanceability": 1.3, "uniqueGenreCount": 6,
+           "spotifyTotalDurationMs": 3600000, "averageRelaxedProbability": 0.4, "potential": 3}
+client = server.app.test_client()
+start = time.perf_counter()
+response = client.get("/get_chart", query_string={"data": json.dumps(metrics)})
+first_chart_seconds = time.perf_counter() - start
+assert response.status_code == 200, response.data
+
+print(json.dumps({
+    "import_ms": import_seconds * 1000,
+    "rss_kb": rss_after_import,
+    "rss_after_chart_kb": rss_kb(),
+    "table_load_us": table_seconds * 1e6,
+    "csv_compile_us": csv_seconds * 1e6,
+    "first_chart_ms": first_chart_seconds * 1000,
+    "heavy_modules": loaded,
+    "heavy_modules_after_chart": [m for m in HEAVY if m in sys.modules],
+}))
+"""
+
+
+def probe(env):
+    script = f"HEAVY = {HEAVY_MODULES!r}\n" + PROBE
+    output = subprocess.run([sys.executable, "-c", script], cwd=SERVER_DIR, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure worker cold start: import time, RSS, stand table load.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float, help="Fail when the median import time exceeds this")
+    parser.add_argument("--max-rss-mb", type=float, help="Fail when the median RSS after import exceeds this")
+    parser.add_argument("--allow", nargs="*", default=[], choices=HEAVY_MODULES,
+                        help="Heavy modules allowed at start-up")
+    parser.add_argument("--output", default=os.path.join(BENCH_DIR, "results"), help="Directory for the JSON result")
+    parser.add_argument("--compare", help="Baseline result JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Relative change reported as a regression")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ,
+                   SPOTIPY_CLIENT_ID=os.getenv("SPOTIPY_CLIENT_ID", "bench"),
+                   SPOTIPY_CLIENT_SECRET=os.getenv("SPOTIPY_CLIENT_SECRET", "bench"),
+                   MBID_CACHE_PATH=os.path.join(tmp, "mbid.sqlite3"),
+                   ANALYSIS_STATE_PATH=os.path.join(tmp, "state.sqlite3"),
+                   JOBS_DB_PATH=os.path.join(tmp, "jobs.sqlite3"),
+                   PLAYLIST_INDEX_PATH=os.path.join(tmp, "playlist-index.sqlite3"),
+                   PLAYLIST_VECTORS_PATH=os.path.join(tmp, "playlist-vectors.f32"),
+                   LOG_LEVEL="ERROR")
+        env.pop("REDIS_URL", None)
+        runs = [probe(env) for _ in range(args.runs)]
+
+    results = {key: round(statistics.median(run_[key] for run_ in runs), 3)
+               for key in runs[0] if not key.startswith("heavy_modules")}
+    results["heavy_modules"] = sorted({m for run_ in runs for m in run_["heavy_modules"]})
+    results["heavy_modules_after_chart"] = sorted({m for run_ in runs for m in run_["heavy_modules_after_chart"]})
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git_revision": run.git_revision(),
+            "python": sys.version.split()[0],
+            "args": vars(args),
+        },
+        "results": {"startup": results},
+    }
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"startup-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"import {results['import_ms']:.1f}ms  RSS {results['rss_kb'] / 1024:.1f}MB"
+          f"  stand table {results['table_load_us']:.0f}us (CSV compile {results['csv_compile_us']:.0f}us)"
+          f"  first chart {results['first_chart_ms']:.2f}ms")
+    print(f"heavy modules at start-up: {', '.join(results['heavy_modules']) or 'none'};"
+          f" after the first chart: {', '.join(results['heavy_modules_after_chart']) or 'none'}")
+    print(f"Results written to {path}")
+
+    failures = [f"{module} is imported at start-up" for module in results["heavy_modules"] if module not in args.allow]
+    if args.max_import_ms is not None and results["import_ms"] > args.max_import_ms:
+        failures.append(f"import took {results['import_ms']:.1f}ms (limit {args.max_import_ms}ms)")
+    if args.max_rss_mb is not None and results["rss_kb"] / 1024 > args.max_rss_mb:
+        failures.append(f"RSS is {results['rss_kb'] / 1024:.1f}MB (limit {args.max_rss_mb}MB)")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = run.compare(json.load(f), report, args.threshold)
+        failures += [f"{name} regressed by more than {args.threshold:.0%}" for name in regressions]
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+"""
+Local stand-ins for the Spotify Web API, the MusicBrainz recording search and
+the AcousticBrainz API, for benchmarking without live services.
+
+Responses are built from the recorded documents in fixtures/, with ids and
+feature values filled in from a deterministic synthetic catalog: track i of
+a playlist is the same song, with the same ISRC, MBID and features, on every
+run. Each service has its own latency (base + random jitter) and error rate.
+
+Run standalone to point a development server at them:
+    python bench/stubs.py --latency-ms 50 --error-rate 0.01
+"""
+import argparse
+import copy
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+GENRES = ["cla", "dan", "hip", "jaz", "pop", "rhy", "roc", "spe"]
+MBID_NAMESPACE = uuid.UUID("6f0d3c1e-4b55-4a5e-9d0e-62b1a1f8e9c4")
+
+
+def _fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return json.load(f)
+
+
+class Catalog:
+    """
+    The synthetic music catalog. Track i has an ISRC when i falls in the
+    isrc_share, is unknown to MusicBrainz for mb_miss_share of tracks and
+    has no AcousticBrainz data for ab_miss_share of the known ones.
+    """
+
+    def __init__(self, isrc_share=0.8, mb_miss_share=0.03, ab_miss_share=0.05, seed=7):
+        self.isrc_share = isrc_share
+        self.mb_miss_share = mb_miss_share
+        self.ab_miss_share = ab_miss_share
+        self.seed = seed
+
+    def _draw(self, i, salt):
+        return random.Random(f"{self.seed}:{salt}:{i}").random()
+
+    def name(self, i):
+        return f"Bench Song {i}"
+
+    def artist(self, i):
+        return f"Bench Artist {i % 997}"
+
+    def album(self, i):
+        return f"Bench Album {i % 1999}"
+
+    def isrc(self, i):
+        return f"QZBEN{i:07d}" if self._draw(i, "isrc") < self.isrc_share else None
+
+    def mbid(self, i):
+        if self._draw(i, "mb") < self.mb_miss_share:
+            return None
+        return str(uuid.uuid5(MBID_NAMESPACE, str(i)))
+
+    def has_features(self, i):
+        return self._draw(i, "ab") >= self.ab_miss_share
+
+    def features(self, i):
+        rng = random.Random(f"{self.seed}:features:{i}")
+        return {
+            "bpm": rng.uniform(60, 190),
+            "danceability": rng.uniform(0.5, 2.5),
+            "genre": rng.choice(GENRES),
+            "relaxed": rng.random(),
+        }
+
+
+class StubState:
+    """Catalog, fixtures and per-service behaviour shared by all handlers."""
+
+    def __init__(self, catalog, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, seed=7):
+        self.catalog = catalog
+        # service -> (latency seconds, jitter seconds, error rate)
+        self.behaviour = {service: (latency_ms / 1000, jitter_ms / 1000, error_rate)
+                          for service in ("spotify", "musicbrainz", "acousticbrainz")}
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.requests = {service: 0 for service in self.behaviour}
+        self.errors = {service: 0 for service in self.behaviour}
+        self.track_template = _fixture("spotify_playlist_item.json")
+        self.recording_template = _fixture("musicbrainz_recording.json")
+        self.lowlevel_template = _fixture("acousticbrainz_lowlevel.json")
+        self.highlevel_template = _fixture("acousticbrainz_highlevel.json")
+        self.mbid_index = {}
+        self.mbid_lock = threading.Lock()
+
+    def configure(self, service, latency_ms=None, jitter_ms=None, error_rate=None):
+        latency, jitter, errors = self.behaviour[service]
+        self.behaviour[service] = (
+            latency if latency_ms is None else latency_ms / 1000,
+            jitter if jitter_ms is None else jitter_ms / 1000,
+            errors if error_rate is None else error_rate,
+        )
+
+    def delay_and_fail(self, service):
+        """Sleeps the configured latency. Returns True when this call should fail."""
+        latency, jitter, error_rate = self.behaviour[service]
+        with self.rng_lock:
+            self.requests[service] += 1
+            pause = latency + self.rng.uniform(0, jitter)
+            fail = self.rng.random() < error_rate
+            if fail:
+                self.errors[service] += 1
+        if pause > 0:
+            time.sleep(pause)
+        return fail
+
+    def track_of_mbid(self, mbid):
+        with self.mbid_lock:
+            return self.mbid_index.get(mbid.lower())
+
+    def remember_mbid(self, i):
+        mbid = self.catalog.mbid(i)
+        if mbid:
+            with self.mbid_lock:
+                self.mbid_index[mbid] = i
+        return mbid
+
+    # --- Response builders ---
+    def playlist_item(self, i):
+        item = copy.deepcopy(self.track_template)
+        track = item["track"]
+        track["id"] = f"benchtrack{i:010d}"
+        track["name"] = self.catalog.name(i)
+        track["duration_ms"] = 150000 + (i * 7919) % 150000
+        track["artists"][0]["name"] = self.catalog.artist(i)
+        track["album"]["name"] = self.catalog.album(i)
+        isrc = self.catalog.isrc(i)
+        track["external_ids"] = {"isrc": isrc} if isrc else {}
+        return item
+
+    def recording(self, i):
+        recording = copy.deepcopy(self.recording_template)
+        recording["id"] = self.remember_mbid(i)
+        recording["title"] = self.catalog.name(i)
+        recording["artist-credit"][0]["name"] = self.catalog.artist(i)
+        recording["releases"][0]["title"] = self.catalog.album(i)
+        isrc = self.catalog.isrc(i)
+        recording["isrcs"] = [isrc] if isrc else []
+        return recording
+
+    def lowlevel(self, i):
+        doc = copy.deepcopy(self.lowlevel_template)
+        features = self.catalog.features(i)
+        doc["rhythm"] = {"bpm": features["bpm"], "danceability": features["danceability"]}
+        return doc
+
+    def highlevel(self, i):
+        doc = copy.deepcopy(self.highlevel_template)
+        features = self.catalog.features(i)
+        doc["highlevel"]["genre_rosamerica"]["value"] = features["genre"]
+        doc["highlevel"]["mood_relaxed"]["all"] = {"relaxed": features["relaxed"], "not_relaxed": 1 - features["relaxed"]}
+        return doc
+
+
+PLAYLIST_PATH = re.compile(r"^/v1/playlists/bench(\d+)(/tracks|/items)?$")
+SONG_QUERY = re.compile(r'recording:"Bench Song (\d+)"')
+ISRC_QUERY = re.compile(r"isrc:QZBEN(\d{7})")
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # Keep-alive, like the real services
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if url.path.startswith("/v1/playlists/"):
+                self._spotify(url.path, query)
+            elif url.path.startswith("/ws/2/recording"):
+                self._musicbrainz(query)
+            elif url.path.startswith("/api/v1/"):
+                self._acousticbrainz(url.path, query)
+            else:
+                self._send(404, {"error": "Unknown stub endpoint"})
+
+        def _spotify(self, path, query):
+            if state.delay_and_fail("spotify"):
+                return self._send(500, {"error": {"status": 500, "message": "Stub failure"}})
+            match = PLAYLIST_PATH.match(path)
+            if not match:
+                return self._send(404, {"error": {"status": 404, "message": "Not found"}})
+            size = int(match.group(1))
+            if not match.group(2):
+                return self._send(200, {"name": f"Bench playlist ({size} tracks)", "snapshot_id": f"bench-{size}"})
+            limit = min(int(query.get("limit", 100)), 100)
+            offset = int(query.get("offset", 0))
+            items = [state.playlist_item(i) for i in range(offset, min(offset + limit, size))]
+            more = offset + limit < size
+            self._send(200, {"items": items, "total": size, "limit": limit, "offset": offset,
+                             "next": f"{path}?offset={offset + limit}&limit={limit}" if more else None})
+
+        def _musicbrainz(self, query):
+            if state.delay_and_fail("musicbrainz"):
+                return self._send(503, {"error": "Your requests are exceeding the allowable rate limit."})
+            text = query.get("query", "")
+            limit = int(query.get("limit", 25))
+            offset = int(query.get("offset", 0))
+            isrc_matches = ISRC_QUERY.findall(text)
+            if isrc_matches:
+                tracks = [int(i) for i in isrc_matches]
+                tracks = [i for i in tracks if state.catalog.isrc(i) and state.catalog.mbid(i)]
+            else:
+                song = SONG_QUERY.search(text)
+                tracks = [int(song.group(1))] if song and state.catalog.mbid(int(song.group(1))) else []
+            page = tracks[offset:offset + limit]
+            self._send(200, {"created": "2024-01-01T00:00:00.000Z", "count": len(tracks), "offset": offset,
+                             "recordings": [state.recording(i) for i in page]})
+
+        def _acousticbrainz(self, path, query):
+            if state.delay_and_fail("acousticbrainz"):
+                return self._send(500, {"message": "Stub failure"})
+            parts = path.strip("/").split("/") # api, v1, <mbid>?, level
+            level = parts[-1]
+            if level not in ("low-level", "high-level"):
+                return self._send(404, {"message": "Not found"})
+            build = state.lowlevel if level == "low-level" else state.highlevel
+            if len(parts) == 4: # Single recording: /api/v1/<mbid>/<level>
+                i = state.track_of_mbid(parts[2])
+                if i is None or not state.catalog.has_features(i):
+                    return self._send(404, {"message": "Not found"})
+                return self._send(200, build(i))
+            result = {"mbid_mapping": {}}
+            for mbid in query.get("recording_ids", "").split(";"):
+                i = state.track_of_mbid(mbid.split(":")[0])
+                if i is not None and state.catalog.has_features(i):
+                    result[mbid] = {"0": build(i)}
+            self._send(200, result)
+
+    return Handler
+
+
+class StubServers:
+    """One threaded HTTP server on localhost serving all three services."""
+
+    def __init__(self, state, port=0):
+        self.state = state
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def env(self):
+        """Environment variables pointing the app's clients at the stubs."""
+        return {
+            "MUSICBRAINZ_URL": f"{self.base}/ws/2/recording/",
+            "ACOUSTICBRAINZ_API_ROOT": f"{self.base}/api/v1",
+            "SPOTIFY_API_URL": f"{self.base}/v1/",
+        }
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve Spotify/MusicBrainz/AcousticBrainz stand-ins.")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--isrc-share", type=float, default=0.8)
+    args = parser.parse_args()
+
+    state = StubState(Catalog(isrc_share=args.isrc_share), args.latency_ms, args.jitter_ms, args.error_rate)
+    with StubServers(state, args.port) as stubs:
+        for key, value in stubs.env().items():
+            print(f"export {key}={value}")
+        print("Playlists: bench<N> has N tracks, e.g. playlist_id=bench1000. Ctrl-C to stop.")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
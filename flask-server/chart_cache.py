@@ -0,0 +1,76 @@
+"""
+Memoized /get_chart responses.
+
+A chart is a pure function of the six playlist metrics (and k), so its
+JSON body is computed once per distinct input and kept in a bounded LRU.
+Inputs are canonicalized to their normalized chart stats, so e.g. 3 and
+3.0 share an entry; with CHART_CACHE_DECIMALS set, stats are also rounded
+to that many decimals (the chart displays 2), so near-identical playlists
+share one entry, computed from the first of them.
+Every entry has an ETag derived from the key and the stand table, so
+clients and CDNs can revalidate without the chart being recomputed.
+"""
+import hashlib
+import json
+import os
+from functools import lru_cache
+import jojo
+import lru
+import pipeline
+import telemetry
+
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", 4096)) # Distinct charts kept in memory
+_decimals = os.getenv("CHART_CACHE_DECIMALS") # Unset: exact keys
+CHART_CACHE_DECIMALS = int(_decimals) if _decimals else None
+CHART_MAX_AGE = int(os.getenv("CHART_MAX_AGE", 86400)) # Seconds browsers and CDNs may reuse a chart
+
+_charts = lru.LRUCache("chart", CHART_CACHE_SIZE) # chart key -> JSON body
+
+
+@lru_cache(maxsize=1)
+def stand_table_version():
+    """Short digest of the stand table: charts from another table get other ETags."""
+    names, columns, rows = jojo.load_stand_table()
+    return hashlib.sha1(repr((names, columns, rows)).encode()).hexdigest()[:12]
+
+
+def chart_key(metrics, k=None):
+    """
+    Canonical key of a chart request: the normalized stats, rounded to
+    CHART_CACHE_DECIMALS when set, and k. Raises KeyError for missing metrics.
+    """
+    stats = jojo.normalize_metrics(metrics)
+    if CHART_CACHE_DECIMALS is not None:
+        stats = [round(stat, CHART_CACHE_DECIMALS) + 0.0 for stat in stats] # + 0.0 turns -0.0 into 0.0
+    return tuple(stats) + (k or None,)
+
+
+def etag(key):
+    """Entity tag (unquoted) of the chart for a key."""
+    return hashlib.sha1(f"{stand_table_version()}:{key!r}".encode()).hexdigest()[:20]
+
+
+def get_chart(metrics, k=None, key=None):
+    """
+    The chart for metrics as a JSON body, computed by pipeline.chart_payload
+    on the first request for its key (chart_key(metrics, k) by default) only.
+    """
+    key = key or chart_key(metrics, k)
+    body = _charts.get(key)
+    if body is None:
+        body = json.dumps(pipeline.chart_payload(metrics, k=k), separators=(",", ":"))
+        _charts.put(key, body)
+    return body
+
+
+def stats():
+    hits = telemetry.CACHE_LOOKUPS.value(cache="chart", result="hit")
+    misses = telemetry.CACHE_LOOKUPS.value(cache="chart", result="miss")
+    return {
+        "entries": len(_charts),
+        "max_entries": CHART_CACHE_SIZE,
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else None,
+        "evictions": telemetry.CACHE_EVICTIONS.value(cache="chart"),
+    }
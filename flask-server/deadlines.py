@@ -0,0 +1,91 @@
+import math
+import threading
+import time
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+import requests
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """The analysis ran out of its time budget before the call could finish."""
+
+
+class Deadline:
+    """A point in time by which an analysis, and every upstream call it makes, must finish."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self, error):
+        """
+        Re-raises a failed call's error as DeadlineExceeded when the budget
+        is spent: a request cut short by the deadline didn't really fail.
+        """
+        if self.expired():
+            raise DeadlineExceeded(f"Time budget of {self.seconds}s exhausted") from error
+
+    def timeout(self, cap):
+        """A request timeout of at most cap seconds that ends with the budget."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Time budget of {self.seconds}s exhausted")
+        return min(cap, remaining)
+
+
+def request_timeout(deadline, cap):
+    """cap, shortened to the remaining budget when there is a deadline."""
+    return cap if deadline is None else deadline.timeout(cap)
+
+
+def hedged(fn, hedge_after, deadline=None, attempts=2):
+    """
+    Runs fn and, if it hasn't answered within hedge_after seconds (or has
+    failed), starts another copy, up to attempts in total. The first
+    successful result wins; slower copies are abandoned and end with their
+    own request timeouts. Raises the last error when every copy fails and
+    DeadlineExceeded when the budget runs out first.
+    Only for idempotent calls to upstreams without a strict rate limit.
+    """
+    running = []
+    started = 0
+    error = None
+
+    def start():
+        nonlocal started
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, daemon=True).start()
+        running.append(future)
+        started += 1
+
+    start()
+    while True:
+        timeout = hedge_after if started < attempts else math.inf
+        if deadline is not None:
+            if deadline.expired():
+                raise DeadlineExceeded(f"Time budget of {deadline.seconds}s exhausted")
+            timeout = min(timeout, deadline.remaining())
+        done, _ = wait(running, timeout=None if timeout == math.inf else timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            running.remove(future)
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+        if started < attempts and (not done or not running):
+            start() # Slow or failed: hedge with another copy
+        elif not running:
+            if deadline is not None:
+                deadline.check(error)
+            raise error
@@ -0,0 +1,124 @@
+import mmap
+import os
+import struct
+import threading
+import uuid
+from bisect import bisect_left
+
+DEFAULT_STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "acousticbrainz-features.bin")
+
+# Rosamerica genre classes, stored as their index (-1 when unknown)
+GENRES = ["cla", "dan", "hip", "jaz", "pop", "rhy", "roc", "spe"]
+
+# File layout: header, then fixed-size records sorted by MBID bytes.
+#   header: magic, version, record count
+#   record: MBID (16 raw bytes), bpm, danceability, relaxed probability
+#           (float32, NaN when missing), genre index (int8), padding
+MAGIC = b"ABFS"
+VERSION = 1
+HEADER = struct.Struct("<4sIQ")
+RECORD = struct.Struct("<16sfffb3x")
+
+
+def pack_record(mbid, bpm, danceability, relaxed, genre):
+    """Encodes one recording's features. genre is a Rosamerica label or None."""
+    nan = float("nan")
+    return RECORD.pack(
+        uuid.UUID(mbid).bytes,
+        nan if bpm is None else bpm,
+        nan if danceability is None else danceability,
+        nan if relaxed is None else relaxed,
+        GENRES.index(genre) if genre in GENRES else -1,
+    )
+
+
+def write_store(path, records):
+    """
+    Writes packed records (any order) to path, sorted by MBID. The file is
+    written next to path and renamed into place so readers never see a
+    partial store.
+    """
+    records = sorted(records)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(records)))
+        for record in records:
+            f.write(record)
+    os.replace(tmp_path, path)
+    return len(records)
+
+
+class _Keys:
+    """Read-only sequence view over the MBID column, for bisect."""
+
+    def __init__(self, buf, count):
+        self._buf = buf
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        offset = HEADER.size + i * RECORD.size
+        return self._buf[offset:offset + 16]
+
+
+class FeatureStore:
+    """
+    Memory-mapped lookup of AcousticBrainz features by MBID, built offline
+    by ingest_acousticbrainz.py. Pages are shared by every worker through
+    the OS page cache and a lookup is a binary search over the sorted file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not an AcousticBrainz feature store (version {VERSION})")
+        if len(self._mmap) < HEADER.size + count * RECORD.size:
+            raise ValueError(f"{path} is truncated")
+        self._keys = _Keys(self._mmap, count)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, mbid):
+        """
+        Features for an MBID in the same shape as get_acousticbrainz_data,
+        or None when the recording isn't in the store.
+        """
+        try:
+            key = uuid.UUID(mbid).bytes
+        except (ValueError, TypeError, AttributeError):
+            return None
+        i = bisect_left(self._keys, key)
+        if i == len(self._keys) or self._keys[i] != key:
+            return None
+
+        _, bpm, danceability, relaxed, genre = RECORD.unpack_from(self._mmap, HEADER.size + i * RECORD.size)
+        return {
+            "bpm": None if bpm != bpm else bpm, # NaN marks a missing value
+            "danceability": None if danceability != danceability else danceability,
+            "genre": GENRES[genre] if genre >= 0 else "Unknown",
+            "relaxedProbability": None if relaxed != relaxed else relaxed,
+        }
+
+
+_default_store = None
+_default_lock = threading.Lock()
+
+
+def default_store():
+    """
+    The store at FEATURE_STORE_PATH, opened on first use. Returns None when
+    no store has been built, in which case callers use the live API.
+    """
+    global _default_store
+    if _default_store is None:
+        with _default_lock:
+            if _default_store is None:
+                path = os.getenv("FEATURE_STORE_PATH", DEFAULT_STORE_PATH)
+                _default_store = FeatureStore(path) if os.path.exists(path) else False
+    return _default_store or None
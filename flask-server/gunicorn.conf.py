@@ -0,0 +1,14 @@
+import os
+
+# Usage: gunicorn -c gunicorn.conf.py server:app
+# OAuth state is per request (see server.get_oauth), so one worker process can
+# serve many concurrent I/O-bound requests. Pick the concurrency mode with
+# GUNICORN_WORKER_CLASS: "gthread" (threads, default), "gevent" (greenlets;
+# gevent is in requirements.txt) or "sync" (one request per process).
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+threads = int(os.getenv("GUNICORN_THREADS", 32))                          # gthread only
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", 500))   # gevent only
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+# /analyze_playlist streams for as long as the analysis runs
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 300))
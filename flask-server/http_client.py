@@ -0,0 +1,218 @@
+"""
+Shared outbound HTTP layer for MusicBrainz, AcousticBrainz and Spotify.
+
+One requests.Session holds a keep-alive connection pool per host, so calls
+reuse connections instead of paying a TCP and TLS handshake each time.
+Transient failures are retried a bounded number of times with jittered
+backoff. A per-host circuit breaker fails fast while an upstream is down,
+and every host gets call counts and a latency histogram (see host_stats()
+and /metrics).
+"""
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import telemetry
+
+POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 20)) # Keep-alive connections per host
+POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", 10)) # Hosts with a pool of their own
+RETRIES = int(os.getenv("HTTP_RETRIES", 2)) # Retries of connection errors and 5xx responses
+BACKOFF = float(os.getenv("HTTP_BACKOFF", 0.3)) # Seconds, doubled per retry
+BREAKER_FAILURES = int(os.getenv("HTTP_BREAKER_FAILURES", 5)) # Consecutive failures that open a circuit
+BREAKER_RESET = float(os.getenv("HTTP_BREAKER_RESET", 30)) # Seconds an open circuit fails fast
+# Timeouts shorter than this (e.g. cut short by an analysis deadline) don't count against a host
+BREAKER_MIN_TIMEOUT = float(os.getenv("HTTP_BREAKER_MIN_TIMEOUT", 2))
+
+# 429/503 from MusicBrainz are rate-limit signals handled by ratelimit.RateLimitedScheduler
+RETRY_STATUSES = (500, 502, 504)
+SCHEDULED_RETRY_STATUSES = () # Upstreams behind a scheduler: every status retry must take a rate-limit slot
+SPOTIFY_RETRY_STATUSES = (429, 500, 502, 503, 504) # What spotipy retries on its own sessions
+THROTTLE_STATUSES = (429, 503) # Rate limiting (MusicBrainz answers 503): the host is up, it isn't failing
+
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    """Raised without a request while a host's circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Opens after `failures` consecutive failures and rejects calls for
+    reset_after seconds. Then one trial call is let through (half-open):
+    success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, failures=BREAKER_FAILURES, reset_after=BREAKER_RESET):
+        self.failures = failures
+        self.reset_after = reset_after
+        self._consecutive = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half-open" if time.monotonic() - self._opened_at >= self.reset_after else "open"
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_after or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self._consecutive = 0
+            self._opened_at = None
+            self._trial = False
+
+    def release(self):
+        """Ends a trial call without a verdict (e.g. it was throttled): the next call is the trial."""
+        with self._lock:
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self._trial or self._consecutive >= self.failures:
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+
+UPSTREAM_REQUESTS = telemetry.counter("upstream_requests_total",
+                                    "Outbound calls by host and outcome (ok, error, timeout, throttled, rejected)")
+UPSTREAM_SECONDS = telemetry.histogram("upstream_request_seconds", "Outbound call latency by host, retries included")
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def _breaker(host):
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker()
+        return breaker
+
+
+def _counts_as_failure(timeout):
+    """Whether a timed-out request says something about the host's health."""
+    if isinstance(timeout, tuple):
+        timeout = timeout[-1]
+    return timeout is None or timeout >= BREAKER_MIN_TIMEOUT
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    """Pooled adapter that times every request and guards it with the host's circuit breaker."""
+
+    def send(self, request, **kwargs):
+        host = urlsplit(request.url).hostname
+        breaker = _breaker(host)
+        if not breaker.allow():
+            UPSTREAM_REQUESTS.inc(host=host, outcome="rejected")
+            raise CircuitOpen(f"Circuit open for {host}: failing fast", request=request)
+
+        start = time.perf_counter()
+        try:
+            response = super().send(request, **kwargs)
+        except requests.exceptions.Timeout:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - start, host=host)
+            UPSTREAM_REQUESTS.inc(host=host, outcome="timeout")
+            if _counts_as_failure(kwargs.get("timeout")):
+                breaker.failure()
+            else:
+                breaker.release()
+            raise
+        except requests.exceptions.RequestException:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - start, host=host)
+            UPSTREAM_REQUESTS.inc(host=host, outcome="error")
+            breaker.failure()
+            raise
+
+        UPSTREAM_SECONDS.observe(time.perf_counter() - start, host=host)
+        if response.status_code in THROTTLE_STATUSES:
+            UPSTREAM_REQUESTS.inc(host=host, outcome="throttled")
+            breaker.release() # Neither a failure nor a success
+        elif response.status_code >= 500:
+            UPSTREAM_REQUESTS.inc(host=host, outcome="error")
+            breaker.failure()
+        else:
+            UPSTREAM_REQUESTS.inc(host=host, outcome="ok")
+            breaker.success()
+        return response
+
+
+def _adapter(retry_statuses):
+    retry = Retry(
+        total=RETRIES,
+        connect=RETRIES,
+        read=0, # A read timeout already used up the caller's time
+        status=RETRIES,
+        status_forcelist=retry_statuses,
+        backoff_factor=BACKOFF,
+        backoff_jitter=BACKOFF,
+        # Also makes urllib3 retry 429/503 that carry Retry-After
+        respect_retry_after_header=bool(retry_statuses),
+        raise_on_status=False, # Callers check the final status themselves
+    )
+    return InstrumentedAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE, max_retries=retry)
+
+
+def make_session():
+    session = requests.Session()
+    adapter = _adapter(RETRY_STATUSES)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # Spotify has no scheduler of its own in front of it: retry its rate limits here
+    spotify = _adapter(SPOTIFY_RETRY_STATUSES)
+    session.mount("https://api.spotify.com/", spotify)
+    session.mount("https://accounts.spotify.com/", spotify)
+    return session
+
+
+session = make_session()
+
+
+def mount_scheduled(prefix):
+    """
+    Gives requests under prefix (an upstream behind ratelimit.RateLimitedScheduler)
+    an adapter that only retries connection errors: a status retry inside
+    session.get would skip the scheduler's rate limit, so the scheduler
+    retries those itself.
+    """
+    session.mount(prefix, _adapter(SCHEDULED_RETRY_STATUSES))
+
+
+def host_stats():
+    """Per-host call counts by outcome, error rate, circuit state and latency histogram."""
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    stats = {}
+    for host, breaker in breakers.items():
+        outcomes = {outcome: UPSTREAM_REQUESTS.value(host=host, outcome=outcome)
+                    for outcome in ("ok", "error", "timeout", "throttled", "rejected")}
+        attempted = outcomes["ok"] + outcomes["error"] + outcomes["timeout"] + outcomes["throttled"]
+        stats[host] = dict(
+            outcomes,
+            error_rate=(outcomes["error"] + outcomes["timeout"]) / attempted if attempted else None,
+            circuit=breaker.state,
+            latency_seconds=UPSTREAM_SECONDS.snapshot(host=host),
+        )
+    return stats
+
+
+@telemetry.register_collector
+def _collect():
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    states = {"closed": 0, "half-open": 1, "open": 2}
+    return [("upstream_circuit_state", "gauge", "Circuit breaker state per host (0 closed, 1 half-open, 2 open)",
+             [({"host": host}, states[breaker.state]) for host, breaker in breakers.items()])]
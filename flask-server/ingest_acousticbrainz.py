@@ -0,0 +1,106 @@
+"""
+Builds the offline AcousticBrainz feature store (see feature_store.py) from
+the AcousticBrainz JSON data dumps.
+
+Usage:
+    python ingest_acousticbrainz.py --lowlevel LOW [LOW ...] --highlevel HIGH [HIGH ...] [--output PATH]
+
+Each input is a dump archive (.tar, .tar.gz, .tar.bz2, .tar.xz), a directory
+of extracted JSON files, or "-" to read a tar stream from stdin. The official
+dumps are zstd-compressed; stream them through zstd:
+    zstd -dc acousticbrainz-lowlevel-json-*.tar.zst | python ingest_acousticbrainz.py --lowlevel - ...
+
+Only the fields the app uses are kept: rhythm.bpm and rhythm.danceability
+from low-level documents, genre_rosamerica and mood_relaxed from high-level
+ones. Like the live API, only the first submission (offset 0) of each
+recording is used.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import tarfile
+import feature_store
+
+FILENAME = re.compile(r"([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})-0\.json$")
+
+
+def iter_documents(source):
+    """Yields (mbid, document) for every offset-0 JSON document in a dump."""
+    if source != "-" and os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            for name in files:
+                match = FILENAME.search(name)
+                if match:
+                    with open(os.path.join(root, name), "rb") as f:
+                        yield match.group(1), json.load(f)
+        return
+
+    if source.endswith(".zst"):
+        raise SystemExit(f"{source}: decompress zstd dumps first, e.g. zstd -dc {source} | python {sys.argv[0]} ... -")
+
+    # Stream mode ("r|*") reads members sequentially without seeking
+    archive = tarfile.open(fileobj=sys.stdin.buffer, mode="r|*") if source == "-" else tarfile.open(source, mode="r|*")
+    with archive:
+        for member in archive:
+            match = FILENAME.search(member.name)
+            if not member.isfile() or not match:
+                continue
+            f = archive.extractfile(member)
+            if f is not None:
+                yield match.group(1), json.load(f)
+
+
+def _number(value):
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+
+def ingest(lowlevel_sources, highlevel_sources):
+    """
+    Collects the used features from both dump kinds.
+    Returns {mbid: [bpm, danceability, relaxed, genre]} for recordings that
+    have low-level data.
+    """
+    features = {}
+    for source in lowlevel_sources:
+        for n, (mbid, doc) in enumerate(iter_documents(source), 1):
+            rhythm = doc.get("rhythm", {})
+            features[mbid] = [_number(rhythm.get("bpm")), _number(rhythm.get("danceability")), None, None]
+            if n % 100000 == 0:
+                print(f"{source}: {n} low-level documents", file=sys.stderr)
+
+    for source in highlevel_sources:
+        for n, (mbid, doc) in enumerate(iter_documents(source), 1):
+            entry = features.get(mbid)
+            if entry is None:
+                continue # The API requires low-level data; skip orphans
+            highlevel = doc.get("highlevel", {})
+            entry[2] = _number(highlevel.get("mood_relaxed", {}).get("all", {}).get("relaxed"))
+            entry[3] = highlevel.get("genre_rosamerica", {}).get("value")
+            if n % 100000 == 0:
+                print(f"{source}: {n} high-level documents", file=sys.stderr)
+
+    return features
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the offline AcousticBrainz feature store.")
+    parser.add_argument("--lowlevel", nargs="+", required=True, help="Low-level dump archives/directories, or -")
+    parser.add_argument("--highlevel", nargs="*", default=[], help="High-level dump archives/directories, or -")
+    parser.add_argument("--output", default=os.getenv("FEATURE_STORE_PATH", feature_store.DEFAULT_STORE_PATH))
+    args = parser.parse_args()
+
+    if (args.lowlevel + args.highlevel).count("-") > 1:
+        parser.error("only one input can be read from stdin")
+
+    features = ingest(args.lowlevel, args.highlevel)
+    count = feature_store.write_store(
+        args.output,
+        (feature_store.pack_record(mbid, *values) for mbid, values in features.items()),
+    )
+    print(f"Wrote {count} recordings to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+Background playlist analysis jobs.
+
+A job is submitted with a playlist id, snapshot and potential and gets a job
+id back right away. Jobs with the same (playlist id, snapshot_id, potential)
+are deduplicated: while one is queued, running or finished, submitting it
+again returns the existing job. Results are persisted for polling.
+
+Two backends share one interface:
+  RedisJobQueue  (REDIS_URL set) a Redis list feeds any number of worker
+                 processes started with `python jobs.py worker`
+  LocalJobQueue  a thread pool inside the web process, results in SQLite
+"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import logs
+import pipeline
+import ratelimit
+
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", 7 * 24 * 3600)) # Seconds finished jobs are kept
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2)) # Local backend worker threads
+JOB_STALE_AFTER = int(os.getenv("JOB_STALE_AFTER", 900)) # Seconds without progress before a job counts as lost
+DEFAULT_JOBS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs.sqlite3")
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+log = logs.get_logger(__name__)
+
+
+def job_key(payload):
+    return f"{payload['playlist_id']}:{payload['snapshot_id']}:{payload['potential']}"
+
+
+def run_job(payload, on_progress):
+    """
+    Runs the MBID, acoustic and chart stages for a job payload. Tracks are
+    included in the payload by the submitter, or None when the stored state
+    already reflects the snapshot. Returns the final result event.
+    """
+    def fetch_tracks():
+        if payload.get("tracks") is None:
+            raise RuntimeError("Playlist changed since the job was submitted; please resubmit")
+        return payload["tracks"], payload["total_duration_ms"]
+
+    result = None
+    for event in pipeline.analyze_snapshot(
+        payload["playlist_id"], payload.get("playlist_name"), payload["snapshot_id"],
+        payload["potential"], fetch_tracks, public=payload.get("public", False),
+    ):
+        if event["type"] == "result":
+            result = event
+        else:
+            on_progress(event)
+    return result
+
+
+class LocalJobQueue:
+    """In-process worker pool; job records are persisted in SQLite."""
+
+    def __init__(self, path=DEFAULT_JOBS_PATH, workers=JOB_WORKERS):
+        self.path = path
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY,"
+                " key TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " progress TEXT,"
+                " result TEXT,"
+                " error TEXT,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key)")
+            self._local.conn = conn
+        return conn
+
+    def _update(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        self._connection().execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def submit(self, payload, prepare=None):
+        """
+        Returns (job_id, deduplicated). prepare(payload), when given, is only
+        called for new jobs, to fill in data that's costly to gather.
+        """
+        key = job_key(payload)
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM jobs WHERE updated_at < ?", (now - JOB_RESULT_TTL,))
+            # Queued/running jobs that stopped updating died with their process
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE key = ? AND (status = ? OR (status != ? AND updated_at >= ?))"
+                " ORDER BY created_at DESC LIMIT 1",
+                (key, DONE, FAILED, now - JOB_STALE_AFTER),
+            ).fetchone()
+            if row:
+                return row[0], True
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (id, key, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, key, QUEUED, now, now),
+            )
+        try:
+            if prepare:
+                prepare(payload)
+        except Exception as e:
+            self._update(job_id, status=FAILED, error=str(e))
+            raise
+        self._pool.submit(self._run, job_id, payload)
+        return job_id, False
+
+    def _run(self, job_id, payload):
+        self._update(job_id, status=RUNNING)
+        try:
+            result = run_job(payload, lambda event: self._update(job_id, progress=json.dumps(event)))
+            self._update(job_id, status=DONE, result=json.dumps(result))
+        except Exception as e:
+            log.exception("Job failed", job_id=job_id)
+            self._update(job_id, status=FAILED, error=str(e))
+
+    def get(self, job_id):
+        row = self._connection().execute(
+            "SELECT status, progress, result, error, created_at, updated_at FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        status, progress, result, error, created_at, updated_at = row
+        if status in (QUEUED, RUNNING) and updated_at < time.time() - JOB_STALE_AFTER:
+            status, error = FAILED, "Job was lost before it finished"
+        return {
+            "job_id": job_id,
+            "status": status,
+            "progress": json.loads(progress) if progress else None,
+            "result": json.loads(result) if result else None,
+            "error": error,
+            "created_at": created_at,
+            "updated_at": updated_at,
+        }
+
+
+# Points a dedup key at a new job only if it still points at the job it replaces
+_REPLACE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+    return 1
+end
+return 0
+"""
+
+
+class RedisJobQueue:
+    """
+    Jobs as Redis hashes (job:<id>), a dedup index (jobkey:<key> -> id) and
+    a list (jobs:queue) consumed by `python jobs.py worker` processes.
+    """
+
+    QUEUE = "jobs:queue"
+
+    def __init__(self, client):
+        self.client = client
+        self._replace = client.register_script(_REPLACE_SCRIPT)
+
+    def _live(self, job_id):
+        """Whether a job is done, or queued/running and still making progress."""
+        status, updated_at = self.client.hmget(f"job:{job_id}", "status", "updated_at")
+        if status is None:
+            return False
+        status = status.decode()
+        return status == DONE or (status != FAILED and float(updated_at) >= time.time() - JOB_STALE_AFTER)
+
+    def submit(self, payload, prepare=None):
+        key = job_key(payload)
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        # The job exists (queued) before its key is claimed, so a concurrent
+        # identical submission finds it live while prepare is still running
+        pipe = self.client.pipeline()
+        pipe.hset(f"job:{job_id}", mapping={
+            "key": key, "status": QUEUED, "payload": "", "created_at": now, "updated_at": now,
+        })
+        pipe.expire(f"job:{job_id}", JOB_RESULT_TTL)
+        pipe.execute()
+
+        # Atomically claim the key; an existing live job wins
+        while not self.client.set(f"jobkey:{key}", job_id, nx=True, ex=JOB_RESULT_TTL):
+            existing = self.client.get(f"jobkey:{key}")
+            if existing is None:
+                continue # Expired in between; try to claim again
+            if self._live(existing.decode()):
+                self.client.delete(f"job:{job_id}")
+                return existing.decode(), True
+            # Failed, lost or vanished: this submission retries it
+            if self._replace(keys=[f"jobkey:{key}"], args=[existing, job_id, JOB_RESULT_TTL]):
+                break
+
+        try:
+            if prepare:
+                prepare(payload)
+        except Exception as e:
+            self._update(job_id, status=FAILED, error=str(e))
+            raise
+
+        pipe = self.client.pipeline()
+        pipe.hset(f"job:{job_id}", mapping={"payload": json.dumps(payload), "updated_at": time.time()})
+        pipe.lpush(self.QUEUE, job_id)
+        pipe.execute()
+        return job_id, False
+
+    def _update(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        self.client.hset(f"job:{job_id}", mapping=fields)
+
+    def get(self, job_id):
+        data = self.client.hgetall(f"job:{job_id}")
+        if not data:
+            return None
+        data = {k.decode(): v.decode() for k, v in data.items()}
+        status, error = data.get("status"), data.get("error")
+        if status in (QUEUED, RUNNING) and float(data["updated_at"]) < time.time() - JOB_STALE_AFTER:
+            status, error = FAILED, "Job was lost before it finished"
+        return {
+            "job_id": job_id,
+            "status": status,
+            "progress": json.loads(data["progress"]) if data.get("progress") else None,
+            "result": json.loads(data["result"]) if data.get("result") else None,
+            "error": error,
+            "created_at": float(data["created_at"]),
+            "updated_at": float(data["updated_at"]),
+        }
+
+    def work(self):
+        """Worker loop: runs queued jobs one at a time, forever."""
+        log.info("Job worker started")
+        while True:
+            item = self.client.brpop(self.QUEUE, timeout=5)
+            if item is None:
+                continue
+            job_id = item[1].decode()
+            raw = self.client.hget(f"job:{job_id}", "payload")
+            if raw is None:
+                continue # Expired before a worker got to it
+            self._update(job_id, status=RUNNING)
+            try:
+                result = run_job(json.loads(raw), lambda event: self._update(job_id, progress=json.dumps(event)))
+                self._update(job_id, status=DONE, result=json.dumps(result), payload="")
+            except Exception as e:
+                log.exception("Job failed", job_id=job_id)
+                self._update(job_id, status=FAILED, error=str(e), payload="")
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """Redis-backed queue when REDIS_URL is set, else the local one. Created on first use."""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                client = ratelimit.redis_client_from_env()
+                _queue = RedisJobQueue(client) if client is not None else LocalJobQueue(os.getenv("JOBS_DB_PATH", DEFAULT_JOBS_PATH))
+    return _queue
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["worker"]:
+        raise SystemExit("Usage: python jobs.py worker")
+    queue = get_queue()
+    if not isinstance(queue, RedisJobQueue):
+        raise SystemExit("Set REDIS_URL to run standalone workers; without Redis jobs run inside the web process")
+    queue.work()
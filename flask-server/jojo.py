@@ -1,5 +1,6 @@
-import numpy as np
-import pandas as pd
+import math
+from functools import lru_cache
+import stand_table
 
 # Danceability (Power): 0-3
 # BPM (Speed): 40-250
@@ -12,14 +13,34 @@ def norm(val, ma, mi):
     # Normalize values to range 16.677-100 to get chars
     return (500 / 6) * ((val - mi) / (ma - mi)) + (100 / 6)
 
-def get_jojo_chart(data):
-    # Create char map for JoJo chart
-    df = pd.read_csv('jojo-stands.csv', encoding='ISO-8859-1')
+STANDS_CSV = stand_table.DEFAULT_CSV_PATH
+STANDS_TABLE = stand_table.DEFAULT_TABLE_PATH # Prebuilt from STANDS_CSV, see stand_table.py
+
+
+@lru_cache(maxsize=1)
+def load_stand_table():
+    """
+    Loads the stand table once per process, from the prebuilt file when it
+    is up to date. Returns (names, columns, rows): stand names, stat column
+    names and one tuple of 6 stats per stand, letter grades converted
+    (NaN for missing grades).
+    Single charts are matched in plain Python against the rows, so serving
+    them needs neither pandas nor numpy.
+    """
+    return stand_table.load(STANDS_CSV, STANDS_TABLE)
 
-    # Convert values   
-    df = df.replace(to_replace=['None', 'E', 'D', 'C', 'B', 'A', 'Infi'], value=[i * 100 / 6 for i in range(7)])
-    df.columns = ['STM' if x == 'PER' else x for x in df.columns]
 
+@lru_cache(maxsize=1)
+def stand_matrix():
+    """The stand rows as a contiguous, read-only (n_stands, 6) numpy matrix, for bulk matching."""
+    import numpy as np
+    matrix = np.ascontiguousarray(load_stand_table()[2], dtype=np.float64)
+    matrix.setflags(write=False)
+    return matrix
+
+
+def normalize_metrics(data):
+    """Converts playlist metrics into the 6 normalized chart stats."""
     # Get values from data
     danceability = data['averageDanceability']
     bpm = data['averageBPM']
@@ -36,14 +57,106 @@ def get_jojo_chart(data):
     stm = norm(durability, 1440000000, 4)
     rng = norm(genre_range, 8, 1)  # Updated variable name
 
-    converted_stats = np.array([pwr, spd, prc, dev, stm, rng])
+    return [float(pwr), float(spd), float(prc), float(dev), float(stm), float(rng)]
+
+
+def _distances(matrix, stats):
+    """
+    Euclidean distances between stat rows and stands, broadcasting over the
+    leading axes. Stands with missing grades (NaN) get an infinite distance
+    so they are never matched, as with pandas' idxmin.
+    """
+    import numpy as np
+    distances = np.sqrt(((stats[..., None, :] - matrix) ** 2).sum(axis=-1))
+    return np.where(np.isnan(distances), np.inf, distances)
+
+
+def _stand_distances(stats):
+    """
+    _distances for a single stats row, in plain Python: the same float
+    operations in the same order, so the results are identical.
+    """
+    s0, s1, s2, s3, s4, s5 = stats
+    distances = []
+    for g0, g1, g2, g3, g4, g5 in load_stand_table()[2]:
+        distance = math.sqrt((s0 - g0) * (s0 - g0) + (s1 - g1) * (s1 - g1) + (s2 - g2) * (s2 - g2)
+                             + (s3 - g3) * (s3 - g3) + (s4 - g4) * (s4 - g4) + (s5 - g5) * (s5 - g5))
+        distances.append(math.inf if distance != distance else distance) # NaN grade: never matched
+    return distances
+
+
+def _stand_record(index, distance):
+    names, columns, rows = load_stand_table()
+    record = {'Stand': names[index]}
+    record.update(zip(columns, rows[index]))
+    record['distance'] = float(distance)
+    return record
+
+
+def get_nearest_stands(data, k=1):
+    """
+    Matches playlist metrics against every stand. Returns the normalized
+    stats and the k closest stands (name, stats and distance), nearest first.
+    """
+    converted_stats = normalize_metrics(data)
+
+    distances = _stand_distances(converted_stats)
+    k = max(1, min(int(k), sum(1 for d in distances if d != math.inf)))
+    # First stand on ties, like idxmin did (min and the stable sort both keep it)
+    if k == 1:
+        nearest = [distances.index(min(distances))]
+    else:
+        nearest = sorted(range(len(distances)), key=distances.__getitem__)[:k]
+
+    return converted_stats, [_stand_record(i, distances[i]) for i in nearest]
+
+
+def get_jojo_chart(data):
+    converted_stats, nearest = get_nearest_stands(data, k=1)
+    return converted_stats, nearest[0]
+
+METRIC_KEYS = [
+    'averageDanceability', 'averageBPM', 'averageRelaxedProbability',
+    'potential', 'spotifyTotalDurationMs', 'uniqueGenreCount'
+]
+# (max, min) per metric, in METRIC_KEYS order; same ranges as normalize_metrics
+METRIC_RANGES = ((3, 0), (250, 40), (1, 0), (6, 1), (1440000000, 4), (8, 1))
+
+
+def normalize_metrics_matrix(raw):
+    """
+    Normalizes an (n, 6) matrix of raw metrics, columns in METRIC_KEYS order,
+    into chart stats in one step.
+    """
+    import numpy as np
+    raw = np.asarray(raw, dtype=np.float64)
+    ranges = np.array(METRIC_RANGES, dtype=np.float64)
+    return norm(raw, ranges[:, 0], ranges[:, 1])
+
 
-    def distance(a, b):
-        return np.linalg.norm(a - b)
+def get_jojo_charts(raw, chunk_size=4096):
+    """
+    Bulk version of get_jojo_chart for an (n, 6) matrix of raw metrics
+    (see normalize_metrics_matrix). Distances to every stand are computed
+    as one batched pairwise step per chunk of rows, which bounds memory at
+    chunk_size * n_stands * 6 floats.
+    Returns (converted_stats, stand_indices, distances) as arrays; stand
+    indices refer to the names returned by load_stand_table.
+    """
+    import numpy as np
+    matrix = stand_matrix()
+    converted = normalize_metrics_matrix(raw).reshape(-1, 6)
+    indices = np.empty(len(converted), dtype=np.intp)
+    distances = np.empty(len(converted), dtype=np.float64)
 
-    df["distance"] = df.apply(lambda x: distance(x.to_numpy()[1:7], converted_stats), axis=1)  
+    for start in range(0, len(converted), chunk_size):
+        block = converted[start:start + chunk_size]
+        pairwise = _distances(matrix, block)
+        best = pairwise.argmin(axis=1) # First minimum on ties, like get_jojo_chart
+        indices[start:start + len(block)] = best
+        distances[start:start + len(block)] = pairwise[np.arange(len(block)), best]
 
-    return converted_stats, df.loc[df['distance'].idxmin()]
+    return converted, indices, distances
 
 # def main():
 #     data = { 
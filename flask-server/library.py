@@ -0,0 +1,207 @@
+"""
+Whole-library analysis: every playlist of a user in one pass.
+
+Tracks are deduplicated across (and within) playlists before any lookup, so
+each distinct track is resolved and featurized once. Per-playlist metrics
+are then aggregated from the shared feature table with numpy and matched to
+stands as one matrix.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import accumulator
+import deadlines
+import logs
+import pipeline
+import playlist_catalog
+import playlist_state
+
+log = logs.get_logger(__name__)
+
+
+def fetch_library_tracks(sp, catalog, deadline=None):
+    """
+    Track lists of every playlist in the catalog, fetched concurrently.
+    Returns [(playlist, tracks_info, total_duration_ms)]; playlists that
+    failed to load are logged and skipped. Raises DeadlineExceeded when the
+    deadline passes before every track list is in.
+    """
+    def fetch(playlist):
+        try:
+            tracks, total_duration_ms = playlist_catalog.get_playlist_tracks(
+                sp, playlist['id'], playlist['snapshot_id'], deadline
+            )
+            return playlist, tracks, total_duration_ms
+        except deadlines.DeadlineExceeded:
+            raise
+        except Exception as e:
+            log.warning("Skipping playlist", playlist_id=playlist['id'], error=str(e))
+            return None
+
+    with ThreadPoolExecutor(max_workers=pipeline.SPOTIFY_PAGE_CONCURRENCY) as pool:
+        return [entry for entry in pool.map(fetch, catalog.playlists) if entry]
+
+
+def known_details(playlist_ids, state_store=None):
+    """Track details from earlier analyses of these playlists, by track key."""
+    store = state_store or playlist_state.store
+    details = {}
+    for playlist_id in playlist_ids:
+        state = store.get(playlist_id)
+        if state:
+            for key, entry in state["tracks"].items():
+                details.setdefault(key, entry["detail"])
+    return details
+
+
+def feature_table(details):
+    """
+    Columns of the unique-track table: a (n, 3) float array of
+    FEATURES (NaN when missing) and an int array of genre codes (-1 when
+    not a Rosamerica genre), plus the number of distinct genres.
+    """
+    values = np.full((len(details), len(playlist_state.FEATURES)), np.nan)
+    genres = np.full(len(details), -1, dtype=np.int64)
+    codes = {}
+    for row, detail in enumerate(details):
+        detail = detail or {} # Skipped when the time budget ran out
+        for col, feature in enumerate(playlist_state.FEATURES):
+            value = detail.get(feature)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                values[row, col] = value
+        genre = detail.get("genre")
+        if accumulator.genre_bit(genre):
+            genres[row] = codes.setdefault(genre, len(codes))
+    return values, genres, len(codes)
+
+
+def aggregate_playlists(occurrences, owners, playlist_count, values, genres, genre_count):
+    """
+    Per-playlist aggregates in one pass over all playlist entries.
+    occurrences[i] is the unique-track row of entry i, owners[i] its playlist.
+    Returns metric dictionaries rounded like pipeline.aggregate_metrics.
+    """
+    entry_values = values[occurrences]
+    present = ~np.isnan(entry_values)
+    sums = np.stack([
+        np.bincount(owners, weights=np.where(present[:, col], entry_values[:, col], 0.0), minlength=playlist_count)
+        for col in range(values.shape[1])
+    ], axis=1)
+    counts = np.stack([
+        np.bincount(owners, weights=present[:, col], minlength=playlist_count)
+        for col in range(values.shape[1])
+    ], axis=1)
+
+    # Distinct (playlist, genre) pairs, counted per playlist
+    entry_genres = genres[occurrences]
+    tagged = entry_genres >= 0
+    pairs = np.unique(owners[tagged] * max(genre_count, 1) + entry_genres[tagged])
+    unique_genres = np.bincount(pairs // max(genre_count, 1), minlength=playlist_count)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        averages = (sums / counts).tolist()
+
+    metrics = []
+    for row in range(playlist_count):
+        average = {
+            # Python's round, so ties resolve exactly like aggregate_metrics
+            feature: round(averages[row][col], 2) if counts[row, col] > 0 else None
+            for col, feature in enumerate(playlist_state.FEATURES)
+        }
+        metrics.append({
+            "averageBPM": average["bpm"],
+            "averageDanceability": average["danceability"],
+            "uniqueGenreCount": int(unique_genres[row]) or None,
+            "averageRelaxedProbability": average["relaxedProbability"],
+        })
+    return metrics
+
+
+def analyze_library(sp, session_id, potential, max_workers=pipeline.ANALYZE_CONCURRENCY, state_store=None,
+                    deadline=None):
+    """
+    Analyzes all of the user's playlists. With a deadline, tracks not
+    analyzed in time are left out of every playlist's metrics and counted
+    in its "coverage". Generator of event dictionaries,
+    suitable for streaming as NDJSON:
+      {"type": "library", ...}   once every playlist has been paged through
+      {"type": "progress", ...}  every PROGRESS_EVERY newly analyzed tracks
+      {"type": "result", ...}    metrics and matched stand per playlist
+    """
+    catalog = playlist_catalog.get_catalog(sp, session_id, deadline)
+    library = fetch_library_tracks(sp, catalog, deadline)
+
+    # Unique-track table and, per playlist entry, its row in it
+    rows = {}
+    unique_tracks = []
+    occurrences = []
+    owners = []
+    for owner, (_, tracks, _) in enumerate(library):
+        for track in tracks:
+            key = playlist_state.track_key(track)
+            row = rows.get(key)
+            if row is None:
+                row = rows[key] = len(unique_tracks)
+                unique_tracks.append(track)
+            occurrences.append(row)
+            owners.append(owner)
+
+    details = [None] * len(unique_tracks)
+    known = known_details((playlist['id'] for playlist, _, _ in library), state_store)
+    for key, row in rows.items():
+        details[row] = known.get(key)
+    to_analyze = [row for row, detail in enumerate(details) if detail is None]
+
+    yield {
+        "type": "library",
+        "playlist_count": len(library),
+        "track_count": len(occurrences),
+        "unique_tracks": len(unique_tracks),
+        "reused": len(unique_tracks) - len(to_analyze),
+        "to_analyze": len(to_analyze),
+    }
+
+    done = 0
+    for i, detail in pipeline.analyze_tracks([unique_tracks[row] for row in to_analyze], max_workers=max_workers,
+                                             deadline=deadline):
+        details[to_analyze[i]] = detail
+        done += 1
+        if done % pipeline.PROGRESS_EVERY == 0 and done < len(to_analyze):
+            yield {"type": "progress", "done": done, "total": len(to_analyze)}
+
+    occurrences = np.array(occurrences, dtype=np.int64)
+    owners = np.array(owners, dtype=np.int64)
+    values, genres, genre_count = feature_table(details)
+    metrics = aggregate_playlists(occurrences, owners, len(library), values, genres, genre_count)
+    for (_, _, total_duration_ms), playlist_metrics in zip(library, metrics):
+        playlist_metrics.update(spotifyTotalDurationMs=total_duration_ms, potential=potential)
+
+    # Entries of tracks skipped for lack of time, per playlist
+    unfinished = np.array([detail is None for detail in details], dtype=bool)
+    skipped = np.bincount(owners, weights=unfinished[occurrences], minlength=len(library)).astype(np.int64).tolist()
+
+    charts = pipeline.chart_columns(metrics)
+    errors = {error["index"]: error["error"] for error in charts["errors"]}
+    playlists = []
+    for i, ((playlist, tracks, _), playlist_metrics) in enumerate(zip(library, metrics)):
+        playlists.append({
+            "id": playlist['id'],
+            "name": playlist['name'],
+            "track_count": len(tracks),
+            "metrics": playlist_metrics,
+            "playlist_stats_normalized": charts["playlist_stats_normalized"][i],
+            "stand": charts["stand"][i],
+            "distance": charts["distance"][i],
+            "error": errors.get(i),
+            "coverage": {
+                "tracks": len(tracks),
+                "analyzed": len(tracks) - skipped[i],
+                "ratio": round((len(tracks) - skipped[i]) / len(tracks), 4) if tracks else 1.0,
+            },
+        })
+
+    pipeline.index_playlists([
+        (entry["id"], entry["name"], entry["playlist_stats_normalized"], playlist['public'])
+        for (playlist, _, _), entry in zip(library, playlists)
+        if entry["error"] is None and entry["coverage"]["analyzed"] == entry["coverage"]["tracks"]
+    ])
+    yield {"type": "result", "playlists": playlists}
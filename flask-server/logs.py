@@ -0,0 +1,114 @@
+"""
+Leveled, structured (JSON lines) logging to stderr.
+
+    log = logs.get_logger(__name__)
+    log.info("ISRC lookup done", matched=12, wanted=20)
+    log.debug("Validated features", mbid=mbid, bpm=bpm, sample=True)
+
+Keyword arguments become fields of the record; one named like a key of the
+record itself (level, message, ...) is written with a "field_" prefix instead
+of overwriting it. Records passed sample=True
+come from hot paths (per track, per request); below WARNING only
+LOG_SAMPLE_RATE of them are written. LOG_LEVEL sets the minimum level.
+"""
+import json
+import logging
+import os
+import random
+import sys
+import threading
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.1)) # Share of sampled records kept
+
+_RESERVED = ("exc_info", "stack_info", "stacklevel", "extra")
+_RECORD_KEYS = ("ts", "level", "logger", "message", "msg", "exception") # Renamed when passed as fields
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps LOG_SAMPLE_RATE of the sampled records below WARNING, and everything else."""
+
+    def __init__(self, rate=LOG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not getattr(record, "sampled", False):
+            return True
+        return random.random() < self.rate
+
+
+class StructuredLogger(logging.LoggerAdapter):
+    """Turns keyword arguments into structured fields."""
+
+    # level and msg are positional-only, so fields with those names don't collide with them
+    def log(self, level, msg, /, *args, **kwargs):
+        if self.isEnabledFor(level):
+            msg, kwargs = self.process(msg, kwargs)
+            self.logger.log(level, msg, *args, **kwargs)
+
+    def debug(self, msg, /, *args, **kwargs):
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, /, *args, **kwargs):
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+    def warning(self, msg, /, *args, **kwargs):
+        self.log(logging.WARNING, msg, *args, **kwargs)
+
+    def error(self, msg, /, *args, **kwargs):
+        self.log(logging.ERROR, msg, *args, **kwargs)
+
+    def exception(self, msg, /, *args, exc_info=True, **kwargs):
+        self.log(logging.ERROR, msg, *args, exc_info=exc_info, **kwargs)
+
+    def critical(self, msg, /, *args, **kwargs):
+        self.log(logging.CRITICAL, msg, *args, **kwargs)
+
+    def process(self, msg, kwargs):
+        fields = {
+            f"field_{key}" if key in _RECORD_KEYS else key: kwargs.pop(key)
+            for key in list(kwargs) if key not in _RESERVED
+        }
+        sampled = fields.pop("sample", False)
+        kwargs["extra"] = {"fields": fields, "sampled": sampled}
+        return msg, kwargs
+
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+def _configure():
+    """Installs the JSON handler on the root logger, unless the host (e.g. a test runner) already has one."""
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        root = logging.getLogger()
+        if not root.handlers:
+            handler = logging.StreamHandler(sys.stderr)
+            handler.setFormatter(JsonFormatter())
+            handler.addFilter(SamplingFilter())
+            root.addHandler(handler)
+            root.setLevel(LOG_LEVEL)
+        _configured = True
+
+
+def get_logger(name):
+    _configure()
+    return StructuredLogger(logging.getLogger(name), {})
@@ -0,0 +1,43 @@
+import threading
+import time
+from collections import OrderedDict
+import telemetry
+
+
+class LRUCache:
+    """Small thread-safe LRU mapping with optional per-entry expiry."""
+
+    def __init__(self, name, max_entries):
+        self.name = name # Label of the cache in cache_lookups_total/cache_evictions_total
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.time():
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        telemetry.CACHE_LOOKUPS.inc(cache=self.name, result="miss" if entry is None else "hit")
+        return None if entry is None else entry[0]
+
+    def put(self, key, value, ttl=None):
+        evicted = 0
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl if ttl else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+        if evicted:
+            telemetry.CACHE_EVICTIONS.inc(evicted, cache=self.name)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
@@ -0,0 +1,110 @@
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+# Default locations/lifetimes, overridable through the environment
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mbid_cache.sqlite3")
+DEFAULT_HIT_TTL = 30 * 24 * 3600   # Resolved MBIDs practically never change
+DEFAULT_MISS_TTL = 24 * 3600       # Retry unmatched songs daily, MusicBrainz keeps growing
+
+
+def normalize(value):
+    """Canonical form of a lookup field: NFKC, case-folded, whitespace collapsed."""
+    if not value:
+        return ""
+    value = unicodedata.normalize("NFKC", str(value)).casefold()
+    return " ".join(value.split())
+
+
+def make_key(song_name, artist_name, album=None):
+    """Cache key for a (song, artist, album) lookup."""
+    return "\x1f".join([normalize(song_name), normalize(artist_name), normalize(album)])
+
+
+class MbidCache:
+    """
+    Persistent MBID resolution cache backed by SQLite.
+    Stores both hits (an MBID) and misses (None) with separate TTLs, so
+    repeated lookups for the same song never reach MusicBrainz again until
+    the entry expires. The file is shared by every worker on the machine.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, hit_ttl=DEFAULT_HIT_TTL, miss_ttl=DEFAULT_MISS_TTL):
+        self.path = path
+        self.hit_ttl = hit_ttl
+        self.miss_ttl = miss_ttl
+        self._local = threading.local()  # sqlite3 connections can't be shared across threads
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            path=os.getenv("MBID_CACHE_PATH", DEFAULT_CACHE_PATH),
+            hit_ttl=int(os.getenv("MBID_CACHE_HIT_TTL", DEFAULT_HIT_TTL)),
+            miss_ttl=int(os.getenv("MBID_CACHE_MISS_TTL", DEFAULT_MISS_TTL)),
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")  # Readers don't block the writer
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS mbid_cache ("
+                " key TEXT PRIMARY KEY,"
+                " mbid TEXT,"
+                " expires_at REAL NOT NULL)"
+            )
+            self._local.conn = conn
+        return conn
+
+    def _count(self, attr):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+    def get(self, key):
+        """
+        Returns (True, mbid) on a cache hit, where mbid is None for a cached
+        miss, or (False, None) when the key is unknown or expired.
+        """
+        row = self._connection().execute(
+            "SELECT mbid, expires_at FROM mbid_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[1] < time.time():
+            self._count("misses")
+            return False, None
+        if row[0] is None:
+            self._count("negative_hits")
+        else:
+            self._count("hits")
+        return True, row[0]
+
+    def set(self, key, mbid):
+        """Stores a resolved MBID, or None to remember that nothing matched."""
+        ttl = self.hit_ttl if mbid else self.miss_ttl
+        self._connection().execute(
+            "INSERT OR REPLACE INTO mbid_cache (key, mbid, expires_at) VALUES (?, ?, ?)",
+            (key, mbid or None, time.time() + ttl),
+        )
+
+    def purge_expired(self):
+        """Deletes expired rows. Returns the number of rows removed."""
+        cur = self._connection().execute("DELETE FROM mbid_cache WHERE expires_at < ?", (time.time(),))
+        return cur.rowcount
+
+    def stats(self):
+        with self._lock:
+            hits, negative_hits, misses = self.hits, self.negative_hits, self.misses
+        lookups = hits + negative_hits + misses
+        return {
+            "hits": hits,
+            "negative_hits": negative_hits,
+            "misses": misses,
+            "hit_ratio": (hits + negative_hits) / lookups if lookups else None,
+        }
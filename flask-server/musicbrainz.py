@@ -0,0 +1,210 @@
+import os
+import requests
+import deadlines
+import http_client
+import logs
+import telemetry
+import mbid_cache
+import ratelimit
+
+MUSICBRAINZ_URL = os.getenv("MUSICBRAINZ_URL", "https://musicbrainz.org/ws/2/recording/")
+ISRC_BATCH = 50 # ISRCs OR-ed into one search query
+REQUEST_TIMEOUT = 10 # Seconds, per request (less when an analysis budget ends sooner)
+HEADERS = {
+    "User-Agent": "SpotifyPlaylistAnalyzer/1.0 ( your-email@example.com )" # Be a good citizen
+}
+
+cache = mbid_cache.MbidCache.from_env()
+
+# MusicBrainz allows about 1 request/second per client. The bucket is shared
+# by all workers through Redis when REDIS_URL is set, else it is per process.
+_redis = ratelimit.redis_client_from_env()
+scheduler = ratelimit.RateLimitedScheduler(
+    ratelimit.make_bucket("musicbrainz", float(os.getenv("MUSICBRAINZ_RATE", 1)), client=_redis)
+)
+coalescer = ratelimit.Coalescer(_redis, prefix="coalesce:mbid:")
+http_client.mount_scheduled(MUSICBRAINZ_URL)
+
+log = logs.get_logger(__name__)
+
+
+@telemetry.register_collector
+def _collect():
+    cache_stats = cache.stats()
+    scheduler_stats = scheduler.stats()
+    return [
+        ("mbid_cache_lookups_total", "counter", "Persistent MBID cache lookups by result",
+         [({"result": result}, cache_stats[result]) for result in ("hits", "negative_hits", "misses")]),
+        ("mbid_cache_hit_ratio", "gauge", "Share of MBID cache lookups answered from the cache",
+         [({}, cache_stats["hit_ratio"])]),
+        ("musicbrainz_scheduler_queue_depth", "gauge", "Calls waiting for a MusicBrainz rate-limit slot",
+         [({}, scheduler_stats["queue_depth"])]),
+        ("musicbrainz_scheduler_throttled_total", "counter", "503/429 responses from MusicBrainz",
+         [({}, scheduler_stats["throttled_responses"])]),
+        ("musicbrainz_coalesced_total", "counter", "MBID lookups answered by an identical in-flight lookup",
+         [({}, coalescer.coalesced)]),
+    ]
+
+
+def _get(params, deadline=None):
+    """
+    Rate-limited GET against the recording search endpoint. MusicBrainz
+    requests aren't hedged (a duplicate would spend a rate-limit slot);
+    with a deadline they're cut short instead.
+    """
+    return scheduler.call(
+        lambda: http_client.session.get(MUSICBRAINZ_URL, params=params, headers=HEADERS,
+                                         timeout=deadlines.request_timeout(deadline, REQUEST_TIMEOUT)),
+        deadline=deadline,
+    )
+
+
+def search_mbid(song_name, artist_name, album=None, deadline=None):
+    """
+    Runs the Lucene recording search against MusicBrainz, first with the album
+    and then, if nothing matched, without it.
+    Returns the MBID of the first matching recording, or None.
+    Request errors (timeouts, HTTP errors) are raised to the caller.
+    """
+    # Construct the query, prioritizing matches with all three fields
+    query_parts = [f'recording:"{song_name}"', f'artist:"{artist_name}"']
+    if album:
+        query_parts.append(f'release:"{album}"') # Use release for album matching in recordings
+
+    query = " AND ".join(query_parts)
+    params = {
+        "query": query,
+        "fmt": "json",
+        "limit": 10 # Get a few results to potentially check score later if needed
+    }
+
+    log.debug("Querying MusicBrainz", query=query, sample=True)
+
+    response = _get(params, deadline)
+    response.raise_for_status() # Raise HTTP errors
+    recordings = response.json().get("recordings", [])
+
+    if recordings:
+        # Simple approach: take the first result's ID.
+        mbid = recordings[0].get("id")
+        if not mbid:
+            log.info("No MBID in first recording", song=song_name, artist=artist_name)
+        return mbid or None
+
+    log.debug("No recordings found, retrying without album" if album else "No recordings found",
+              query=query, sample=True)
+    # Try a broader query without the album as a fallback
+    if album:
+        query_simple = f'recording:"{song_name}" AND artist:"{artist_name}"'
+        params_simple = {"query": query_simple, "fmt": "json", "limit": 1}
+        response_simple = _get(params_simple, deadline)
+        response_simple.raise_for_status()
+        recordings_simple = response_simple.json().get("recordings", [])
+        if recordings_simple and recordings_simple[0].get("id"):
+            log.debug("MBID found without album", mbid=recordings_simple[0]["id"], song=song_name,
+                      artist=artist_name, sample=True)
+            return recordings_simple[0]["id"]
+        log.debug("No recordings found even without album", song=song_name, artist=artist_name, sample=True)
+
+    return None
+
+
+def normalize_isrc(isrc):
+    """ISRCs are 12 alphanumerics; Spotify sometimes returns them lowercase or hyphenated."""
+    return "".join(ch for ch in str(isrc) if ch.isalnum()).upper() if isrc else ""
+
+
+def search_mbids_by_isrc(isrcs, deadline=None, on_chunk=None):
+    """
+    Exact MBID resolution for many ISRCs with a handful of searches: ISRCs are
+    OR-ed together ISRC_BATCH at a time and matched against the "isrcs" list
+    of every returned recording.
+    Returns {isrc: mbid} for the ISRCs MusicBrainz knows. on_chunk, if given,
+    receives {isrc: mbid or None} for the ISRCs of each chunk as soon as it is
+    resolved. Request errors are raised to the caller.
+    """
+    wanted = list(dict.fromkeys(normalize_isrc(i) for i in isrcs if normalize_isrc(i)))
+    found = {}
+    for start in range(0, len(wanted), ISRC_BATCH):
+        chunk = wanted[start:start + ISRC_BATCH]
+        chunk_set = set(chunk)
+        query = " OR ".join(f"isrc:{isrc}" for isrc in chunk)
+        offset = 0
+        while True:
+            response = _get({"query": query, "fmt": "json", "limit": 100, "offset": offset}, deadline)
+            response.raise_for_status()
+            data = response.json()
+            recordings = data.get("recordings", [])
+            for recording in recordings:
+                for isrc in recording.get("isrcs", []):
+                    isrc = normalize_isrc(isrc)
+                    # Results are sorted by score, so keep the first recording per ISRC
+                    if isrc in chunk_set and isrc not in found and recording.get("id"):
+                        found[isrc] = recording["id"]
+            offset += len(recordings)
+            if not recordings or offset >= data.get("count", 0) or chunk_set.issubset(found):
+                break
+        if on_chunk is not None:
+            on_chunk({isrc: found.get(isrc) for isrc in chunk})
+    log.info("MusicBrainz ISRC lookup", matched=len(found), wanted=len(wanted))
+    return found
+
+
+def get_mbids_by_isrc(isrcs, deadline=None):
+    """
+    Cached bulk ISRC resolution. Returns {isrc: mbid or None} for every
+    (normalized) ISRC given; None means MusicBrainz has no recording for it.
+    Chunks are cached as they resolve: when a search fails or the deadline
+    passes, the ISRCs resolved so far are kept and returned, and the rest are
+    left out, to be retried by the next call.
+    """
+    results = {}
+    uncached = []
+    for isrc in dict.fromkeys(normalize_isrc(i) for i in isrcs):
+        if not isrc:
+            continue
+        cached, mbid = cache.get("isrc:" + isrc)
+        if cached:
+            results[isrc] = mbid
+        else:
+            uncached.append(isrc)
+
+    if uncached:
+        def store(chunk):
+            for isrc, mbid in chunk.items():
+                results[isrc] = mbid
+                cache.set("isrc:" + isrc, mbid)
+
+        try:
+            search_mbids_by_isrc(uncached, deadline, on_chunk=store)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            log.warning("ISRC lookup stopped early", unresolved=sum(1 for isrc in uncached if isrc not in results),
+                        wanted=len(uncached), error=str(e))
+    return results
+
+
+def get_mbid(song_name, artist_name, album=None, isrc=None, deadline=None):
+    """
+    Resolves a song to an MBID, answering from the persistent cache when
+    possible. An ISRC, when given, is tried first as an exact match; the
+    fuzzy text search is the fallback. Both matches and "no match" results
+    are cached; failed requests are not, so they are retried on the next call.
+    deadline (a deadlines.Deadline) bounds every request made.
+    """
+    if normalize_isrc(isrc):
+        mbid = get_mbids_by_isrc([isrc], deadline).get(normalize_isrc(isrc))
+        if mbid:
+            return mbid
+
+    key = mbid_cache.make_key(song_name, artist_name, album)
+    cached, mbid = cache.get(key)
+    if cached:
+        return mbid
+
+    def resolve():
+        mbid = search_mbid(song_name, artist_name, album, deadline)
+        cache.set(key, mbid)
+        return mbid
+
+    # Identical lookups already in flight (here or in another worker) share one search
+    return coalescer.run(key, resolve, lookup=lambda: cache.get(key), deadline=deadline)
@@ -0,0 +1,508 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeout
+from collections import Counter, deque
+from itertools import islice
+import accumulator
+import acousticbrainz
+import deadlines
+import logs
+import telemetry
+import musicbrainz
+import jojo
+import playlist_index
+import playlist_state
+
+ANALYZE_CONCURRENCY = int(os.getenv("ANALYZE_CONCURRENCY", 8)) # Parallel MBID lookups per analysis
+SPOTIFY_PAGE_CONCURRENCY = int(os.getenv("SPOTIFY_PAGE_CONCURRENCY", 4)) # Parallel Spotify page fetches
+PROGRESS_EVERY = 25 # Tracks between progress events
+ANALYSIS_BUDGET = float(os.getenv("ANALYSIS_BUDGET_SECONDS", 60)) # Max seconds per interactive analysis
+BUDGET_RESERVE = 0.25 # Share of the budget kept for fetching features of already resolved tracks
+
+# Fields needed from Spotify for every playlist item
+PLAYLIST_ITEM_FIELDS = 'items(track(id, name, artists(name), album(name), duration_ms, external_ids(isrc))),next,total'
+
+REQUIRED_METRICS = [
+    "averageBPM", "averageDanceability", "uniqueGenreCount",
+    "spotifyTotalDurationMs", "averageRelaxedProbability", "potential"
+]
+
+log = logs.get_logger(__name__)
+
+
+def track_info(item):
+    """
+    Extracts name/artist/album from a playlist item, or None when a field
+    needed for the MBID lookup is missing.
+    """
+    track = item.get('track')
+    # Check essential fields needed for MBID lookup
+    if track and track.get('name') and track.get('artists') and track['artists'][0].get('name') and track.get('album') and track['album'].get('name'):
+        return {
+            "id": track.get('id'),
+            "name": track['name'],
+            "artist": track['artists'][0]['name'],
+            "album": track['album']['name'],
+            "isrc": (track.get('external_ids') or {}).get('isrc'), # Exact MBID lookup when available
+        }
+    # Log if essential info for MBID lookup is missing
+    log.info("Skipping track due to missing name/artist/album data", track=(track or {}).get('name', 'N/A'), sample=True)
+    return None
+
+
+def iter_pages(fetch_page, limit, window=SPOTIFY_PAGE_CONCURRENCY, deadline=None):
+    """
+    Yields every page of a paginated Spotify listing, in order, as it
+    arrives. fetch_page(offset) returns one page; once the first page
+    reveals the total, up to `window` of the following pages are fetched
+    concurrently ahead of the consumer, so at most that many pages are held
+    in memory. Closing the generator drops the pages not yet fetched.
+    With a deadline, raises DeadlineExceeded once it passes between pages.
+    """
+    def page_timeout():
+        return None if deadline is None else deadline.timeout(math.inf)
+
+    page_timeout()
+    first = fetch_page(0)
+    yield first
+    if first.get('next') is None:
+        return
+
+    total = first.get('total')
+    if not isinstance(total, int):
+        # No total to plan with: follow the next links one by one
+        page, fetched = first, 1
+        while page.get('next') is not None:
+            page_timeout()
+            page = fetch_page(fetched * limit)
+            fetched += 1
+            yield page
+        return
+
+    offsets = iter(range(limit, total, limit))
+    pool = ThreadPoolExecutor(max_workers=window)
+    try:
+        in_flight = deque(pool.submit(fetch_page, offset) for offset in islice(offsets, window))
+        while in_flight:
+            try:
+                page = in_flight.popleft().result(timeout=page_timeout())
+            except FutureTimeout:
+                raise deadlines.DeadlineExceeded(f"Time budget of {deadline.seconds}s exhausted") from None
+            for offset in islice(offsets, 1):
+                in_flight.append(pool.submit(fetch_page, offset))
+            yield page
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def fetch_all_pages(fetch_page, limit, deadline=None):
+    """
+    Fetches every page of a paginated Spotify listing, pages after the
+    first concurrently (see iter_pages). Returns the pages in order.
+    """
+    with telemetry.stage("spotify_pagination"):
+        return list(iter_pages(fetch_page, limit, deadline=deadline))
+
+
+def page_tracks(page):
+    """
+    The usable tracks of one page of playlist items, as track_info
+    dictionaries, and the page's total duration.
+    """
+    tracks_info = []
+    duration_ms = 0
+    for item in page['items']:
+        # Add duration of fetched tracks to total
+        track = item.get('track')
+        if track and isinstance(track.get('duration_ms'), int):
+            duration_ms += track['duration_ms']
+        info = track_info(item)
+        if info:
+            tracks_info.append(info)
+    return tracks_info, duration_ms
+
+
+def _playlist_items_page(sp, playlist_id, limit):
+    return lambda offset: sp.playlist_items(playlist_id, limit=limit, offset=offset, fields=PLAYLIST_ITEM_FIELDS)
+
+
+def fetch_playlist_tracks(sp, playlist_id, deadline=None):
+    """
+    Fetches all of a playlist's items, pages in parallel.
+    Returns (tracks_info, total_duration_ms).
+    """
+    limit = 100
+    pages = fetch_all_pages(_playlist_items_page(sp, playlist_id, limit), limit, deadline=deadline)
+
+    tracks_info = []
+    total_duration_ms = 0
+    for page in pages:
+        page_info, duration_ms = page_tracks(page)
+        tracks_info.extend(page_info)
+        total_duration_ms += duration_ms
+
+    return tracks_info, total_duration_ms
+
+
+def stream_playlist_tracks(sp, playlist_id):
+    """
+    Streaming counterpart of fetch_playlist_tracks: turns Spotify pages into
+    events as they arrive, holding no more than the prefetch window of pages
+    (see iter_pages), whatever the playlist's size.
+    Generator of event dictionaries, suitable for streaming as NDJSON:
+      {"type": "tracks", ...}  the usable tracks of each page, in playlist order
+      {"type": "end", ...}     trailer with the track count and total duration
+    """
+    limit = 100
+    track_count = 0
+    total_duration_ms = 0
+    for page in iter_pages(_playlist_items_page(sp, playlist_id, limit), limit):
+        tracks_info, duration_ms = page_tracks(page)
+        track_count += len(tracks_info)
+        total_duration_ms += duration_ms
+        yield {"type": "tracks", "tracks": tracks_info}
+    yield {"type": "end", "track_count": track_count, "total_duration_ms": total_duration_ms}
+
+
+def aggregate_metrics(details):
+    """
+    Averages BPM, danceability and relaxed probability over the tracks that
+    have them and counts unique genres, rounded to 2 decimals (see
+    accumulator.Accumulator.metrics).
+    """
+    return accumulator.Accumulator.from_details(details).metrics()
+
+
+def missing_metrics(metrics):
+    """Required chart metrics that are absent or None."""
+    return [key for key in REQUIRED_METRICS if key not in metrics or metrics[key] is None]
+
+
+def chart_payload(metrics, k=None):
+    """
+    Matches metrics to stands and converts the result to JSON-safe types.
+    When k is given, the k nearest stands (runner-ups included) are returned
+    as well, at no extra matching cost.
+    """
+    with telemetry.stage("stand_matching"):
+        converted_stats, nearest = jojo.get_nearest_stands(metrics, k=k or 1)
+    payload = {
+        "playlist_stats_normalized": converted_stats,
+        "matched_stand": nearest[0]
+    }
+    if k:
+        payload["nearest_stands"] = nearest
+    return payload
+
+
+def chart_columns(records):
+    """
+    Bulk counterpart of chart_payload for many metric records at once.
+    Records are validated like /get_chart, then normalized and matched as one
+    matrix. Results come back in columnar form, aligned with the input; rows
+    that failed validation hold None and are listed under "errors".
+    """
+    errors = []
+    valid_rows = []
+    raw = []
+    for i, record in enumerate(records):
+        if not isinstance(record, dict):
+            errors.append({"index": i, "error": "Metrics record must be an object"})
+            continue
+        missing = missing_metrics(record)
+        if missing:
+            errors.append({"index": i, "error": f"Missing or null required metric(s) for chart generation: {', '.join(missing)}"})
+            continue
+        values = [record[key] for key in jojo.METRIC_KEYS]
+        if not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+            errors.append({"index": i, "error": "Metric values must be numbers"})
+            continue
+        valid_rows.append(i)
+        raw.append(values)
+
+    stats = [None] * len(records)
+    stands = [None] * len(records)
+    distances = [None] * len(records)
+    if raw:
+        import numpy as np # Only bulk scoring needs numpy
+        names, _, _ = jojo.load_stand_table()
+        with telemetry.stage("stand_matching"):
+            converted, indices, dists = jojo.get_jojo_charts(np.array(raw, dtype=np.float64))
+        for row, stat, index, dist in zip(valid_rows, converted.tolist(), indices.tolist(), dists.tolist()):
+            stats[row] = stat
+            stands[row] = names[index]
+            distances[row] = dist
+
+    return {
+        "playlist_stats_normalized": stats,
+        "stand": stands,
+        "distance": distances,
+        "errors": errors,
+    }
+
+
+def _empty_detail(track):
+    return {
+        "name": track["name"], "artist": track["artist"], "mbid": "Not found",
+        "bpm": None, "danceability": None, "genre": "N/A", "relaxedProbability": None,
+    }
+
+
+def _resolve_mbid(track, deadline=None):
+    """The track's MBID, None when MusicBrainz has no match. A failed lookup raises."""
+    try:
+        with telemetry.stage("mbid_resolution"):
+            return musicbrainz.get_mbid(track["name"], track["artist"], track["album"], deadline=deadline)
+    except deadlines.DeadlineExceeded:
+        raise
+    except Exception as e:
+        if deadline is not None:
+            deadline.check(e)
+        log.warning("MBID lookup failed", song=track['name'], artist=track['artist'], error=str(e))
+        raise
+
+
+def _resolve_isrcs(tracks, deadline=None):
+    """Bulk exact lookup for every track with an ISRC. Returns {index: mbid}."""
+    isrcs = {i: musicbrainz.normalize_isrc(t.get("isrc")) for i, t in enumerate(tracks)}
+    isrcs = {i: isrc for i, isrc in isrcs.items() if isrc}
+    if not isrcs:
+        return {}
+    try:
+        with telemetry.stage("mbid_resolution"):
+            found = musicbrainz.get_mbids_by_isrc(isrcs.values(), deadline)
+    except Exception as e:
+        log.warning("ISRC lookup failed, falling back to text search", error=str(e))
+        return {}
+    return {i: found[isrc] for i, isrc in isrcs.items() if found.get(isrc)}
+
+
+def analyze_tracks(tracks, max_workers=ANALYZE_CONCURRENCY, deadline=None):
+    """
+    Resolves MBIDs and acoustic features for a list of tracks.
+    Tracks with an ISRC are resolved exactly, in bulk, first; the rest go
+    through the text search on a bounded thread pool. Resolved MBIDs are sent
+    to the AcousticBrainz bulk endpoints in batches as soon as a batch fills up.
+    Yields (index, detail) for every finished track, in completion order.
+    Tracks whose lookups failed (rather than found no match) are not
+    yielded, so callers treat them as skipped and don't keep a featureless
+    detail for them. With a deadline, stops when it passes: tracks not
+    yielded by then were skipped too, and their upstream calls are cut short
+    rather than waited for.
+    """
+    batch_size = acousticbrainz.BULK_LIMIT
+    by_isrc = _resolve_isrcs(tracks, deadline)
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    pending = {
+        pool.submit(_resolve_mbid, track, deadline): ("mbid", i)
+        for i, track in enumerate(tracks) if i not in by_isrc
+    }
+    waiting = list(by_isrc.items()) # (index, mbid) pairs not yet sent for acoustic data
+
+    def submit_acoustic_batch():
+        batch = waiting[:batch_size]
+        del waiting[:batch_size]
+        future = pool.submit(acousticbrainz.get_acousticbrainz_data_batch, [mbid for _, mbid in batch], deadline=deadline)
+        pending[future] = ("acoustic", batch)
+
+    def in_reserve():
+        return deadline is not None and deadline.remaining() <= deadline.seconds * BUDGET_RESERVE
+
+    def flush_waiting():
+        # Send full batches right away, and the remainder once lookups are
+        # done, or once the budget gets short so slow lookups don't hold it up
+        while len(waiting) >= batch_size:
+            submit_acoustic_batch()
+        if waiting and (in_reserve() or not any(kind == "mbid" for kind, _ in pending.values())):
+            submit_acoustic_batch()
+
+    try:
+        flush_waiting()
+        while pending:
+            timeout = None
+            if deadline is not None:
+                timeout = deadline.remaining()
+                if timeout == 0:
+                    break
+                if waiting and not in_reserve():
+                    # Wake up when the reserve starts, to flush the remainder
+                    timeout -= deadline.seconds * BUDGET_RESERVE
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, payload = pending.pop(future)
+                if kind == "mbid":
+                    try:
+                        mbid = future.result()
+                    except Exception: # Out of time or failed: skipped, retried by the next analysis
+                        continue
+                    if mbid:
+                        waiting.append((payload, mbid))
+                    else:
+                        yield payload, _empty_detail(tracks[payload])
+                    continue
+                try:
+                    features = future.result()
+                except deadlines.DeadlineExceeded:
+                    continue
+                except Exception as e:
+                    log.warning("Acoustic batch failed", error=str(e))
+                    continue
+                for i, mbid in payload:
+                    if mbid.lower() not in features:
+                        continue # Its chunk failed to download
+                    detail = _empty_detail(tracks[i])
+                    detail["mbid"] = mbid
+                    detail.update(features.get(mbid.lower()) or {})
+                    yield i, detail
+            flush_waiting()
+    finally:
+        # Out of time or the consumer went away (e.g. client disconnected):
+        # drop queued work and don't wait for calls still in flight
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def coverage(track_count, skipped):
+    """How much of a playlist the result is based on, and which tracks were left out."""
+    skipped_count = sum(count for _, count in skipped)
+    return {
+        "tracks": track_count,
+        "analyzed": track_count - skipped_count,
+        "ratio": round((track_count - skipped_count) / track_count, 4) if track_count else 1.0,
+        "skipped": [{"name": track["name"], "artist": track["artist"]} for track, _ in skipped],
+    }
+
+
+def _result_event(metrics, details, total_duration_ms, potential, coverage_info=None):
+    metrics = dict(metrics, spotifyTotalDurationMs=total_duration_ms, potential=potential)
+    result = {"type": "result", "metrics": metrics, "tracks": details, "chart": None}
+    if coverage_info is not None:
+        result["coverage"] = coverage_info
+    missing = missing_metrics(metrics)
+    if missing:
+        result["error"] = f"Missing or null required metric(s) for chart generation: {', '.join(missing)}"
+    else:
+        result["chart"] = chart_payload(metrics)
+    return result
+
+
+def index_playlists(entries):
+    """
+    Adds (playlist_id, playlist_name, normalized stats, public) of fully
+    analyzed playlists to the similar-playlists index. A failure is logged, the
+    analysis result doesn't depend on it.
+    """
+    try:
+        playlist_index.index.add_many(entries)
+    except Exception:
+        log.exception("Could not add playlists to the similar-playlists index", playlists=len(entries))
+
+
+def analyze_playlist(sp, playlist_id, potential, max_workers=ANALYZE_CONCURRENCY, state_store=None, deadline=None):
+    """
+    Full server-side analysis: Spotify items -> MBIDs -> acoustic features
+    -> aggregate metrics -> matched stand.
+    The aggregate state of the last analysis is kept per playlist, tagged
+    with Spotify's snapshot_id. An unchanged snapshot is answered from that
+    state; otherwise only the tracks added since are analyzed and removed
+    tracks are subtracted, so the work is proportional to the change.
+    With a deadline (deadlines.Deadline), tracks still unresolved when it
+    passes are skipped: the result is computed from the finished ones and
+    its "coverage" lists what was left out. Running out of time while still
+    paging through the playlist raises DeadlineExceeded.
+    Generator of event dictionaries, suitable for streaming as NDJSON:
+      {"type": "tracks", ...}    once the playlist has been paged through
+      {"type": "progress", ...}  every PROGRESS_EVERY tracks, with partial metrics
+      {"type": "result", ...}    final metrics, track details and chart
+    """
+    playlist = sp.playlist(playlist_id, fields='name,snapshot_id,public')
+    yield from analyze_snapshot(
+        playlist_id, playlist.get('name'), playlist.get('snapshot_id'), potential,
+        lambda: fetch_playlist_tracks(sp, playlist_id, deadline=deadline), max_workers=max_workers, state_store=state_store,
+        deadline=deadline, public=playlist.get('public') is True,
+    )
+
+
+def analyze_snapshot(playlist_id, playlist_name, snapshot_id, potential, fetch_tracks,
+                     max_workers=ANALYZE_CONCURRENCY, state_store=None, deadline=None, public=False):
+    """
+    Spotify-independent part of analyze_playlist for one playlist snapshot.
+    fetch_tracks() returns (tracks_info, total_duration_ms) and is only
+    called when the stored state doesn't already reflect snapshot_id.
+    public is whether the playlist is public on Spotify; only public
+    playlists are offered by /similar_playlists.
+    """
+    store = state_store or playlist_state.store
+    state = store.get(playlist_id)
+
+    if state and snapshot_id and state["snapshot_id"] == snapshot_id:
+        yield {
+            "type": "tracks",
+            "playlist_name": playlist_name,
+            "track_count": len(state["order"]),
+            "total_duration_ms": state["total_duration_ms"],
+            "reused": len(state["order"]),
+            "to_analyze": 0,
+        }
+        yield _result_event(playlist_state.state_metrics(state), playlist_state.state_details(state),
+                            state["total_duration_ms"], potential, coverage(len(state["order"]), []))
+        return
+
+    state = state or playlist_state.empty_state(playlist_id)
+    tracks, total_duration_ms = fetch_tracks()
+    keys = [playlist_state.track_key(track) for track in tracks]
+    wanted = Counter(keys)
+
+    # Subtract removed occurrences and add extra occurrences of known tracks
+    for key in list(state["tracks"]):
+        delta = wanted.get(key, 0) - state["tracks"][key]["count"]
+        if delta:
+            playlist_state.apply_track(state, key, state["tracks"][key]["detail"], delta)
+
+    # Only tracks the state has never seen need MBIDs and acoustic data
+    first_index = {}
+    for i, key in enumerate(keys):
+        if key not in state["tracks"]:
+            first_index.setdefault(key, i)
+    new_tracks = [tracks[i] for i in first_index.values()]
+    new_keys = list(first_index)
+
+    yield {
+        "type": "tracks",
+        "playlist_name": playlist_name,
+        "track_count": len(tracks),
+        "total_duration_ms": total_duration_ms,
+        "reused": len(tracks) - sum(wanted[key] for key in new_keys),
+        "to_analyze": len(new_tracks),
+    }
+
+    done = 0
+    finished = set()
+    for i, detail in analyze_tracks(new_tracks, max_workers=max_workers, deadline=deadline):
+        playlist_state.apply_track(state, new_keys[i], detail, wanted[new_keys[i]])
+        finished.add(i)
+        done += 1
+        if done % PROGRESS_EVERY == 0 and done < len(new_tracks):
+            yield {
+                "type": "progress",
+                "done": done,
+                "total": len(new_tracks),
+                "metrics": playlist_state.state_metrics(state),
+            }
+
+    skipped = [(new_tracks[i], wanted[new_keys[i]]) for i in range(len(new_tracks)) if i not in finished]
+    if skipped:
+        log.warning("Tracks skipped (time budget ran out or lookups failed)", playlist_id=playlist_id,
+                    skipped=len(skipped), to_analyze=len(new_tracks))
+
+    # A partial state is still saved, without a snapshot_id, so the next
+    # analysis reuses the finished tracks and picks up the skipped ones
+    state.update(snapshot_id=None if skipped else snapshot_id, playlist_name=playlist_name,
+                 total_duration_ms=total_duration_ms, order=keys)
+    if snapshot_id:
+        store.put(state)
+
+    result = _result_event(playlist_state.state_metrics(state), playlist_state.state_details(state),
+                           total_duration_ms, potential, coverage(len(tracks), skipped))
+    if result["chart"] and not skipped:
+        index_playlists([(playlist_id, playlist_name, result["chart"]["playlist_stats_normalized"], public)])
+    yield result
@@ -0,0 +1,152 @@
+import os
+from bisect import bisect_left
+import lru
+import pipeline
+
+CATALOG_TTL = int(os.getenv("PLAYLIST_CATALOG_TTL", 600)) # Seconds a session's playlist list is reused
+MAX_CATALOGS = int(os.getenv("PLAYLIST_CATALOG_MAX_SESSIONS", 1000))
+MAX_TRACK_LISTS = int(os.getenv("PLAYLIST_TRACKS_CACHE_SIZE", 200))
+
+
+class PlaylistCatalog:
+    """
+    A user's playlists (id, name, snapshot_id, public) with a sorted name
+    index for case-insensitive exact and prefix lookups.
+    """
+
+    def __init__(self, playlists):
+        self.playlists = [
+            {'id': pl['id'], 'name': pl['name'], 'snapshot_id': pl.get('snapshot_id'),
+             'public': pl.get('public') is True}
+            for pl in playlists if pl and pl.get('id') and pl.get('name') is not None
+        ]
+        self._by_id = {pl['id']: pl for pl in self.playlists}
+        # (lowercase name, position in the user's list), sorted for bisect
+        self._index = sorted((pl['name'].lower(), i) for i, pl in enumerate(self.playlists))
+        self._names = [name for name, _ in self._index]
+
+    def __len__(self):
+        return len(self.playlists)
+
+    def get(self, playlist_id):
+        return self._by_id.get(playlist_id)
+
+    def find(self, query):
+        """
+        Best match for a playlist name: an exact (case-insensitive) match,
+        else the first playlist starting with the query, else the first one
+        containing it. "First" follows the order of the user's library.
+        """
+        query = query.lower()
+        start = bisect_left(self._names, query)
+        if start < len(self._names) and self._names[start] == query:
+            return self.playlists[self._index[start][1]]
+
+        prefixed = []
+        for name, position in self._index[start:]:
+            if not name.startswith(query):
+                break
+            prefixed.append(position)
+        if prefixed:
+            return self.playlists[min(prefixed)]
+
+        for pl in self.playlists:
+            if query in pl['name'].lower():
+                return pl
+        return None
+
+
+_catalogs = lru.LRUCache("playlist_catalog", MAX_CATALOGS)     # session_id -> PlaylistCatalog
+_track_lists = lru.LRUCache("playlist_tracks", MAX_TRACK_LISTS) # (playlist_id, snapshot_id) -> (tracks_info, total_duration_ms)
+
+
+def fetch_catalog(sp, deadline=None):
+    """Pages through the user's playlists (pages in parallel) into a PlaylistCatalog."""
+    limit = 50
+    pages = pipeline.fetch_all_pages(lambda offset: sp.current_user_playlists(limit=limit, offset=offset), limit,
+                                     deadline=deadline)
+    return PlaylistCatalog([pl for page in pages for pl in page['items']])
+
+
+def get_catalog(sp, session_id, deadline=None):
+    """The session's cached catalog, fetched from Spotify when missing or expired."""
+    catalog = _catalogs.get(session_id)
+    if catalog is None:
+        catalog = fetch_catalog(sp, deadline)
+        _catalogs.put(session_id, catalog, ttl=CATALOG_TTL)
+    return catalog
+
+
+def observe_playlists(session_id, playlists):
+    """
+    Checks freshly fetched playlists (e.g. the first page served by
+    /get_playlists) against the cached catalog and drops it when a playlist
+    is new or its snapshot_id changed.
+    """
+    catalog = _catalogs.get(session_id)
+    if catalog is None:
+        return
+    for pl in playlists:
+        cached = catalog.get(pl.get('id'))
+        if cached is None or cached['name'] != pl.get('name') or cached['snapshot_id'] != pl.get('snapshot_id'):
+            _catalogs.pop(session_id)
+            return
+
+
+def invalidate(session_id):
+    _catalogs.pop(session_id)
+
+
+def _current_snapshot_id(sp, playlist_id):
+    """The playlist's snapshot_id as Spotify has it now, in one small request."""
+    return sp.playlist(playlist_id, fields='snapshot_id').get('snapshot_id')
+
+
+def _cached_tracks(sp, playlist_id, snapshot_id):
+    """
+    The track list cached for the playlist, or None. The snapshot_id a
+    caller knows may come from a catalog cached for up to CATALOG_TTL, so a
+    hit is confirmed against Spotify's current snapshot_id before reuse.
+    Returns (cached, snapshot_id) with the snapshot_id that was confirmed.
+    """
+    if not snapshot_id:
+        return None, None
+    cached = _track_lists.get((playlist_id, snapshot_id))
+    if cached is None:
+        return None, snapshot_id
+    current = _current_snapshot_id(sp, playlist_id)
+    if current == snapshot_id:
+        return cached, snapshot_id
+    return None, current
+
+
+def get_playlist_tracks(sp, playlist_id, snapshot_id=None, deadline=None):
+    """
+    A playlist's (tracks_info, total_duration_ms), reused while its
+    snapshot_id is unchanged (see _cached_tracks). Any edit to the playlist
+    changes the snapshot_id, so a track list is only served for the
+    snapshot it was fetched at.
+    """
+    cached, snapshot_id = _cached_tracks(sp, playlist_id, snapshot_id)
+    if cached is None:
+        cached = pipeline.fetch_playlist_tracks(sp, playlist_id, deadline)
+        if snapshot_id:
+            _track_lists.put((playlist_id, snapshot_id), cached)
+    return cached
+
+
+def stream_playlist_tracks(sp, playlist_id, snapshot_id=None):
+    """
+    Streaming counterpart of get_playlist_tracks (see
+    pipeline.stream_playlist_tracks). A track list already cached for the
+    snapshot is replayed in pages; a fresh one isn't cached, since holding
+    it whole is what streaming avoids.
+    """
+    cached, _ = _cached_tracks(sp, playlist_id, snapshot_id)
+    if cached is None:
+        yield from pipeline.stream_playlist_tracks(sp, playlist_id)
+        return
+    tracks_info, total_duration_ms = cached
+    for start in range(0, len(tracks_info), 100):
+        yield {"type": "tracks", "tracks": tracks_info[start:start + 100]}
+    yield {"type": "end", "track_count": len(tracks_info), "total_duration_ms": total_duration_ms}
@@ -0,0 +1,375 @@
+"""
+Nearest-neighbour index of analyzed playlists over their 6 normalized chart
+stats (the vector jojo matches against the stands), for "similar playlists".
+
+Vectors are float32 rows in an append-only file, read through a memory map;
+a SQLite table maps every playlist id to its current row. The index is an
+inverted file (IVF): a playlist is kept in the cell of its nearest centroid
+and a query only scans the cells nearest to it (at least SIMILAR_NPROBE
+non-empty ones). The cells start as one per stand; a cell that outgrows
+SIMILAR_CELL_SIZE is split in two (2-means over its own vectors), so the
+index refines itself where playlists concentrate. An insert appends a row
+and adds it to one cell, and at most splits that cell: nothing is ever
+rebuilt. Re-analyzing a playlist appends a new row; the old one stays in
+the file, unreferenced.
+
+Every analyzed playlist is indexed with its visibility on Spotify, but only
+public ones are ever returned, by query or by vector: private ones are
+filtered out through the SQLite table, like replaced rows.
+
+Several workers can share the files: each one picks up rows appended by the
+others before answering a query, and rows they replaced are filtered out of
+its results through the SQLite table.
+"""
+import os
+import sqlite3
+import struct
+import threading
+import time
+import jojo
+import logs
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DB_PATH = os.path.join(BASE_DIR, "playlist_index.sqlite3")
+DEFAULT_VECTORS_PATH = os.path.join(BASE_DIR, "playlist_vectors.f32")
+
+SIMILAR_NPROBE = int(os.getenv("SIMILAR_NPROBE", 8)) # Non-empty cells scanned per query, at least
+SIMILAR_CELL_SIZE = int(os.getenv("SIMILAR_CELL_SIZE", 1024)) # Vectors per cell before it is split
+
+# Vector file layout: header, then one row of DIMENSIONS float32 per insert
+#   header: magic, version, dimensions
+MAGIC = b"JJPV"
+VERSION = 1
+DIMENSIONS = 6
+HEADER = struct.Struct("<4sHH")
+ROW = struct.Struct(f"<{DIMENSIONS}f")
+ASSIGN_CHUNK = 16384 # Vectors assigned to cells per numpy batch when loading
+SPLIT_ITERATIONS = 4 # 2-means refinement steps when splitting a cell
+
+log = logs.get_logger(__name__)
+
+
+class _Cell:
+    """
+    Rows, vectors and squared vector norms of one IVF cell, in contiguous
+    arrays grown by doubling.
+    """
+
+    def __init__(self, rows, vectors):
+        self.rows = rows
+        self.vectors = vectors
+        self.norms = (vectors ** 2).sum(axis=1)
+        self.size = len(rows)
+
+    def extend(self, rows, vectors):
+        import numpy as np
+        size = self.size + len(rows)
+        if size > len(self.rows):
+            capacity = max(16, 2 * self.size, size)
+            grown_rows = np.empty(capacity, dtype=np.int64)
+            grown_vectors = np.empty((capacity, DIMENSIONS), dtype=np.float32)
+            grown_norms = np.empty(capacity, dtype=np.float32)
+            grown_rows[:self.size] = self.rows[:self.size]
+            grown_vectors[:self.size] = self.vectors[:self.size]
+            grown_norms[:self.size] = self.norms[:self.size]
+            self.rows, self.vectors, self.norms = grown_rows, grown_vectors, grown_norms
+        self.rows[self.size:size] = rows
+        self.vectors[self.size:size] = vectors
+        self.norms[self.size:size] = (vectors ** 2).sum(axis=1)
+        self.size = size
+
+    def remove(self, row):
+        """Removes row if the cell holds it. Returns whether it did."""
+        import numpy as np
+        found = np.flatnonzero(self.rows[:self.size] == row)
+        if not found.size:
+            return False
+        i, last = found[0], self.size - 1
+        self.rows[i] = self.rows[last]
+        self.vectors[i] = self.vectors[last]
+        self.norms[i] = self.norms[last]
+        self.size = last
+        return True
+
+
+class PlaylistIndex:
+    """
+    Vector store and IVF index of analyzed playlists; see the module
+    docstring. The cells are loaded from the files on the first query.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, vectors_path=DEFAULT_VECTORS_PATH, nprobe=SIMILAR_NPROBE,
+                 cell_size=SIMILAR_CELL_SIZE):
+        self.db_path = db_path
+        self.vectors_path = vectors_path
+        self.nprobe = nprobe
+        self.cell_size = cell_size
+        self._local = threading.local() # sqlite3 connections can't be shared across threads
+        self._lock = threading.Lock()
+        self._cells = None
+        self._centroids = None # One row per cell
+        self._centroid_norms = None
+        self._stand_vectors = None
+        self._stands = None
+        self._seen = 0 # Highest row loaded into the cells
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            db_path=os.getenv("PLAYLIST_INDEX_PATH", DEFAULT_DB_PATH),
+            vectors_path=os.getenv("PLAYLIST_VECTORS_PATH", DEFAULT_VECTORS_PATH),
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS playlist_vectors ("
+                " row INTEGER PRIMARY KEY AUTOINCREMENT," # Row in the vector file, plus one
+                " playlist_id TEXT NOT NULL UNIQUE,"
+                " playlist_name TEXT,"
+                " updated_at REAL NOT NULL,"
+                " public INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = [column[1] for column in conn.execute("PRAGMA table_info(playlist_vectors)")]
+            if "public" not in columns:
+                # Indexed before visibility was recorded: hidden until re-analyzed
+                conn.execute("ALTER TABLE playlist_vectors ADD COLUMN public INTEGER NOT NULL DEFAULT 0")
+            self._local.conn = conn
+        return conn
+
+    def _open_vectors(self):
+        """File descriptor of the vector file, created with its header when missing."""
+        fd = os.open(self.vectors_path, os.O_RDWR | os.O_CREAT, 0o644)
+        header = os.pread(fd, HEADER.size, 0)
+        if not header:
+            os.pwrite(fd, HEADER.pack(MAGIC, VERSION, DIMENSIONS), 0)
+        elif header != HEADER.pack(MAGIC, VERSION, DIMENSIONS):
+            os.close(fd)
+            raise ValueError(f"{self.vectors_path} is not a playlist vector file (version {VERSION})")
+        return fd
+
+    def _read_vectors(self, first, last):
+        """Memory-mapped (n, DIMENSIONS) view of rows first to last (inclusive)."""
+        import numpy as np
+        return np.memmap(self.vectors_path, dtype=np.float32, mode="r",
+                         offset=HEADER.size + (first - 1) * ROW.size, shape=(last - first + 1, DIMENSIONS))
+
+    def add_many(self, entries):
+        """
+        Indexes (playlist_id, playlist_name, stats, public) entries, stats
+        being the 6 normalized chart stats and public whether the playlist is
+        public on Spotify; a playlist indexed before is replaced.
+        """
+        entries = [(playlist_id, name, [float(x) for x in stats], bool(public))
+                   for playlist_id, name, stats, public in entries]
+        if not entries:
+            return
+        conn = self._connection()
+        fd = self._open_vectors()
+        replaced = []
+        try:
+            conn.execute("BEGIN IMMEDIATE") # Serializes writers, so rows are appended in order
+            try:
+                for playlist_id, name, stats, public in entries:
+                    old = conn.execute("SELECT row FROM playlist_vectors WHERE playlist_id = ?",
+                                       (playlist_id,)).fetchone()
+                    if old:
+                        conn.execute("DELETE FROM playlist_vectors WHERE row = ?", old)
+                        replaced.append(old[0])
+                    row = conn.execute(
+                        "INSERT INTO playlist_vectors (playlist_id, playlist_name, updated_at, public)"
+                        " VALUES (?, ?, ?, ?)",
+                        (playlist_id, name, time.time(), int(public)),
+                    ).lastrowid
+                    # Written before the commit: a committed row always has its vector
+                    os.pwrite(fd, ROW.pack(*stats), HEADER.size + (row - 1) * ROW.size)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            os.close(fd)
+
+        with self._lock:
+            if self._cells is not None:
+                for row in replaced:
+                    if row <= self._seen:
+                        any(cell.remove(row) for cell in self._cells)
+                self._refresh()
+
+    def add(self, playlist_id, playlist_name, stats, public=False):
+        self.add_many([(playlist_id, playlist_name, stats, public)])
+
+    def _assign(self, vectors, centroids):
+        """Index of the nearest centroid of every vector, in chunks of ASSIGN_CHUNK."""
+        import numpy as np
+        centroid_norms = (centroids ** 2).sum(axis=1)
+        nearest = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), ASSIGN_CHUNK):
+            chunk = np.asarray(vectors[start:start + ASSIGN_CHUNK], dtype=np.float32)
+            # |v - c|^2 without the |v|^2 term, which doesn't change the nearest c
+            distances = centroid_norms - 2 * chunk @ centroids.T
+            nearest[start:start + ASSIGN_CHUNK] = distances.argmin(axis=1)
+        return nearest
+
+    def _load(self):
+        """Builds the cells from the files (once per process)."""
+        import numpy as np
+        names, _, rows = jojo.load_stand_table()
+        matrix = np.asarray(rows, dtype=np.float64)
+        complete = ~np.isnan(matrix).any(axis=1) # Stands with missing grades never match
+        self._stand_vectors = matrix[complete].astype(np.float32)
+        self._stands = [name for name, keep in zip(names, complete) if keep]
+        self._centroids = self._stand_vectors.copy()
+        self._centroid_norms = (self._centroids ** 2).sum(axis=1)
+        empty = (np.empty(0, dtype=np.int64), np.empty((0, DIMENSIONS), dtype=np.float32))
+        self._cells = [_Cell(*empty) for _ in self._stands]
+        self._seen = 0
+        start = time.perf_counter()
+        self._refresh()
+        log.info("Playlist index loaded", entries=self.entries(), cells=len(self._cells),
+                 seconds=round(time.perf_counter() - start, 3))
+
+    def _refresh(self):
+        """Adds the rows committed (by any process) since the last refresh to the cells."""
+        import numpy as np
+        conn = self._connection()
+        conn.execute("BEGIN") # One snapshot for both reads
+        try:
+            last = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'playlist_vectors'").fetchone()
+            last = last[0] if last else 0
+            if last <= self._seen:
+                return
+            rows = np.array([row for row, in conn.execute(
+                "SELECT row FROM playlist_vectors WHERE row > ? AND row <= ? ORDER BY row", (self._seen, last)
+            )], dtype=np.int64)
+        finally:
+            conn.execute("COMMIT")
+        if rows.size:
+            first = int(rows[0])
+            vectors = np.array(self._read_vectors(first, int(rows[-1]))[rows - first])
+            cells = self._assign(vectors, self._centroids)
+            order = np.argsort(cells, kind="stable")
+            bounds = np.searchsorted(cells[order], np.arange(len(self._cells) + 1))
+            grown = []
+            for cell, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:])):
+                if hi > lo:
+                    self._cells[cell].extend(rows[order[lo:hi]], vectors[order[lo:hi]])
+                    grown.append(cell)
+            self._split(grown)
+        self._seen = last
+
+    def _split(self, cells):
+        """Splits the given cells in two, and their halves in turn, until none exceeds cell_size."""
+        import numpy as np
+        pending = [cell for cell in cells if self._cells[cell].size > self.cell_size]
+        while pending:
+            cell = pending.pop()
+            current = self._cells[cell]
+            rows, vectors = current.rows[:current.size], current.vectors[:current.size]
+            # Seeded with a median cut along the widest dimension, then refined (2-means)
+            widest = vectors.var(axis=0).argmax()
+            left = vectors[:, widest] <= np.median(vectors[:, widest])
+            for _ in range(SPLIT_ITERATIONS):
+                if left.all() or not left.any():
+                    break
+                a, b = vectors[left].mean(axis=0), vectors[~left].mean(axis=0)
+                left = ((vectors - a) ** 2).sum(axis=1) <= ((vectors - b) ** 2).sum(axis=1)
+            if left.all() or not left.any():
+                continue # All the vectors are equal
+            self._cells[cell] = _Cell(rows[left], vectors[left])
+            self._cells.append(_Cell(rows[~left], vectors[~left]))
+            self._centroids[cell] = vectors[left].mean(axis=0)
+            self._centroids = np.vstack([self._centroids, vectors[~left].mean(axis=0)])
+            pending += [i for i in (cell, len(self._cells) - 1) if self._cells[i].size > self.cell_size]
+        self._centroid_norms = (self._centroids ** 2).sum(axis=1)
+
+    def entries(self):
+        """Vectors in the loaded cells (replaced ones included until filtered)."""
+        return sum(cell.size for cell in self._cells) if self._cells is not None else 0
+
+    def vector(self, playlist_id):
+        """The indexed stats of a public playlist, or None."""
+        found = self._connection().execute(
+            "SELECT row FROM playlist_vectors WHERE playlist_id = ? AND public = 1", (playlist_id,)
+        ).fetchone()
+        if not found:
+            return None
+        return [float(x) for x in self._read_vectors(found[0], found[0])[0]]
+
+    def query(self, stats, k=10, exclude=None):
+        """
+        The k indexed public playlists nearest to stats (6 normalized chart
+        stats), nearest first, as {"playlist_id", "playlist_name", "distance",
+        "stand"}. The playlist with id exclude, if any, is left out.
+        """
+        import numpy as np
+        vector = np.asarray(stats, dtype=np.float32)
+        with self._lock:
+            if self._cells is None:
+                self._load()
+            else:
+                self._refresh()
+            # Squared distances less |vector|^2, which doesn't change the order
+            order = np.argsort(self._centroid_norms - 2 * (self._centroids @ vector))
+            rows, vectors, distances = [], [], []
+            probed = candidates = 0
+            for cell in order:
+                current = self._cells[cell]
+                if current.size == 0:
+                    continue
+                rows.append(current.rows[:current.size])
+                vectors.append(current.vectors[:current.size])
+                distances.append(current.norms[:current.size] - 2 * (vectors[-1] @ vector))
+                probed += 1
+                candidates += current.size
+                if probed >= self.nprobe and candidates > k:
+                    break
+            if not rows:
+                return []
+            rows, vectors, distances = np.concatenate(rows), np.concatenate(vectors), np.concatenate(distances)
+
+        # Nearest candidates first, widened until k of them are current rows
+        # (replaced rows from other workers and private playlists are skipped)
+        take = min(len(rows), 2 * (k + 1))
+        while True:
+            nearest = np.argpartition(distances, take - 1)[:take] if take < len(rows) else np.arange(len(rows))
+            nearest = nearest[np.argsort(distances[nearest], kind="stable")]
+            current = self._current([int(rows[i]) for i in nearest])
+            found = [i for i in nearest if int(rows[i]) in current and current[int(rows[i])][0] != exclude][:k]
+            if len(found) == k or take == len(rows):
+                stands = self._assign(vectors[found], self._stand_vectors)
+                exact = np.sqrt(((vectors[found] - vector) ** 2).sum(axis=1))
+                return [{
+                    "playlist_id": current[int(rows[i])][0],
+                    "playlist_name": current[int(rows[i])][1],
+                    "distance": float(distance),
+                    "stand": self._stands[stand],
+                } for i, distance, stand in zip(found, exact, stands)]
+            take = min(len(rows), 2 * take)
+
+    def _current(self, rows):
+        """{row: (playlist_id, playlist_name)} for the rows still current, of public playlists."""
+        placeholders = ",".join("?" * len(rows))
+        return {row: (playlist_id, name) for row, playlist_id, name in self._connection().execute(
+            f"SELECT row, playlist_id, playlist_name FROM playlist_vectors WHERE row IN ({placeholders}) AND public = 1",
+            rows
+        )}
+
+    def stats(self):
+        with self._lock:
+            loaded = self._cells is not None
+            return {
+                "loaded": loaded,
+                "entries": self.entries(),
+                "cells": sum(1 for cell in self._cells if cell.size) if loaded else 0,
+                "nprobe": self.nprobe,
+                "cell_size": self.cell_size,
+            }
+
+
+index = PlaylistIndex.from_env()
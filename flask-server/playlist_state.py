@@ -0,0 +1,140 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import accumulator
+import mbid_cache
+
+DEFAULT_STATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "analysis_state.sqlite3")
+
+FEATURES = accumulator.FEATURES
+IGNORED_GENRES = ("Unknown", "N/A")
+
+
+def track_key(track):
+    """Stable identity of a playlist entry: the Spotify id, else name/artist/album."""
+    return track.get("id") or mbid_cache.make_key(track.get("name"), track.get("artist"), track.get("album"))
+
+
+def empty_state(playlist_id):
+    """
+    Mergeable aggregate state of one analyzed playlist:
+      features     accumulator.RunningStats (as a dict) per numeric feature
+      genres       genre -> number of entries carrying it
+      tracks       track key -> {"count": occurrences, "detail": per-track features}
+      order        track keys in playlist order (for listing details)
+    """
+    return {
+        "playlist_id": playlist_id,
+        "snapshot_id": None,
+        "playlist_name": None,
+        "total_duration_ms": 0,
+        "features": {feature: accumulator.RunningStats().to_dict() for feature in FEATURES},
+        "genres": {},
+        "tracks": {},
+        "order": [],
+    }
+
+
+def apply_track(state, key, detail, delta):
+    """
+    Adds (delta > 0) or removes (delta < 0) delta occurrences of a track's
+    contribution to the aggregate.
+    """
+    for feature in FEATURES:
+        value = accumulator.feature_value(detail, feature)
+        if value is not None:
+            stats = accumulator.RunningStats.from_dict(state["features"][feature])
+            stats.add(value, delta)
+            state["features"][feature] = stats.to_dict()
+    genre = detail.get("genre")
+    if genre and genre not in IGNORED_GENRES:
+        remaining = state["genres"].get(genre, 0) + delta
+        if remaining > 0:
+            state["genres"][genre] = remaining
+        else:
+            state["genres"].pop(genre, None)
+
+    entry = state["tracks"].setdefault(key, {"count": 0, "detail": detail})
+    entry["count"] += delta
+    if entry["count"] <= 0:
+        del state["tracks"][key]
+
+
+def upgrade_state(state):
+    """
+    States saved before the features field kept plain sums and counts;
+    their running stats are rebuilt from the stored tracks.
+    """
+    if "features" not in state:
+        acc = accumulator.Accumulator()
+        for entry in state["tracks"].values():
+            acc.add(entry["detail"], entry["count"])
+        state["features"] = {feature: stats.to_dict() for feature, stats in acc.stats.items()}
+        state.pop("sums", None)
+        state.pop("counts", None)
+    return state
+
+
+def state_accumulator(state):
+    """The state's aggregate as an accumulator.Accumulator."""
+    return accumulator.Accumulator.from_dict({
+        "features": state["features"],
+        "genre_mask": accumulator.genre_mask(state["genres"]),
+    })
+
+
+def state_metrics(state):
+    """Aggregate metrics of the state, rounded like aggregate_metrics."""
+    return state_accumulator(state).metrics()
+
+
+def state_details(state):
+    """Per-track details in playlist order."""
+    return [state["tracks"][key]["detail"] for key in state["order"] if key in state["tracks"]]
+
+
+class PlaylistStateStore:
+    """
+    Persists the latest aggregate state of every analyzed playlist in SQLite,
+    keyed by playlist id and tagged with the snapshot_id it reflects.
+    """
+
+    def __init__(self, path=DEFAULT_STATE_PATH):
+        self.path = path
+        self._local = threading.local()
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.getenv("ANALYSIS_STATE_PATH", DEFAULT_STATE_PATH))
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS playlist_state ("
+                " playlist_id TEXT PRIMARY KEY,"
+                " snapshot_id TEXT,"
+                " state TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            self._local.conn = conn
+        return conn
+
+    def get(self, playlist_id):
+        row = self._connection().execute(
+            "SELECT state FROM playlist_state WHERE playlist_id = ?", (playlist_id,)
+        ).fetchone()
+        return upgrade_state(json.loads(row[0])) if row else None
+
+    def put(self, state):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO playlist_state (playlist_id, snapshot_id, state, updated_at) VALUES (?, ?, ?, ?)",
+            (state["playlist_id"], state["snapshot_id"], json.dumps(state), time.time()),
+        )
+
+
+store = PlaylistStateStore.from_env()
@@ -0,0 +1,310 @@
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+import deadlines
+import logs
+
+# Redis is optional; everything falls back to in-process state. The module is
+# slow to import, so it is only loaded once REDIS_URL asks for it.
+redis = None
+
+log = logs.get_logger(__name__)
+
+# GCRA token bucket: the key holds the "theoretical arrival time" (ms) of the
+# next free slot. Every call reserves a slot and returns how long to wait for
+# it, so callers across all workers are served in reservation order. A call
+# that can wait at most ARGV[3] ms (negative: no limit) reserves nothing when
+# the slot is further away.
+_RESERVE_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+local interval = tonumber(ARGV[1])
+local tolerance = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local tat = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tat < now then tat = now end
+local wait = tat - now - tolerance
+if wait < 0 then wait = 0 end
+if max_wait >= 0 and wait > max_wait then
+    return {wait, tat - now}
+end
+local new_tat = tat + interval
+redis.call('SET', KEYS[1], new_tat, 'PX', math.ceil(new_tat - now + 1000))
+return {wait, tat - now}
+"""
+
+_PENALIZE_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+local until_ms = now + tonumber(ARGV[1])
+local tat = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tat < until_ms then
+    redis.call('SET', KEYS[1], until_ms, 'PX', tonumber(ARGV[1]) + 1000)
+end
+return 0
+"""
+
+
+class LocalTokenBucket:
+    """In-process token bucket: rate requests per second, with a burst allowance."""
+
+    def __init__(self, rate, burst=1):
+        self.interval = 1.0 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self._tat = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait=math.inf):
+        """
+        Reserves the next slot. Returns (seconds to wait, backlog in seconds);
+        nothing is reserved when the wait would exceed max_wait.
+        """
+        with self._lock:
+            now = time.monotonic()
+            tat = max(self._tat, now)
+            wait = max(0.0, tat - now - self.tolerance)
+            if wait <= max_wait:
+                self._tat = tat + self.interval
+            return wait, tat - now
+
+    def penalize(self, seconds):
+        """Pushes every pending and future reservation back by at least seconds."""
+        with self._lock:
+            self._tat = max(self._tat, time.monotonic() + seconds)
+
+
+class RedisTokenBucket:
+    """
+    Token bucket shared by every worker through Redis. Falls back to a local
+    bucket whenever Redis can't be reached, so a Redis outage degrades to
+    per-process limiting instead of failing requests.
+    """
+
+    def __init__(self, client, key, rate, burst=1):
+        self.client = client
+        self.key = key
+        self.interval_ms = 1000.0 / rate
+        self.tolerance_ms = (burst - 1) * self.interval_ms
+        self.fallback = LocalTokenBucket(rate, burst)
+        self._reserve = client.register_script(_RESERVE_SCRIPT)
+        self._penalize = client.register_script(_PENALIZE_SCRIPT)
+
+    def reserve(self, max_wait=math.inf):
+        max_wait_ms = -1 if max_wait == math.inf else max_wait * 1000
+        try:
+            wait_ms, backlog_ms = self._reserve(keys=[self.key], args=[self.interval_ms, self.tolerance_ms, max_wait_ms])
+            return float(wait_ms) / 1000.0, float(backlog_ms) / 1000.0
+        except redis.exceptions.RedisError as e:
+            log.warning("Redis unavailable, rate limiting with the local bucket", error=str(e))
+            return self.fallback.reserve(max_wait)
+
+    def penalize(self, seconds):
+        self.fallback.penalize(seconds)
+        try:
+            self._penalize(keys=[self.key], args=[int(seconds * 1000)])
+        except redis.exceptions.RedisError as e:
+            log.warning("Redis unavailable, rate-limit penalty applied locally only", error=str(e))
+
+
+class Coalescer:
+    """
+    Collapses identical in-flight calls. Within a process, concurrent callers
+    with the same key share one Future. Across processes (when a Redis client
+    is given) one worker takes a short lock for the key while the others wait
+    for it to be released and then read the leader's result through `lookup`
+    (e.g. from a shared cache).
+    Only successful results are shared: every caller passes its own fn (bound
+    to its own deadline), and a caller whose leader failed, e.g. on the
+    leader's deadline, runs its own fn instead.
+    """
+
+    def __init__(self, client=None, prefix="coalesce:", lock_ttl=60, poll_interval=0.1):
+        self.client = client
+        self.prefix = prefix
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def run(self, key, fn, lookup=None, deadline=None):
+        """
+        fn()'s result, shared with identical concurrent calls. deadline (a
+        deadlines.Deadline) bounds the time spent waiting for another caller.
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            try:
+                return future.result(timeout=deadline.timeout(math.inf) if deadline else None)
+            except FutureTimeout:
+                raise deadlines.DeadlineExceeded(f"Time budget of {deadline.seconds}s exhausted")
+            except Exception:
+                return fn() # The leader failed: its error may not apply to this caller
+
+        try:
+            result = self._run_shared(key, fn, lookup, deadline)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _run_shared(self, key, fn, lookup, deadline=None):
+        if self.client is None or lookup is None:
+            return fn()
+
+        lock_key = self.prefix + key
+        try:
+            if self.client.set(lock_key, "1", nx=True, ex=self.lock_ttl):
+                try:
+                    return fn()
+                finally:
+                    self.client.delete(lock_key)
+
+            # Another worker is already fetching this key: wait for it to finish,
+            # within the caller's own deadline
+            wait_until = time.monotonic() + self.lock_ttl
+            if deadline is not None:
+                wait_until = min(wait_until, deadline.expires_at)
+            while self.client.exists(lock_key) and time.monotonic() < wait_until:
+                time.sleep(self.poll_interval)
+        except redis.exceptions.RedisError as e:
+            log.warning("Redis unavailable, running coalesced call directly", error=str(e))
+            return fn()
+
+        with self._lock:
+            self.coalesced += 1
+        found, value = lookup()
+        return value if found else fn()
+
+
+class RateLimitedScheduler:
+    """
+    Queues outbound calls to one upstream behind a token bucket and retries
+    rate-limit responses (503/429) with backoff, honouring Retry-After and
+    pausing the shared bucket so every worker slows down together. Server
+    errors (500/502/504) are retried with backoff too, each retry through
+    the bucket like any other call; the HTTP adapter in front of a scheduled
+    upstream must not retry statuses itself (see http_client.mount_scheduled).
+    """
+
+    RETRY_STATUSES = (429, 503)
+    ERROR_STATUSES = (500, 502, 504)
+
+    def __init__(self, bucket, max_retries=3, base_backoff=1.0, max_backoff=30.0):
+        self.bucket = bucket
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self.queue_depth = 0
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_backlog = 0.0
+
+    def _backoff(self, response, attempt):
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.strip().isdigit():
+            return min(float(retry_after), self.max_backoff)
+        backoff = min(self.base_backoff * (2 ** attempt), self.max_backoff)
+        return backoff * random.uniform(0.5, 1.0)
+
+    def _wait_for_slot(self, deadline=None):
+        with self._lock:
+            self.queue_depth += 1
+        wait = backlog = 0.0
+        try:
+            max_wait = deadline.remaining() if deadline is not None else math.inf
+            wait, backlog = self.bucket.reserve(max_wait)
+            if wait > max_wait:
+                # Not reserved: the slot stays free for callers who can wait for it
+                raise deadlines.DeadlineExceeded(f"Rate limit queue ({wait:.1f}s) is longer than the time budget")
+            if wait > 0:
+                time.sleep(wait)
+        finally:
+            with self._lock:
+                self.queue_depth -= 1
+                self.calls += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.last_backlog = backlog
+
+    def call(self, fn, deadline=None):
+        """
+        Runs fn (returning a requests.Response) once a slot is free.
+        With a deadline, raises DeadlineExceeded rather than queue past it.
+        """
+        attempt = 0
+        while True:
+            self._wait_for_slot(deadline)
+            response = fn()
+            throttled = response.status_code in self.RETRY_STATUSES
+            if not throttled and response.status_code not in self.ERROR_STATUSES:
+                return response
+            if throttled:
+                with self._lock:
+                    self.throttled += 1
+            if attempt >= self.max_retries:
+                return response # Caller's raise_for_status() reports the failure
+            pause = self._backoff(response, attempt)
+            if deadline is not None and pause > deadline.remaining():
+                return response
+            if throttled:
+                log.warning("Upstream throttled, pausing before retry", status=response.status_code,
+                            pause_seconds=round(pause, 1))
+                self.bucket.penalize(pause)
+            else:
+                log.warning("Upstream error, retrying", status=response.status_code, pause_seconds=round(pause, 1))
+                time.sleep(pause)
+            attempt += 1
+            with self._lock:
+                self.retries += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self.queue_depth,
+                "calls": self.calls,
+                "retries": self.retries,
+                "throttled_responses": self.throttled,
+                "avg_wait_seconds": self.total_wait / self.calls if self.calls else None,
+                "max_wait_seconds": self.max_wait,
+                "backlog_seconds": self.last_backlog,
+            }
+
+
+def redis_client_from_env():
+    """Redis client for REDIS_URL, or None when unset or redis isn't installed."""
+    global redis
+    url = os.getenv("REDIS_URL")
+    if not url:
+        return None
+    if redis is None:
+        try:
+            import redis as redis_module
+        except ImportError:
+            return None
+        redis = redis_module
+    return redis.Redis.from_url(url, socket_timeout=2, socket_connect_timeout=2)
+
+
+def make_bucket(name, rate, burst=1, client=None):
+    """Shared Redis bucket when a client is available, else an in-process one."""
+    if client is not None:
+        return RedisTokenBucket(client, f"ratelimit:{name}", rate, burst)
+    return LocalTokenBucket(rate, burst)
@@ -1,21 +1,32 @@
-from flask import Flask, request, jsonify, session, redirect, url_for
+from flask import Flask, request, jsonify, session, redirect, url_for, Response, stream_with_context, g
 from flask_cors import CORS
-from spotipy import Spotify
-from spotipy.oauth2 import SpotifyOAuth
-from spotipy.cache_handler import FlaskSessionCacheHandler
 import os
 import sys
+import time
 import requests
 import uuid
+import accumulator
 import acousticbrainz
+import auth
+import chart_cache
+import deadlines
+import http_client
+import logs
+import musicbrainz
+import pipeline
+import playlist_state
+import playlist_index
+import jobs
+import playlist_catalog
 import jojo
+import telemetry
 import json
-import numpy as np
-import pandas as pd
 from dotenv import load_dotenv
 
 load_dotenv()
 
+log = logs.get_logger(__name__)
+
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "default_fallback_secret_key_if_not_set")
 
@@ -33,7 +44,7 @@ CLIENT_ID = os.getenv("SPOTIPY_CLIENT_ID")
 CLIENT_SECRET = os.getenv("SPOTIPY_CLIENT_SECRET")
 
 if not CLIENT_ID or not CLIENT_SECRET:
-    print("Error: SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET must be set in the environment.", file=sys.stderr)
+    log.error("SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET must be set in the environment")
     sys.exit(1) # Exit if credentials aren't found
 
 # Use environment variables for deployment URLs
@@ -48,53 +59,100 @@ SCOPES = [
     "playlist-modify-private"
 ]
 
+# Base URL override for the Spotify Web API, e.g. the benchmark stubs (bench/stubs.py)
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL")
+
+MAX_ACOUSTIC_BATCH = int(os.getenv("MAX_ACOUSTIC_BATCH", 1000)) # MBIDs accepted per batch request
+MAX_CHART_BATCH = int(os.getenv("MAX_CHART_BATCH", 100000)) # Metric records accepted per /get_charts call
+SIMILAR_MAX_K = int(os.getenv("SIMILAR_MAX_K", 100)) # Most similar playlists returned per /similar_playlists call
+MAX_AGGREGATE_RECORDS = int(os.getenv("MAX_AGGREGATE_RECORDS", 100000)) # Tracks plus partials accepted per /aggregate_metrics call
+
+# Publicly cacheable routes: they never touch the session, so their responses
+# carry no Set-Cookie and no Vary: Cookie
+SESSIONLESS_ENDPOINTS = {"get_chart"}
+
 @app.before_request
 def before_request():
+    g.request_start = time.perf_counter()
+    if request.endpoint in SESSIONLESS_ENDPOINTS:
+        return
     if 'session_id' not in session:
         session['session_id'] = str(uuid.uuid4())
 
-cache_handler = FlaskSessionCacheHandler(session)
-sp_oauth = SpotifyOAuth(
-    client_id=CLIENT_ID,
-    client_secret=CLIENT_SECRET,
-    redirect_uri=REDIRECT_URI,
-    scope=" ".join(SCOPES),
-    cache_handler=cache_handler,
-    show_dialog=True
-)
+@app.after_request
+def after_request(response):
+    # Streaming responses are timed up to their headers; their bodies are timed per stage
+    start = g.get('request_start')
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        telemetry.REQUEST_SECONDS.observe(time.perf_counter() - start, route=route, method=request.method,
+                                          status=response.status_code)
+    return response
+
+# Token and API requests share the pooled outbound session (http_client);
+# every request gets its own SpotifyOAuth bound to its own Flask session (see get_oauth)
+token_refresher = auth.TokenRefresher()
+
+
+def spotify_client(token_info):
+    """Spotify API client for a user's token, on the shared connection pool."""
+    from spotipy import Spotify # spotipy (and redis, which it imports) load on first use
+    sp = Spotify(auth=token_info['access_token'], requests_session=http_client.session)
+    if SPOTIFY_API_URL:
+        sp.prefix = SPOTIFY_API_URL
+    return sp
+
+
+def get_oauth():
+    """
+    SpotifyOAuth for the current request, created once per request and bound
+    to that request's session. Nothing OAuth-related is shared between
+    requests, so threaded and gevent workers can't mix up users' sessions.
+    """
+    if 'sp_oauth' not in g:
+        from spotipy.oauth2 import SpotifyOAuth
+        from spotipy.cache_handler import FlaskSessionCacheHandler
+        g.sp_oauth = SpotifyOAuth(
+            client_id=CLIENT_ID,
+            client_secret=CLIENT_SECRET,
+            redirect_uri=REDIRECT_URI,
+            scope=" ".join(SCOPES),
+            cache_handler=FlaskSessionCacheHandler(session._get_current_object()),
+            show_dialog=True,
+            requests_session=http_client.session
+        )
+    return g.sp_oauth
 
 # --- Login, Callback, Get Playlists, Search Playlist Routes (Keep mostly as is) ---
 
 @app.route('/')
 def login():
-    auth_url = sp_oauth.get_authorize_url()
+    auth_url = get_oauth().get_authorize_url()
     return redirect(auth_url)
 
 @app.route("/callback")
 def callback():
     code = request.args.get("code")
-    # Ensure cache handler uses the correct session before getting token
-    sp_oauth.cache_handler = FlaskSessionCacheHandler(session)
     try:
-        token_info = sp_oauth.get_access_token(code, check_cache=False) # Force fetch, don't rely on potentially wrong cache
+        token_info = get_oauth().get_access_token(code, check_cache=False) # Force fetch, don't rely on potentially wrong cache
         session["token_info"] = token_info
         access_token = token_info["access_token"]
 
         # Use environment variable for the frontend URL, crucial for deployment
         frontend_url = os.getenv("FRONTEND_URL")
         if not frontend_url:
-            print("Error: FRONTEND_URL environment variable not set.", file=sys.stderr)
+            log.error("FRONTEND_URL environment variable not set")
             # Fallback or error handling - here we'll default to localhost for dev, but log error
             frontend_url = "http://localhost:3000"
             # In a real production scenario, you might want to return an error page instead.
 
         return redirect(f"{frontend_url}/?token={access_token}")
     except Exception as e:
-        print(f"Error getting token: {e}", file=sys.stderr)
+        log.exception("Error getting token")
         # Use environment variable for the frontend URL on error too
         frontend_url = os.getenv("FRONTEND_URL")
         if not frontend_url:
-            print("Error: FRONTEND_URL environment variable not set.", file=sys.stderr)
+            log.error("FRONTEND_URL environment variable not set")
             frontend_url = "http://localhost:3000" # Fallback for dev
 
         return redirect(f"{frontend_url}/?error=auth_failed")
@@ -116,16 +174,15 @@ def get_valid_token():
         else:
             return None # No token found
 
-    # Ensure cache handler uses the correct session before checking expiry/refreshing
-    sp_oauth.cache_handler = FlaskSessionCacheHandler(session)
-
     # Check if token needs refreshing (requires refresh_token in token_info)
-    if 'refresh_token' in token_info and sp_oauth.is_token_expired(token_info):
+    oauth = get_oauth()
+    if 'refresh_token' in token_info and oauth.is_token_expired(token_info):
         try:
-            token_info = sp_oauth.refresh_access_token(token_info['refresh_token'])
+            # Concurrent requests with the same expired token share one refresh
+            token_info = token_refresher.refresh(oauth, token_info['refresh_token'])
             session['token_info'] = token_info # Update session with new token
         except Exception as e:
-            print(f"Error refreshing token: {e}", file=sys.stderr)
+            log.warning("Error refreshing token", error=str(e))
             # Clear potentially invalid token info and force re-login
             session.pop('token_info', None)
             return None
@@ -140,8 +197,10 @@ def get_playlists():
         return jsonify({'error': 'User not authenticated or token expired'}), 401
 
     try:
-        sp = Spotify(auth=token_info['access_token'])
+        sp = spotify_client(token_info)
         playlists = sp.current_user_playlists()
+        # Drop the cached catalog if any of these playlists changed since it was built
+        playlist_catalog.observe_playlists(session['session_id'], playlists['items'])
         playlists_info = [
             {
                 'name': pl['name'],
@@ -153,7 +212,7 @@ def get_playlists():
         ]
         return jsonify(playlists_info)
     except Exception as e:
-        print(f"Error in get_playlists: {str(e)}", file=sys.stderr)
+        log.exception("Error in get_playlists")
         # Check for specific auth errors if possible
         if "token expired" in str(e).lower():
              session.pop('token_info', None) # Clear expired token
@@ -165,80 +224,47 @@ def search_playlist():
     playlist_name = request.args.get('q')
     if not playlist_name:
         return jsonify({"error": "Please provide a playlist name."}), 400
+    # stream=1: NDJSON with one line per page of tracks, for very large playlists
+    stream = request.args.get('stream', '').lower() in ('1', 'true', 'yes')
 
     token_info = get_valid_token()
     if not token_info:
         return jsonify({'error': 'User not authenticated or token expired'}), 401
 
     try:
-        sp = Spotify(auth=token_info['access_token'])
-
-        # Get user's playlists (same logic as before)
-        user_playlists = []
-        offset = 0
-        limit = 50
-        while True:
-            results = sp.current_user_playlists(limit=limit, offset=offset)
-            user_playlists.extend(results['items'])
-            if results['next'] is None:
-                break
-            offset += limit
-
-        # Find the matching playlist by name (same logic as before)
-        found_playlist = None
-        for pl in user_playlists:
-            if playlist_name.lower() == pl['name'].lower():
-                 found_playlist = pl
-                 break
-        if not found_playlist:
-             for pl in user_playlists:
-                 if playlist_name.lower() in pl['name'].lower():
-                     found_playlist = pl
-                     print(f"Partial match found: {pl['name']}", file=sys.stdout)
-                     break
+        sp = spotify_client(token_info)
 
+        # User's playlist catalog, cached per session
+        catalog = playlist_catalog.get_catalog(sp, session['session_id'])
+
+        # Find the matching playlist by name: exact, then prefix, then partial match
+        found_playlist = catalog.find(playlist_name)
         if not found_playlist:
             return jsonify({"error": f"No playlist found matching '{playlist_name}'."}), 404
+        if found_playlist['name'].lower() != playlist_name.lower():
+            log.debug("Partial playlist match", query=playlist_name, playlist=found_playlist['name'], sample=True)
 
-        playlist_id = found_playlist['id']
         actual_playlist_name = found_playlist['name']
 
-        # Fetch tracks and calculate total duration
-        playlist_tracks_items = []
-        total_duration_ms = 0 # Initialize total duration
-        offset = 0
-        limit = 100
-        # Specify fields to ensure duration_ms is included
-        fields_to_get = 'items(track(name, artists(name), album(name), duration_ms)),next'
-        while True:
-            # Fetch items with specified fields
-            results = sp.playlist_items(playlist_id, limit=limit, offset=offset, fields=fields_to_get)
-            playlist_tracks_items.extend(results['items'])
-
-            # Add duration of fetched tracks to total
-            for item in results['items']:
-                track = item.get('track')
-                if track and isinstance(track.get('duration_ms'), int):
-                    total_duration_ms += track['duration_ms']
-
-            if results['next'] is None:
-                break
-            offset += limit
-
-        # Extract song names, artist names, and album names (still needed for MBID lookup)
-        tracks_info = []
-        for item in playlist_tracks_items:
-            track = item.get('track')
-            # Check essential fields needed for MBID lookup
-            if track and track.get('name') and track.get('artists') and track['artists'][0].get('name') and track.get('album') and track['album'].get('name'):
-                 tracks_info.append({
-                     "name": track['name'],
-                     "artist": track['artists'][0]['name'],
-                     "album": track['album']['name']
-                 })
-            else:
-                 # Log if essential info for MBID lookup is missing
-                 print(f"Skipping track due to missing name/artist/album data: {item.get('track', {}).get('name', 'N/A')}", file=sys.stderr)
+        if stream:
+            def generate():
+                # One JSON record per line: playlist, tracks (one per page), end
+                yield json.dumps({"type": "playlist", "playlist_name": actual_playlist_name}) + "\n"
+                try:
+                    for event in playlist_catalog.stream_playlist_tracks(
+                            sp, found_playlist['id'], found_playlist['snapshot_id']):
+                        yield json.dumps(event) + "\n"
+                except Exception as e:
+                    log.exception("Error in search_playlist stream")
+                    yield json.dumps({"type": "error", "error": f"Failed to process playlist: {str(e)}"}) + "\n"
+
+            return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+        # Fetch tracks (name/artist/album, still needed for MBID lookup) and total duration;
+        # reused while the playlist's snapshot_id is unchanged
+        tracks_info, total_duration_ms = playlist_catalog.get_playlist_tracks(
+            sp, found_playlist['id'], found_playlist['snapshot_id']
+        )
 
         # Return playlist name, tracks, AND total duration
         return jsonify({
@@ -248,7 +274,7 @@ def search_playlist():
         })
 
     except Exception as e:
-        print(f"Error in search_playlist: {str(e)}", file=sys.stderr)
+        log.exception("Error in search_playlist")
         if "token expired" in str(e).lower():
              session.pop('token_info', None)
              return jsonify({'error': 'Spotify token expired, please login again'}), 401
@@ -260,77 +286,45 @@ def get_mbid_route(): # Renamed function to avoid conflict
     song_name = request.args.get("song_name")
     artist_name = request.args.get("artist_name")
     album = request.args.get("album") # Keep album for better matching
+    isrc = request.args.get("isrc") # Exact match, tried before the text search
 
     if not song_name or not artist_name: # Album is helpful but not strictly required for the query
         return jsonify({"error": "Please provide song_name and artist_name"}), 400
 
-    # Construct the query, prioritizing matches with all three fields
-    query_parts = [f'recording:"{song_name}"', f'artist:"{artist_name}"']
-    if album:
-        query_parts.append(f'release:"{album}"') # Use release for album matching in recordings
-
-    query = " AND ".join(query_parts)
-
-    url = "https://musicbrainz.org/ws/2/recording/"
-    params = {
-        "query": query,
-        "fmt": "json",
-        "limit": 10 # Get a few results to potentially check score later if needed
-    }
-    headers = {
-        "User-Agent": "SpotifyPlaylistAnalyzer/1.0 ( your-email@example.com )" # Be a good citizen
-    }
-
-    print(f"Querying MusicBrainz: {url} with params {params}") # Debugging
-
     try:
-        response = requests.get(url, params=params, headers=headers, timeout=10) # Add timeout
-        response.raise_for_status() # Raise HTTP errors
-
-        data = response.json()
-        recordings = data.get("recordings", [])
-
-        if recordings:
-            # Simple approach: take the first result's ID.
-            # More robust: check scores if available, or filter further if needed.
-            mbid = recordings[0].get("id")
-            if mbid:
-                 print(f"MBID found: {mbid} for {song_name} / {artist_name}")
-                 return jsonify({"mbid": mbid})
-            else:
-                 print(f"No MBID in first recording for {song_name} / {artist_name}")
-                 return jsonify({"error": "No MBID found in recording data"}), 404
-        else:
-            print(f"No recordings found for query: {query}")
-             # Try a broader query without the album as a fallback
-            if album:
-                print("Retrying MBID search without album...")
-                query_simple = f'recording:"{song_name}" AND artist:"{artist_name}"'
-                params_simple = {"query": query_simple, "fmt": "json", "limit": 1}
-                response_simple = requests.get(url, params=params_simple, headers=headers, timeout=10)
-                response_simple.raise_for_status()
-                data_simple = response_simple.json()
-                recordings_simple = data_simple.get("recordings", [])
-                if recordings_simple and recordings_simple[0].get("id"):
-                    mbid_simple = recordings_simple[0].get("id")
-                    print(f"MBID found (without album): {mbid_simple} for {song_name} / {artist_name}")
-                    return jsonify({"mbid": mbid_simple})
-                else:
-                     print(f"No recordings found even without album for: {song_name} / {artist_name}")
-
-            return jsonify({"error": "No recordings found matching the criteria"}), 404
+        # Served from the persistent MBID cache when this song was resolved before
+        mbid = musicbrainz.get_mbid(song_name, artist_name, album, isrc=isrc)
+        if mbid:
+            return jsonify({"mbid": mbid})
+        return jsonify({"error": "No recordings found matching the criteria"}), 404
 
     except requests.exceptions.Timeout:
-        print(f"MusicBrainz request timed out for query: {query}")
+        log.warning("MusicBrainz request timed out", song=song_name, artist=artist_name)
         return jsonify({"error": "MusicBrainz request timed out"}), 504 # Gateway Timeout
     except requests.exceptions.RequestException as e:
-        print(f"Error fetching data from MusicBrainz: {e}")
+        log.warning("Error fetching data from MusicBrainz", error=str(e))
         return jsonify({"error": f"Failed to fetch data from MusicBrainz: {e}"}), 502 # Bad Gateway
     except Exception as e:
-        print(f"Unexpected error in get_mbid_route: {e}")
+        log.exception("Unexpected error in get_mbid_route")
         return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(telemetry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify({
+        "mbid_cache": musicbrainz.cache.stats(),
+        "musicbrainz_scheduler": dict(musicbrainz.scheduler.stats(), coalesced=musicbrainz.coalescer.coalesced),
+        "upstreams": http_client.host_stats(),
+        "chart_cache": chart_cache.stats(),
+        "playlist_index": playlist_index.index.stats(),
+    })
+
+
 # --- ADD NEW ACOUSTIC DATA ROUTE ---
 @app.route("/get_acoustic_data", methods=["GET"])
 def get_acoustic_data():
@@ -347,63 +341,296 @@ def get_acoustic_data():
             # Provide specific reasons if possible, otherwise generic
             return jsonify({"error": "No acoustic data available or error fetching data"}), 404
     except Exception as e:
-        print(f"Error fetching acoustic data for MBID {mbid}: {str(e)}", file=sys.stderr)
+        log.exception("Error fetching acoustic data", mbid=mbid)
+        return jsonify({"error": f"Server error fetching acoustic data: {str(e)}"}), 500
+
+@app.route("/get_acoustic_data", methods=["POST"])
+def get_acoustic_data_batch():
+    body = request.get_json(silent=True) or {}
+    mbids = body.get("mbids")
+
+    if not isinstance(mbids, list) or not mbids:
+        return jsonify({"error": "Please provide a non-empty list of MBIDs"}), 400
+    if len(mbids) > MAX_ACOUSTIC_BATCH:
+        return jsonify({"error": f"At most {MAX_ACOUSTIC_BATCH} MBIDs can be requested at once"}), 400
+
+    try:
+        results = acousticbrainz.get_acousticbrainz_data_batch([str(m) for m in mbids if m])
+        # Misses are kept in the result map as null and listed separately;
+        # MBIDs whose download failed are only listed, to be retried
+        missing = [mbid for mbid, data in results.items() if data is None]
+        failed = list(dict.fromkeys(str(m).lower() for m in mbids if m and str(m).lower() not in results))
+        return jsonify({"results": results, "missing": missing, "failed": failed})
+    except Exception as e:
+        log.exception("Error fetching acoustic data batch", mbids=len(mbids))
         return jsonify({"error": f"Server error fetching acoustic data: {str(e)}"}), 500
 
+def parse_budget(value):
+    """
+    Deadline for an interactive analysis: the requested budget in seconds,
+    capped by ANALYSIS_BUDGET_SECONDS (also the default). None if invalid.
+    """
+    try:
+        budget = float(value) if value is not None else pipeline.ANALYSIS_BUDGET
+    except ValueError:
+        return None
+    if not budget > 0:
+        return None
+    return deadlines.Deadline(min(budget, pipeline.ANALYSIS_BUDGET))
+
+def parse_potential(value):
+    """The potential slider value as an int in 1-6, or None if invalid."""
+    try:
+        potential = int(value)
+    except (TypeError, ValueError):
+        return None
+    return potential if 1 <= potential <= 6 else None
+
+@app.route("/analyze_playlist", methods=["GET"])
+def analyze_playlist():
+    playlist_id = request.args.get("playlist_id")
+    if not playlist_id:
+        return jsonify({"error": "Please provide a playlist_id."}), 400
+    potential = parse_potential(request.args.get("potential", 3))
+    if potential is None:
+        return jsonify({"error": "potential must be an integer between 1 and 6."}), 400
+
+    token_info = get_valid_token()
+    if not token_info:
+        return jsonify({'error': 'User not authenticated or token expired'}), 401
+
+    sp = spotify_client(token_info)
+    deadline = parse_budget(request.args.get("budget"))
+    if deadline is None:
+        return jsonify({"error": "budget must be a positive number of seconds."}), 400
+
+    def generate():
+        # One JSON event per line: tracks, progress (with partial metrics), result
+        try:
+            for event in pipeline.analyze_playlist(sp, playlist_id, potential, deadline=deadline):
+                yield json.dumps(event) + "\n"
+        except Exception as e:
+            log.exception("Error in analyze_playlist")
+            yield json.dumps({"type": "error", "error": f"Failed to analyze playlist: {str(e)}"}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+@app.route("/analyze_library", methods=["GET"])
+def analyze_library():
+    potential = parse_potential(request.args.get("potential", 3))
+    if potential is None:
+        return jsonify({"error": "potential must be an integer between 1 and 6."}), 400
+
+    token_info = get_valid_token()
+    if not token_info:
+        return jsonify({'error': 'User not authenticated or token expired'}), 401
+
+    import library # numpy-backed; loaded on first use to keep worker start-up lean
+
+    sp = spotify_client(token_info)
+    session_id = session['session_id']
+    deadline = parse_budget(request.args.get("budget"))
+    if deadline is None:
+        return jsonify({"error": "budget must be a positive number of seconds."}), 400
+
+    def generate():
+        # One JSON event per line: library, progress, result (one entry per playlist)
+        try:
+            for event in library.analyze_library(sp, session_id, potential, deadline=deadline):
+                yield json.dumps(event) + "\n"
+        except Exception as e:
+            log.exception("Error in analyze_library")
+            yield json.dumps({"type": "error", "error": f"Failed to analyze library: {str(e)}"}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    body = request.get_json(silent=True) or {}
+    playlist_id = body.get("playlist_id")
+    if not playlist_id:
+        return jsonify({"error": "Please provide a playlist_id."}), 400
+    potential = parse_potential(body.get("potential", 3))
+    if potential is None:
+        return jsonify({"error": "potential must be an integer between 1 and 6."}), 400
+
+    token_info = get_valid_token()
+    if not token_info:
+        return jsonify({'error': 'User not authenticated or token expired'}), 401
+
+    try:
+        sp = spotify_client(token_info)
+        playlist = sp.playlist(playlist_id, fields='name,snapshot_id,public')
+        payload = {
+            "playlist_id": playlist_id,
+            "playlist_name": playlist.get('name'),
+            "snapshot_id": playlist.get('snapshot_id'),
+            "public": playlist.get('public') is True,
+            "potential": potential,
+            "tracks": None,
+            "total_duration_ms": None,
+        }
+
+        def prepare(payload):
+            # Workers have no Spotify token: hand them the track list, unless
+            # the stored analysis already reflects this snapshot
+            state = playlist_state.store.get(playlist_id)
+            if not state or state["snapshot_id"] != payload["snapshot_id"]:
+                payload["tracks"], payload["total_duration_ms"] = playlist_catalog.get_playlist_tracks(
+                    sp, playlist_id, payload["snapshot_id"]
+                )
+
+        job_id, deduplicated = jobs.get_queue().submit(payload, prepare=prepare)
+        return jsonify({"job_id": job_id, "deduplicated": deduplicated}), 202
+    except Exception as e:
+        log.exception("Error in submit_job")
+        if "token expired" in str(e).lower():
+             session.pop('token_info', None)
+             return jsonify({'error': 'Spotify token expired, please login again'}), 401
+        return jsonify({'error': f'Failed to submit analysis job: {str(e)}'}), 500
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = jobs.get_queue().get(job_id)
+    if job is None:
+        return jsonify({"error": "No such job (it may have expired)."}), 404
+    return jsonify(job)
+
 @app.route("/get_chart", methods=["GET"])
 def get_chart():
     data_str = request.args.get("data")
     if not data_str:
         return jsonify({"error": "Please provide playlist metrics data"}), 400
 
+    k = request.args.get("k") # Optional: also return the k nearest stands
+    if k is not None:
+        if not k.isdigit() or int(k) < 1:
+            return jsonify({"error": "k must be a positive integer"}), 400
+        k = int(k)
+
     try:
         # Parse the JSON string received from the frontend
         playlist_metrics = json.loads(data_str)
-        print(f"Received metrics for chart generation: {playlist_metrics}", file=sys.stdout) # Log received data
 
         # --- Data Validation ---
-        required_keys = [
-            "averageBPM", "averageDanceability", "uniqueGenreCount",
-            "spotifyTotalDurationMs", "averageRelaxedProbability", "potential"
-        ]
         # Check if all required keys are present and have non-null values
-        missing_or_null_keys = [
-            key for key in required_keys
-            if key not in playlist_metrics or playlist_metrics[key] is None
-        ]
+        missing_or_null_keys = pipeline.missing_metrics(playlist_metrics)
 
         if missing_or_null_keys:
              error_message = f"Missing or null required metric(s) for chart generation: {', '.join(missing_or_null_keys)}"
-             print(error_message, file=sys.stderr)
+             log.info("Rejected chart request", missing=missing_or_null_keys, sample=True)
              return jsonify({"error": error_message}), 400
 
-        # --- Call jojo.py ---
-        converted_stats, stand_data = jojo.get_jojo_chart(playlist_metrics)
-
-        # --- Prepare Response ---
-        # Ensure numpy arrays/types are converted to standard Python types for JSON serialization
-        response_data = {
-            "playlist_stats_normalized": converted_stats.tolist() if isinstance(converted_stats, np.ndarray) else converted_stats,
-            "matched_stand": stand_data.to_dict() if hasattr(stand_data, 'to_dict') else stand_data # Assuming stand_data is a Pandas Series/DataFrame row
-        }
-
-        print(f"Sending chart data: {response_data}", file=sys.stdout) # Log response data
-        return jsonify(response_data)
+        # --- Memoized chart; unchanged charts are revalidated without a body ---
+        key = chart_cache.chart_key(playlist_metrics, k)
+        tag = chart_cache.etag(key)
+        if request.if_none_match.contains(tag):
+            response = Response(status=304)
+        else:
+            response = Response(chart_cache.get_chart(playlist_metrics, k, key), mimetype="application/json")
+        response.set_etag(tag)
+        response.vary.add("Origin") # Access-Control-Allow-Origin echoes the request's origin
+        response.cache_control.public = True
+        response.cache_control.max_age = chart_cache.CHART_MAX_AGE
+        return response
 
     except json.JSONDecodeError:
-        print(f"Error decoding JSON data: {data_str}", file=sys.stderr)
+        log.info("Invalid JSON in chart request", length=len(data_str), sample=True)
         return jsonify({"error": "Invalid JSON format in data parameter"}), 400
     except KeyError as e:
-        print(f"Missing key in input data for jojo function: {e}", file=sys.stderr)
+        log.info("Missing key in chart request", key=str(e), sample=True)
         return jsonify({"error": f"Missing expected metric in input data: {e}"}), 400
     except Exception as e:
-        print(f"Error in get_chart: {str(e)}", file=sys.stderr)
-        # Log the full traceback for debugging if possible
-        import traceback
-        traceback.print_exc(file=sys.stderr)
+        log.exception("Error in get_chart")
         return jsonify({"error": f"Failed to generate chart: {str(e)}"}), 500
 
 
+@app.route("/get_charts", methods=["POST"])
+def get_charts():
+    body = request.get_json(silent=True)
+    records = body.get("metrics") if isinstance(body, dict) else body
+
+    if not isinstance(records, list) or not records:
+        return jsonify({"error": "Please provide a non-empty list of playlist metrics"}), 400
+    if len(records) > MAX_CHART_BATCH:
+        return jsonify({"error": f"At most {MAX_CHART_BATCH} metric records can be scored at once"}), 400
+
+    try:
+        return jsonify(pipeline.chart_columns(records))
+    except Exception as e:
+        log.exception("Error in get_charts")
+        return jsonify({"error": f"Failed to generate charts: {str(e)}"}), 500
+
+@app.route("/aggregate_metrics", methods=["POST"])
+def aggregate_metrics():
+    """
+    Playlist metrics of per-track details ("tracks") and/or partial
+    accumulators from other workers ("partials", as returned in
+    "accumulator"), merged into one.
+    """
+    body = request.get_json(silent=True) or {}
+    tracks = body.get("tracks") or []
+    partials = body.get("partials") or []
+
+    if not isinstance(tracks, list) or not isinstance(partials, list) or not (tracks or partials):
+        return jsonify({"error": "Please provide a non-empty list of tracks or partial accumulators"}), 400
+    if len(tracks) + len(partials) > MAX_AGGREGATE_RECORDS:
+        return jsonify({"error": f"At most {MAX_AGGREGATE_RECORDS} tracks and partials can be aggregated at once"}), 400
+
+    try:
+        acc = accumulator.Accumulator.from_details([t for t in tracks if isinstance(t, dict)])
+        for partial in partials:
+            acc.merge(accumulator.Accumulator.from_dict(partial))
+    except (TypeError, ValueError, KeyError, AttributeError, OverflowError) as e:
+        return jsonify({"error": f"Invalid partial accumulator: {str(e)}"}), 400
+    return jsonify({
+        "metrics": acc.metrics(),
+        "feature_stats": acc.feature_stats(),
+        "accumulator": acc.to_dict(),
+    })
+
+@app.route("/similar_playlists", methods=["GET"])
+def similar_playlists():
+    """
+    The k analyzed public playlists most similar to an indexed public
+    playlist (playlist_id) or to playlist metrics (data, as for /get_chart).
+    """
+    playlist_id = request.args.get("playlist_id")
+    data_str = request.args.get("data")
+    if not playlist_id and not data_str:
+        return jsonify({"error": "Please provide a playlist_id or playlist metrics data"}), 400
+    k = request.args.get("k", "10")
+    if not k.isdigit() or not 1 <= int(k) <= SIMILAR_MAX_K:
+        return jsonify({"error": f"k must be an integer between 1 and {SIMILAR_MAX_K}"}), 400
+    k = int(k)
+
+    token_info = get_valid_token()
+    if not token_info:
+        return jsonify({'error': 'User not authenticated or token expired'}), 401
+
+    if playlist_id:
+        stats = playlist_index.index.vector(playlist_id)
+        if stats is None:
+            return jsonify({"error": f"Playlist {playlist_id} is not public or has not been analyzed yet."}), 404
+    else:
+        try:
+            playlist_metrics = json.loads(data_str)
+            missing = pipeline.missing_metrics(playlist_metrics)
+            if missing:
+                return jsonify({"error": f"Missing or null required metric(s): {', '.join(missing)}"}), 400
+            stats = jojo.normalize_metrics(playlist_metrics)
+        except json.JSONDecodeError:
+            return jsonify({"error": "Invalid JSON format in data parameter"}), 400
+        except (KeyError, TypeError, AttributeError) as e:
+            return jsonify({"error": f"Invalid playlist metrics: {e}"}), 400
+
+    try:
+        similar = playlist_index.index.query(stats, k, exclude=playlist_id)
+        return jsonify({"playlist_stats_normalized": stats, "similar": similar})
+    except Exception as e:
+        log.exception("Error in similar_playlists")
+        return jsonify({"error": f"Failed to find similar playlists: {str(e)}"}), 500
+
 if __name__ == '__main__':
     # Use 0.0.0.0 to be accessible from other devices on the network if needed
     # Use a specific port if 5000 is taken
@@ -0,0 +1,135 @@
+"""
+Prebuilt stand table: jojo-stands.csv compiled into a small binary file
+that loads without pandas (or numpy) in microseconds.
+
+Rebuild it whenever the CSV changes:
+    python stand_table.py
+A missing or out-of-date file (its CSV digest no longer matches) is
+replaced by compiling the CSV at load time, which is slower but equivalent.
+"""
+import argparse
+import csv
+import hashlib
+import io
+import math
+import os
+import struct
+import sys
+import logs
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CSV_PATH = os.path.join(BASE_DIR, "jojo-stands.csv")
+DEFAULT_TABLE_PATH = os.path.join(BASE_DIR, "jojo-stands.bin")
+CSV_ENCODING = "ISO-8859-1"
+
+# Letter grades and their chart values: E (16.7) to Infinite (100). "None" and
+# empty grades are missing (NaN), as pandas read them: such stands never match.
+GRADES = {grade: i * 100 / 6 for i, grade in enumerate(['E', 'D', 'C', 'B', 'A', 'Infi'], start=1)}
+MISSING = ("", "None")
+STAT_COUNT = 6
+
+# File layout: header, text block, then the grades as float64 (NaN when missing),
+# STAT_COUNT per stand in column order.
+#   header: magic, version, stand count, SHA-1 of the CSV it was built from, text block length
+#   text:   UTF-8 stat column names, then stand names, separated by \x1f
+MAGIC = b"JJST"
+VERSION = 1
+HEADER = struct.Struct("<4sHH20sI")
+SEPARATOR = "\x1f"
+
+log = logs.get_logger(__name__)
+
+
+def csv_digest(data):
+    return hashlib.sha1(data).digest()
+
+
+def _grade(value):
+    if value in MISSING:
+        return math.nan
+    return GRADES[value]
+
+
+def compile_csv(data):
+    """
+    Parses the stand CSV (bytes). Returns (names, columns, rows): stand
+    names, stat column names (PER renamed to STM) and one tuple of
+    STAT_COUNT grade values per stand.
+    """
+    reader = csv.reader(io.StringIO(data.decode(CSV_ENCODING)))
+    header = next(reader)
+    columns = ['STM' if x == 'PER' else x for x in header[1:1 + STAT_COUNT]]
+    names, rows = [], []
+    for record in reader:
+        if not record:
+            continue
+        names.append(record[0])
+        rows.append(tuple(_grade(value) for value in record[1:1 + STAT_COUNT]))
+    return names, columns, tuple(rows)
+
+
+def pack_table(names, columns, rows, digest):
+    text = SEPARATOR.join(list(columns) + list(names)).encode("utf-8")
+    values = [value for row in rows for value in row]
+    return (HEADER.pack(MAGIC, VERSION, len(names), digest, len(text)) + text
+            + struct.pack(f"<{len(values)}d", *values))
+
+
+def unpack_table(data):
+    """Returns (names, columns, rows, csv digest) from a packed table."""
+    magic, version, count, digest, text_length = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a stand table file, or an unsupported version")
+    text = data[HEADER.size:HEADER.size + text_length].decode("utf-8").split(SEPARATOR)
+    columns, names = text[:STAT_COUNT], text[STAT_COUNT:]
+    values = struct.unpack_from(f"<{count * STAT_COUNT}d", data, HEADER.size + text_length)
+    rows = tuple(values[i:i + STAT_COUNT] for i in range(0, len(values), STAT_COUNT))
+    return names, columns, rows, digest
+
+
+def build(csv_path=DEFAULT_CSV_PATH, table_path=DEFAULT_TABLE_PATH):
+    """Compiles the CSV into table_path (written next to it, then renamed into place)."""
+    with open(csv_path, "rb") as f:
+        data = f.read()
+    names, columns, rows = compile_csv(data)
+    tmp_path = table_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(pack_table(names, columns, rows, csv_digest(data)))
+    os.replace(tmp_path, table_path)
+    return len(names)
+
+
+def load(csv_path=DEFAULT_CSV_PATH, table_path=DEFAULT_TABLE_PATH):
+    """
+    (names, columns, rows) from the prebuilt table when it matches the CSV
+    (or there is no CSV to check against), else compiled from the CSV.
+    """
+    try:
+        with open(csv_path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        data = None
+    try:
+        with open(table_path, "rb") as f:
+            names, columns, rows, digest = unpack_table(f.read())
+        if data is None or digest == csv_digest(data):
+            return names, columns, rows
+    except (OSError, ValueError, struct.error):
+        if data is None:
+            raise
+    log.warning("Prebuilt stand table missing or out of date, compiling the CSV; rebuild it with stand_table.py",
+                path=table_path)
+    return compile_csv(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile jojo-stands.csv into the prebuilt stand table.")
+    parser.add_argument("--csv", default=DEFAULT_CSV_PATH)
+    parser.add_argument("--output", default=DEFAULT_TABLE_PATH)
+    args = parser.parse_args()
+    count = build(args.csv, args.output)
+    print(f"Wrote {count} stands to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
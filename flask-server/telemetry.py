@@ -0,0 +1,176 @@
+"""
+In-process metrics in the Prometheus text format, served by /metrics.
+
+Counters and histograms are updated on the hot path; values that other
+modules already track (cache and scheduler stats, circuit states) are read
+by collectors when the endpoint is scraped. Metrics are per process: with
+several gunicorn workers, each scrape sees the worker that served it.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+_registry = []
+_collectors = []
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic count per label set."""
+
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_label_key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, key, value
+
+
+class Histogram:
+    """Fixed-bucket distribution (e.g. latency in seconds) per label set."""
+
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {} # label key -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the with-block, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self, **labels):
+        """Cumulative counts per upper bound, with sum and count, for one label set."""
+        with self._lock:
+            series = self._series.get(_label_key(labels))
+            counts, total_sum, count = (list(series[0]), series[1], series[2]) if series else ([0] * len(self.buckets), 0.0, 0)
+        cumulative, running = [], 0
+        for n in counts:
+            running += n
+            cumulative.append(running)
+        # The last bound is written "+Inf", as in the text format: JSON has no infinity
+        bounds = [_format_value(bound) if bound == float("inf") else bound for bound in self.buckets]
+        return {"buckets": list(zip(bounds, cumulative)), "sum": total_sum, "count": count}
+
+    def label_sets(self):
+        with self._lock:
+            return [dict(key) for key in self._series]
+
+    def samples(self):
+        with self._lock:
+            series = {key: (list(s[0]), s[1], s[2]) for key, s in self._series.items()}
+        for key, (counts, total_sum, count) in sorted(series.items()):
+            running = 0
+            for bound, n in zip(self.buckets, counts):
+                running += n
+                yield self.name + "_bucket", key + (("le", _format_value(bound)),), running
+            yield self.name + "_sum", key, total_sum
+            yield self.name + "_count", key, count
+
+
+def counter(name, help):
+    metric = Counter(name, help)
+    _registry.append(metric)
+    return metric
+
+
+def histogram(name, help, buckets=LATENCY_BUCKETS):
+    metric = Histogram(name, help, buckets)
+    _registry.append(metric)
+    return metric
+
+
+def register_collector(fn):
+    """
+    fn() is called on every scrape and returns [(name, type, help, samples)],
+    samples being [(labels dict, value)]. Use for values kept elsewhere.
+    """
+    _collectors.append(fn)
+    return fn
+
+
+# --- Shared metrics ---
+REQUEST_SECONDS = histogram("http_request_duration_seconds",
+                            "Time to response headers per route (streaming bodies continue after)")
+STAGE_SECONDS = histogram("analysis_stage_seconds",
+                          "Time per analysis stage: spotify_pagination, mbid_resolution, acoustic_fetch, stand_matching")
+CACHE_LOOKUPS = counter("cache_lookups_total", "Cache lookups by cache and result (hit/miss)")
+CACHE_EVICTIONS = counter("cache_evictions_total", "Entries dropped by cache to stay within its size bound")
+
+
+def stage(name):
+    """Context manager timing one analysis stage."""
+    return STAGE_SECONDS.time(stage=name)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in list(_registry):
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, key, value in metric.samples():
+            lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+    for collect in list(_collectors):
+        for name, kind, help, samples in collect():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if value is not None:
+                    lines.append(f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,26 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+# The app modules read their configuration at import time: keep their stores
+# out of the working tree and away from any Redis
+_tmp = tempfile.mkdtemp(prefix="flask-server-tests-")
+atexit.register(shutil.rmtree, _tmp, ignore_errors=True)
+os.environ.update({
+    "SPOTIPY_CLIENT_ID": "test",
+    "SPOTIPY_CLIENT_SECRET": "test",
+    "MBID_CACHE_PATH": os.path.join(_tmp, "mbid.sqlite3"),
+    "ANALYSIS_STATE_PATH": os.path.join(_tmp, "state.sqlite3"),
+    "JOBS_DB_PATH": os.path.join(_tmp, "jobs.sqlite3"),
+    "PLAYLIST_INDEX_PATH": os.path.join(_tmp, "playlist-index.sqlite3"),
+    "PLAYLIST_VECTORS_PATH": os.path.join(_tmp, "playlist-vectors.f32"),
+    "FEATURE_STORE_PATH": os.path.join(_tmp, "no-feature-store.bin"),
+    "FRONTEND_URL": "http://frontend.test",
+    "LOG_LEVEL": "ERROR",
+})
+os.environ.pop("REDIS_URL", None)
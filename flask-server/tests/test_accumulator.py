@@ -0,0 +1,40 @@
+import json
+import pytest
+import accumulator
+import server
+
+
+def _partial(count=2, partials=(240.0,), m2=50.0):
+    return {"features": {"bpm": {"count": count, "sum": list(partials), "m2": m2}}, "genre_mask": 1}
+
+
+@pytest.mark.parametrize("partial", [
+    _partial(partials=["nan"]),
+    _partial(partials=[float("inf")]),
+    _partial(m2="-inf"),
+    _partial(count=-3),
+])
+def test_invalid_partials_are_rejected(partial):
+    with pytest.raises(ValueError):
+        accumulator.Accumulator.from_dict(partial)
+
+
+@pytest.mark.parametrize("body", [
+    '{"partials": [{"features": {"bpm": {"count": 2, "sum": [NaN], "m2": 0}}}]}',
+    '{"partials": [{"features": {"bpm": {"count": -1, "sum": [120], "m2": 0}}}]}',
+    '{"partials": [{"features": {"bpm": {"count": Infinity, "sum": [120], "m2": 0}}}]}',
+    '{"partials": [{"genre_mask": Infinity}]}',
+])
+def test_aggregate_metrics_answers_400_for_invalid_partials(body):
+    response = server.app.test_client().post("/aggregate_metrics", data=body, content_type="application/json")
+    assert response.status_code == 400
+
+
+def test_aggregate_metrics_merges_valid_partials():
+    response = server.app.test_client().post("/aggregate_metrics", json={"partials": [_partial(), _partial()]})
+    assert response.status_code == 200
+    def reject(constant):
+        raise AssertionError(f"{constant} is not valid JSON")
+
+    json.loads(response.get_data(as_text=True), parse_constant=reject)
+    assert response.get_json()["metrics"]["averageBPM"] == 120.0
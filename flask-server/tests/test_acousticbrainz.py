@@ -0,0 +1,37 @@
+import requests
+import acousticbrainz
+import http_client
+import server
+
+MBIDS = ["11111111-1111-1111-1111-111111111111", "22222222-2222-2222-2222-222222222222"]
+
+
+def _unreachable(monkeypatch):
+    def get(url, **kwargs):
+        raise requests.exceptions.ConnectionError("AcousticBrainz is down")
+
+    monkeypatch.setattr(http_client.session, "get", get)
+
+
+def test_failed_bulk_requests_leave_their_mbids_out(monkeypatch):
+    _unreachable(monkeypatch)
+    assert acousticbrainz.get_acousticbrainz_data_batch(MBIDS) == {}
+
+
+def test_batch_route_reports_failed_mbids_when_acousticbrainz_is_down(monkeypatch):
+    _unreachable(monkeypatch)
+    response = server.app.test_client().post("/get_acoustic_data", json={"mbids": MBIDS})
+    assert response.status_code == 200
+    assert response.get_json() == {"results": {}, "missing": [], "failed": MBIDS}
+
+
+def test_store_misses_whose_download_failed_are_left_out(monkeypatch):
+    _unreachable(monkeypatch)
+    features = {"bpm": 120.0}
+
+    class Store:
+        def get(self, mbid):
+            return features if mbid == MBIDS[0] else None
+
+    monkeypatch.setattr(acousticbrainz.feature_store, "default_store", Store)
+    assert acousticbrainz.get_acousticbrainz_data_batch(MBIDS) == {MBIDS[0]: features}
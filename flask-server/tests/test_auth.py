@@ -0,0 +1,128 @@
+"""
+Concurrency tests for login and token refresh: many requests at once, from
+one user and from several, with Spotify's token endpoint stubbed out.
+"""
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs, urlparse
+import pytest
+from spotipy.oauth2 import SpotifyOAuth
+import auth
+import server
+
+USERS = 4
+REQUESTS_PER_USER = 16
+
+
+def _token(access_token, refresh_token, expires_in=3600):
+    return {
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "expires_in": expires_in,
+        "expires_at": int(time.time()) + expires_in,
+        "token_type": "Bearer",
+        "scope": " ".join(server.SCOPES),
+    }
+
+
+def _hammer(count, fn):
+    """Runs fn(i) for i in range(count) on as many threads, released together. Returns the results."""
+    barrier = threading.Barrier(count)
+    results = [None] * count
+    errors = []
+
+    def run(i):
+        barrier.wait()
+        try:
+            results[i] = fn(i)
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+    assert not errors, errors
+    return results
+
+
+@pytest.fixture
+def refreshes(monkeypatch):
+    """Counts refresh_access_token calls per refresh token; each call is slow enough to overlap."""
+    calls = Counter()
+    lock = threading.Lock()
+
+    def refresh_access_token(self, refresh_token):
+        with lock:
+            calls[refresh_token] += 1
+            generation = calls[refresh_token]
+        time.sleep(0.05)
+        return _token(f"access-{refresh_token}-{generation}", refresh_token)
+
+    monkeypatch.setattr(SpotifyOAuth, "refresh_access_token", refresh_access_token)
+    monkeypatch.setattr(server, "token_refresher", auth.TokenRefresher())
+    return calls
+
+
+def test_concurrent_logins_keep_sessions_apart(monkeypatch):
+    def get_access_token(self, code=None, as_dict=True, check_cache=True):
+        time.sleep(0.01)
+        return _token(f"access-{code}", f"refresh-{code}")
+
+    monkeypatch.setattr(SpotifyOAuth, "get_access_token", get_access_token)
+
+    def login(i):
+        client = server.app.test_client()
+        response = client.get(f"/callback?code=user{i}")
+        with client.session_transaction() as session:
+            stored = session["token_info"]["access_token"]
+        redirected = parse_qs(urlparse(response.headers["Location"]).query)["token"][0]
+        return stored, redirected
+
+    results = _hammer(USERS * REQUESTS_PER_USER, login)
+    assert results == [(f"access-user{i}", f"access-user{i}") for i in range(USERS * REQUESTS_PER_USER)]
+
+
+def test_concurrent_requests_refresh_an_expired_token_once(refreshes):
+    def request(i):
+        user = i % USERS
+        with server.app.test_request_context():
+            server.session["token_info"] = _token(f"stale-{user}", f"refresh-{user}", expires_in=-10)
+            token_info = server.get_valid_token()
+            assert server.session["token_info"] == token_info
+            return user, token_info["access_token"]
+
+    results = _hammer(USERS * REQUESTS_PER_USER, request)
+    assert refreshes == {f"refresh-{user}": 1 for user in range(USERS)}
+    assert all(access_token == f"access-refresh-{user}-1" for user, access_token in results)
+    assert server.token_refresher.refreshes == USERS
+
+
+def test_late_requests_with_the_old_refresh_token_reuse_the_refresh(refreshes):
+    def request(i):
+        with server.app.test_request_context():
+            server.session["token_info"] = _token("stale", "refresh-late", expires_in=-10)
+            return server.get_valid_token()["access_token"]
+
+    first = _hammer(REQUESTS_PER_USER, request)
+    later = _hammer(REQUESTS_PER_USER, request)
+    assert refreshes == {"refresh-late": 1}
+    assert set(first + later) == {"access-refresh-late-1"}
+
+
+def test_failed_refresh_logs_the_user_out(monkeypatch):
+    def refresh_access_token(self, refresh_token):
+        time.sleep(0.05)
+        raise RuntimeError("invalid_grant")
+
+    monkeypatch.setattr(SpotifyOAuth, "refresh_access_token", refresh_access_token)
+    monkeypatch.setattr(server, "token_refresher", auth.TokenRefresher())
+
+    def request(i):
+        with server.app.test_request_context():
+            server.session["token_info"] = _token("stale", "refresh-revoked", expires_in=-10)
+            return server.get_valid_token(), "token_info" in server.session
+
+    assert _hammer(REQUESTS_PER_USER, request) == [(None, False)] * REQUESTS_PER_USER
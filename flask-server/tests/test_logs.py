@@ -0,0 +1,19 @@
+import logging
+import logs
+
+
+def test_fields_named_like_record_keys_are_renamed(caplog):
+    log = logs.get_logger("test_logs")
+    with caplog.at_level(logging.INFO):
+        log.warning("Request failed", level="low-level", msg="timeout", mbids=3)
+        log.info("Done", message="ok")
+    assert [record.getMessage() for record in caplog.records] == ["Request failed", "Done"]
+    assert caplog.records[0].fields == {"field_level": "low-level", "field_msg": "timeout", "mbids": 3}
+    assert caplog.records[1].fields == {"field_message": "ok"}
+
+
+def test_formatted_records_keep_their_own_level():
+    record = logging.LogRecord("test_logs", logging.WARNING, __file__, 1, "Request failed", None, None)
+    record.fields = {"field_level": "low-level"}
+    entry = logs.JsonFormatter().format(record)
+    assert '"level": "warning"' in entry and '"field_level": "low-level"' in entry
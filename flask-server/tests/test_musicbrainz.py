@@ -0,0 +1,52 @@
+import deadlines
+import musicbrainz
+import pipeline
+
+ISRCS = [f"USAAA{i:07d}" for i in range(3 * musicbrainz.ISRC_BATCH)]
+
+
+class Response:
+    def __init__(self, isrcs):
+        self.isrcs = isrcs
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        recordings = [{"id": f"mbid-{isrc}", "isrcs": [isrc]} for isrc in self.isrcs]
+        return {"recordings": recordings, "count": len(recordings)}
+
+
+def _search_until(monkeypatch, chunks):
+    """Answers the first `chunks` ISRC searches, then runs out of time."""
+    calls = []
+
+    def get(params, deadline=None):
+        calls.append(params)
+        if len(calls) > chunks:
+            raise deadlines.DeadlineExceeded("Time budget of 1s exhausted")
+        return Response([term.split(":")[1] for term in params["query"].split(" OR ")])
+
+    monkeypatch.setattr(musicbrainz, "_get", get)
+    return calls
+
+
+def test_resolved_chunks_are_kept_when_a_later_one_fails(monkeypatch):
+    _search_until(monkeypatch, 2)
+    found = musicbrainz.get_mbids_by_isrc(ISRCS)
+    resolved = ISRCS[:2 * musicbrainz.ISRC_BATCH]
+    assert found == {isrc: f"mbid-{isrc}" for isrc in resolved}
+    assert all(musicbrainz.cache.get("isrc:" + isrc) == (True, f"mbid-{isrc}") for isrc in resolved)
+
+    # The next call only searches the chunk that didn't finish
+    calls = _search_until(monkeypatch, 1)
+    assert musicbrainz.get_mbids_by_isrc(ISRCS) == {isrc: f"mbid-{isrc}" for isrc in ISRCS}
+    assert len(calls) == 1
+
+
+def test_pipeline_uses_the_isrcs_resolved_before_the_deadline(monkeypatch):
+    _search_until(monkeypatch, 1)
+    tracks = [{"name": f"s{i}", "artist": "a", "album": "b", "isrc": f"GBBBB{i:07d}"}
+              for i in range(2 * musicbrainz.ISRC_BATCH)]
+    found = pipeline._resolve_isrcs(tracks)
+    assert found == {i: f"mbid-GBBBB{i:07d}" for i in range(musicbrainz.ISRC_BATCH)}
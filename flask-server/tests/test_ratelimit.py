@@ -0,0 +1,49 @@
+import time
+import pytest
+import deadlines
+import http_client
+import musicbrainz
+import ratelimit
+
+
+class Response:
+    status_code = 200
+    headers = {}
+
+
+def test_calls_abandoned_for_their_deadline_do_not_delay_the_next_caller():
+    scheduler = ratelimit.RateLimitedScheduler(ratelimit.LocalTokenBucket(rate=10))
+    scheduler.call(Response) # Takes the free slot: the next one is 0.1s away
+
+    for _ in range(50):
+        with pytest.raises(deadlines.DeadlineExceeded):
+            scheduler.call(Response, deadline=deadlines.Deadline(0.05))
+
+    start = time.monotonic()
+    scheduler.call(Response)
+    assert time.monotonic() - start < 0.5 # Not the 5s that 50 lost slots would add
+
+
+def test_calls_within_their_deadline_keep_their_slot():
+    bucket = ratelimit.LocalTokenBucket(rate=10)
+    scheduler = ratelimit.RateLimitedScheduler(bucket)
+    for _ in range(3):
+        scheduler.call(Response, deadline=deadlines.Deadline(1))
+    wait, _ = bucket.reserve()
+    assert wait == pytest.approx(0.1, abs=0.05)
+
+
+def test_server_errors_are_retried_through_the_bucket():
+    class Failing(Response):
+        status_code = 502
+
+    scheduler = ratelimit.RateLimitedScheduler(ratelimit.LocalTokenBucket(rate=100), base_backoff=0.001)
+    assert scheduler.call(Failing).status_code == 502
+    assert scheduler.stats()["calls"] == scheduler.max_retries + 1 # One slot per attempt
+
+
+def test_musicbrainz_adapter_leaves_status_retries_to_the_scheduler():
+    retry = http_client.session.get_adapter(musicbrainz.MUSICBRAINZ_URL).max_retries
+    assert not retry.is_retry("GET", 502) and not retry.is_retry("GET", 503, has_retry_after=True)
+    default = http_client.session.get_adapter("https://acousticbrainz.org/api/v1/").max_retries
+    assert default.is_retry("GET", 502)
@@ -288,7 +288,7 @@ function App() {
     };
 
     // Calculate aggregate metrics from track details
-    const calculatePlaylistMetrics = useCallback((details) => {
+    const calculatePlaylistMetrics = useCallback(async (details) => {
         console.log("Calculate Metrics: Starting calculation with details:", details);
         if (!details || details.length === 0) {
             console.warn("Calculate Metrics: No details provided to calculate metrics.");
@@ -303,33 +303,27 @@ function App() {
             return;
         }
 
-        const validBPMs = details.map(item => item?.bpm).filter(bpm => typeof bpm === 'number');
-        const validDanceabilities = details.map(item => item?.danceability).filter(d => typeof d === 'number');
-        const validGenres = details.map(item => item?.genre).filter(g => g && g !== "Unknown" && g !== "N/A");
-        const validRelaxedProbs = details.map(item => item?.relaxedProbability).filter(p => typeof p === 'number');
-
-        console.log("Calculate Metrics - Valid Data Points:", {
-            BPMs: validBPMs.length,
-            Danceabilities: validDanceabilities.length,
-            Genres: validGenres.length,
-            RelaxedProbs: validRelaxedProbs.length
-        });
-
-        const rawAverageBPM = validBPMs.length > 0 ? validBPMs.reduce((a, b) => a + b, 0) / validBPMs.length : null;
-        const rawAverageDanceability = validDanceabilities.length > 0 ? validDanceabilities.reduce((a, b) => a + b, 0) / validDanceabilities.length : null;
-        const rawAverageRelaxedProb = validRelaxedProbs.length > 0 ? validRelaxedProbs.reduce((a, b) => a + b, 0) / validRelaxedProbs.length : null;
-        const uniqueGenreCount = new Set(validGenres).size;
-
-        const finalAverageBPM = rawAverageBPM !== null ? parseFloat(rawAverageBPM.toFixed(2)) : null;
-        const finalAverageDanceability = rawAverageDanceability !== null ? parseFloat(rawAverageDanceability.toFixed(2)) : null;
-        const finalAverageRelaxedProb = rawAverageRelaxedProb !== null ? parseFloat(rawAverageRelaxedProb.toFixed(2)) : null;
-
-        const calculatedMetrics = {
-            averageBPM: finalAverageBPM,
-            averageDanceability: finalAverageDanceability,
-            uniqueGenreCount: uniqueGenreCount > 0 ? uniqueGenreCount : null,
-            averageRelaxedProbability: finalAverageRelaxedProb,
-        };
+        let calculatedMetrics;
+        try {
+            // The server aggregates in one pass, so only the features are sent
+            const tracks = details.map(item => ({
+                bpm: item?.bpm ?? null,
+                danceability: item?.danceability ?? null,
+                genre: item?.genre ?? null,
+                relaxedProbability: item?.relaxedProbability ?? null,
+            }));
+            const response = await axios.post(`${API_BASE_URL}/aggregate_metrics`, { tracks });
+            console.log("Calculate Metrics: Feature statistics:", response.data.feature_stats);
+            calculatedMetrics = response.data.metrics;
+        } catch (error) {
+            console.error("Calculate Metrics: Error aggregating metrics:", error.response?.data?.error || error.message);
+            calculatedMetrics = {
+                averageBPM: null,
+                averageDanceability: null,
+                uniqueGenreCount: null,
+                averageRelaxedProbability: null,
+            };
+        }
         console.log("Calculate Metrics: Calculated values:", calculatedMetrics);
 
         // Update state using functional update to merge with existing metrics (like duration, potential)
@@ -387,7 +381,7 @@ function App() {
 
             console.log("Process Track Data: Successfully processed track details:", allTrackDetails);
             setTrackDetails(allTrackDetails); // Update state with successfully processed details
-            calculatePlaylistMetrics(allTrackDetails); // Calculate metrics based on the processed details
+            await calculatePlaylistMetrics(allTrackDetails); // Calculate metrics based on the processed details
 
             console.log("\n\nTRACK METRICS: ", allTrackDetails);
         } catch (err) {
@@ -396,7 +390,7 @@ function App() {
             console.error("Process Track Data: Unexpected error during Promise processing:", err);
             setError("An error occurred while processing song details.");
             setTrackDetails([]); // Clear details on major error
-            calculatePlaylistMetrics([]); // Recalculate metrics with empty data
+            await calculatePlaylistMetrics([]); // Recalculate metrics with empty data
         } finally {
             console.log("Process Track Data: Setting loadingData to false.");
             setLoadingData(false); // Stop general loading indicator *after* all processing is done or failed